@@ -14,6 +14,8 @@ __author__ = "aagrawal"
 import sys
 import re
 
+import numpy as np
+
 
 class VQAEval:
     def __init__(self, vqa=None, vqaRes=None, n=2):
@@ -206,42 +208,63 @@ class VQAEval:
         accQuesType = {}
         accAnsType = {}
         print("computing accuracy")
+        # every distinct answer string is normalized once
+        resAnsTable = {}
+        gtAnsTable = {}
+        # one entry per ground truth answer: question, whether it matches the
+        # prediction and how many answers of its question are equal to it
+        gtQues, gtMatch, gtDup = [], [], []
         step = 0
-        for quesId in quesIds:
-            resAns = res[quesId]["answer"]
-            resAns = resAns.replace("\n", " ")
-            resAns = resAns.replace("\t", " ")
-            resAns = resAns.strip()
-            resAns = self.processPunctuation(resAns)
-            resAns = self.processDigitArticle(resAns)
-            gtAcc = []
-            gtAnswers = [ans["answer"] for ans in gts[quesId]["answers"]]
+        for q, quesId in enumerate(quesIds):
+            rawAns = res[quesId]["answer"]
+            resAns = resAnsTable.get(rawAns)
+            if resAns is None:
+                resAns = rawAns.replace("\n", " ")
+                resAns = resAns.replace("\t", " ")
+                resAns = resAns.strip()
+                resAns = self.processPunctuation(resAns)
+                resAns = self.processDigitArticle(resAns)
+                resAnsTable[rawAns] = resAns
+            answers = gts[quesId]["answers"]
+            gtAnswers = [ans["answer"] for ans in answers]
             if len(set(gtAnswers)) > 1:
-                for ansDic in gts[quesId]["answers"]:
-                    ansDic["answer"] = self.processPunctuation(ansDic["answer"])
-            for gtAnsDatum in gts[quesId]["answers"]:
-                otherGTAns = [
-                    item for item in gts[quesId]["answers"] if item != gtAnsDatum
-                ]
-                matchingAns = [item for item in otherGTAns if item["answer"] == resAns]
-                acc = min(1, float(len(matchingAns)) / 3)
-                gtAcc.append(acc)
+                for ansDic in answers:
+                    gtAns = gtAnsTable.get(ansDic["answer"])
+                    if gtAns is None:
+                        gtAns = gtAnsTable[ansDic["answer"]] = self.processPunctuation(ansDic["answer"])
+                    ansDic["answer"] = gtAns
+            matching = [item for item in answers if item["answer"] == resAns]
+            for item in answers:
+                gtQues.append(q)
+                gtMatch.append(len(matching))
+                # leaving an answer out drops every answer equal to it
+                gtDup.append(sum(1 for other in matching if other == item) if item["answer"] == resAns else 0)
+            if step % 100 == 0:
+                self.updateProgress(step / float(len(quesIds)))
+            step = step + 1
+
+        # leave-one-out accuracy of every ground truth answer, averaged per question
+        gtQues = np.asarray(gtQues, dtype=np.int64)
+        gtAcc = np.minimum(1, (np.asarray(gtMatch) - np.asarray(gtDup)).astype(np.float64) / 3)
+        numAns = np.bincount(gtQues, minlength=len(quesIds))
+        if (numAns == 0).any():
+            noAns = [quesIds[q] for q in np.flatnonzero(numAns == 0)]
+            raise ZeroDivisionError(f"questions without ground truth answers: {noAns[:10]}")
+        avgGTAcc = np.bincount(gtQues, weights=gtAcc, minlength=len(quesIds)) / numAns
+
+        for quesId, acc in zip(quesIds, avgGTAcc.tolist()):
             quesType = gts[quesId]["question_type"]
             ansType = gts[quesId]["answer_type"]
-            avgGTAcc = float(sum(gtAcc)) / len(gtAcc)
-            accQA.append(avgGTAcc)
+            accQA.append(acc)
             if quesType not in accQuesType:
                 accQuesType[quesType] = []
-            accQuesType[quesType].append(avgGTAcc)
+            accQuesType[quesType].append(acc)
             if ansType not in accAnsType:
                 accAnsType[ansType] = []
-            accAnsType[ansType].append(avgGTAcc)
-            self.setEvalQA(quesId, avgGTAcc)
-            self.setEvalQuesType(quesId, quesType, avgGTAcc)
-            self.setEvalAnsType(quesId, ansType, avgGTAcc)
-            if step % 100 == 0:
-                self.updateProgress(step / float(len(quesIds)))
-            step = step + 1
+            accAnsType[ansType].append(acc)
+            self.setEvalQA(quesId, acc)
+            self.setEvalQuesType(quesId, quesType, acc)
+            self.setEvalAnsType(quesId, ansType, acc)
 
         self.setAccuracy(accQA, accQuesType, accAnsType)
         print("Done computing accuracy")
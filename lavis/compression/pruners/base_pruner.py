@@ -1,6 +1,6 @@
 import torch
 from lavis.compression.pruners.utils import (
-    loss_vision_language, loss_language, loss_vision, print_time
+    loss_vision_language, loss_language, loss_vision, print_time, invalidate_weight_cache
 )
 
 
@@ -59,6 +59,8 @@ class BasePruner:
 
         for n, p in model.state_dict().items():
             p.data = p.data.type(dtype_record[n])
+        for m in model.modules():
+            invalidate_weight_cache(m)
             
         model.to(device)
 
@@ -0,0 +1,362 @@
+import os
+import shutil
+import tempfile
+
+import torch
+
+from lavis.peft.src.peft.tuners.lora import LoraLayer
+
+
+# cached block arguments holding an (additive or boolean) attention mask,
+# mapped to the stream that provides their key length
+MASK_KEYS = {
+    "attention_mask": "hidden",
+    "position_bias": "hidden",
+    "encoder_attention_mask": "encoder",
+    "encoder_decoder_position_bias": "encoder",
+}
+
+# cached block arguments with a batch and a sequence dimension
+SEQUENCE_KEYS = {
+    "encoder_hidden_states": "encoder",
+    "position_ids": "hidden",
+}
+
+
+def _expand_batch(x, batch_size):
+    if x.shape[0] == 1 and batch_size > 1:
+        return x.expand(batch_size, *x.shape[1:])
+    return x
+
+
+def _pad(x, dim, size, value):
+    dim = dim % x.dim()
+    if x.shape[dim] >= size:
+        return x
+    pad_shape = list(x.shape)
+    pad_shape[dim] = size - x.shape[dim]
+    return torch.cat([x, x.new_full(pad_shape, value)], dim=dim)
+
+
+def _pad_mask(mask, batch_size, key_length, query_length):
+    mask = _expand_batch(mask, batch_size)
+    if mask.dim() == 2:
+        # (batch, keys) keep-mask
+        return _pad(mask, -1, key_length, 0)
+
+    if mask.dtype == torch.bool:
+        masked_value, open_value = False, True
+    elif mask.is_floating_point():
+        masked_value, open_value = torch.finfo(mask.dtype).min, 0
+    else:
+        masked_value, open_value = 0, 1
+
+    # padded keys are never attended; padded queries attend everywhere so they stay finite
+    mask = _pad(mask, -1, key_length, masked_value)
+    if mask.shape[-2] > 1:
+        mask = _pad(mask, -2, query_length, open_value)
+    return mask
+
+
+def pruning_changes_forward(subset, weights_modified, dense):
+    """
+    Whether the masks just set on the linears of ``subset`` change the block
+    forward. They do not if nothing was pruned, or if pruning only set the
+    ``mask`` buffers and the calibration forward never reads them: plain
+    linears ignore ``mask`` and LoRA layers ignore it when run densely.
+    """
+    for module in subset.values():
+        mask = getattr(module, "mask", None)
+        if not torch.is_tensor(mask) or bool(mask.all()):
+            continue
+        if weights_modified or (isinstance(module, LoraLayer) and not dense):
+            return True
+    return False
+
+
+class ActivationStore:
+    """
+    Where the calibration activations live between block forwards.
+
+    Args:
+        location: ``"device"`` keeps them where they were produced, ``"cpu"``
+            moves them to pinned host memory and ``"disk"`` to memory-mapped
+            files under ``offload_dir`` (a temporary directory by default).
+        offload_dir: parent directory of the memory-mapped files.
+
+    Only per-sample tensors are offloaded; tensors shared by all samples
+    (e.g. ``rel_pos_bias``) and non-tensor arguments stay as they are.
+    """
+
+    def __init__(self, location="device", offload_dir=None):
+        assert location in ["device", "cpu", "disk"], f"Unknown activation store location {location}"
+        self.location = location
+        self.offload_dir = offload_dir
+        self._tmpdir = None
+        self._num_files = 0
+        self._files = {}      # data pointer of a memory-mapped tensor -> its file
+
+    @property
+    def offloaded(self):
+        return self.location != "device"
+
+    def _file_tensor(self, tensor):
+        if self._tmpdir is None:
+            if self.offload_dir is not None:
+                os.makedirs(self.offload_dir, exist_ok=True)
+            self._tmpdir = tempfile.mkdtemp(prefix="calibration_", dir=self.offload_dir)
+        filename = os.path.join(self._tmpdir, f"{self._num_files}.bin")
+        self._num_files += 1
+        with open(filename, "wb") as f:
+            f.truncate(tensor.numel() * tensor.element_size())
+        host = torch.from_file(filename, shared=True, size=tensor.numel(), dtype=tensor.dtype)
+        self._files[host.data_ptr()] = filename
+        return host.view(tensor.shape)
+
+    def offload(self, tensor, non_blocking=False):
+        if not self.offloaded or not torch.is_tensor(tensor) or tensor.numel() == 0:
+            return tensor
+        if self.location == "cpu":
+            host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+        else:
+            host = self._file_tensor(tensor)
+        host.copy_(tensor, non_blocking=non_blocking and host.is_pinned())
+        return host
+
+    def offload_cache(self, cache, non_blocking=False):
+        return {
+            k: self.offload(v, non_blocking) if k in MASK_KEYS or k in SEQUENCE_KEYS else v
+            for k, v in cache.items()
+        }
+
+    def load(self, tensor, device):
+        if not self.offloaded or not torch.is_tensor(tensor) or device is None:
+            return tensor
+        return tensor.to(device, non_blocking=True)
+
+    def release(self, tensors):
+        """
+        Remove the memory-mapped files of offloaded ``tensors`` that are no
+        longer used, so that the disk holds about two sets of activations
+        during a sweep. The mapped pages stay valid until the tensors are freed.
+        """
+        for tensor in tensors:
+            filename = self._files.pop(tensor.data_ptr(), None) if torch.is_tensor(tensor) else None
+            if filename is not None:
+                os.remove(filename)
+
+    def clear(self):
+        """Remove the memory-mapped files of the last calibration sweep."""
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+            self._num_files = 0
+            self._files = {}
+
+
+class CalibrationBatches:
+    """
+    Batched calibration engine for the layer-wise pruners.
+
+    ``prepare_calibration_input_encoder`` captures one ``(inp, cache)`` pair per
+    data loader batch. Running a block on each pair separately launches many
+    tiny kernels, so this class stacks consecutive captures into micro-batches
+    of up to ``batch_size`` samples. Sequences are right padded to the longest
+    one in the micro-batch and the cached attention masks are extended so that
+    padded keys are never attended, which keeps the outputs at real positions
+    unchanged.
+
+    Statistics hooks must pass their inputs through ``split``: it slices the
+    batched tensor back into the original captures with the padding removed,
+    so ``add_batch`` is called with exactly the same tensors as by the
+    per-sample loop.
+
+    With an offloading ``store`` the micro-batches live in host memory or on
+    disk between block forwards. ``run`` copies the next micro-batch to
+    ``device`` on a side CUDA stream while the current one is computed, and
+    writes the outputs back to the store, so device memory holds one block
+    plus about two micro-batches regardless of the calibration set size.
+
+    Args:
+        inps: list of captured block inputs, each ``(batch, seq_len, dim)``.
+        caches: list of captured keyword arguments of the block.
+        batch_size: maximal number of samples per micro-batch; ``<= 0``
+            disables stacking and runs every capture on its own.
+        store: ``ActivationStore`` the captures were offloaded to, if any.
+        device: device the block runs on, required when ``store`` offloads.
+    """
+
+    def __init__(self, inps, caches, batch_size=32, store=None, device=None):
+        self.nsamples = sum(inp.shape[0] for inp in inps)
+        self.groups = self._make_groups(inps, batch_size)
+        self.store = store if store is not None else ActivationStore("device")
+        self.device = device
+
+        self.inps, self.caches, self.layouts = [], [], []
+        for group in self.groups:
+            inp, cache, layout = self._collate(
+                [inps[j] for j in group], [caches[j] for j in group]
+            )
+            if len(group) > 1:
+                inp, cache = self.store.offload(inp), self.store.offload_cache(cache)
+            self.inps.append(inp)
+            self.caches.append(cache)
+            self.layouts.append(layout)
+
+        self._stream = None
+        if self.store.offloaded and torch.cuda.is_available() and \
+                self.device is not None and torch.device(self.device).type == "cuda":
+            self._stream = torch.cuda.Stream(device=self.device)
+
+        self.dense = all(c.get("dense", False) for c in self.caches)
+        self.outs = None
+        self._layout = None
+
+    def __len__(self):
+        return len(self.inps)
+
+    @staticmethod
+    def _make_groups(inps, batch_size):
+        groups, group, group_size = [], [], 0
+        for j, inp in enumerate(inps):
+            if len(group) > 0 and (batch_size <= 0 or group_size + inp.shape[0] > batch_size):
+                groups.append(group)
+                group, group_size = [], 0
+            group.append(j)
+            group_size += inp.shape[0]
+        if len(group) > 0:
+            groups.append(group)
+        return groups
+
+    @staticmethod
+    def _collate(inps, caches):
+        batch_sizes = [inp.shape[0] for inp in inps]
+        lengths = {"hidden": [inp.shape[1] for inp in inps]}
+        encoder_states = [c.get("encoder_hidden_states", None) for c in caches]
+        if all(torch.is_tensor(e) for e in encoder_states):
+            lengths["encoder"] = [e.shape[1] for e in encoder_states]
+
+        padded = {k: max(v) for k, v in lengths.items()}
+        needs_padding = any(l != padded[k] for k, v in lengths.items() for l in v)
+        if needs_padding and "encoder" in padded and padded["encoder"] == padded["hidden"]:
+            # keep the two streams distinguishable by their padded length in ``split``
+            padded["encoder"] += 1
+
+        layout = {"batch_sizes": batch_sizes, "lengths": lengths, "padded": padded}
+        if len(inps) == 1:
+            return inps[0], caches[0], layout
+
+        inp = torch.cat([_pad(x, 1, padded["hidden"], 0) for x in inps])
+
+        cache = {}
+        for k in caches[0]:
+            values = [c[k] for c in caches]
+            if k in MASK_KEYS and torch.is_tensor(values[0]):
+                cache[k] = torch.cat([
+                    _pad_mask(v, b, padded[MASK_KEYS[k]], padded["hidden"])
+                    for v, b in zip(values, batch_sizes)
+                ])
+            elif k in SEQUENCE_KEYS and torch.is_tensor(values[0]) and SEQUENCE_KEYS[k] in padded:
+                cache[k] = torch.cat([
+                    _pad(_expand_batch(v, b), 1, padded[SEQUENCE_KEYS[k]], 0)
+                    for v, b in zip(values, batch_sizes)
+                ])
+            else:
+                # shared by all captures, e.g. rel_pos_bias, head masks or the dense flag
+                cache[k] = values[0]
+
+        return inp, cache, layout
+
+    def split(self, inp):
+        """Slice a batched linear input back into the captured batches."""
+        layout = self._layout
+        if layout is None or len(layout["batch_sizes"]) == 1:
+            return [inp]
+        if inp.dim() != 3 or inp.shape[0] != sum(layout["batch_sizes"]):
+            return [inp]
+
+        stream = None
+        for k, length in layout["padded"].items():
+            if inp.shape[1] == length:
+                stream = k
+                break
+
+        pieces, offset = [], 0
+        for j, b in enumerate(layout["batch_sizes"]):
+            piece = inp[offset:offset + b]
+            if stream is not None:
+                piece = piece[:, :layout["lengths"][stream][j]]
+            pieces.append(piece)
+            offset += b
+        return pieces
+
+    def _fetch(self, g):
+        if not self.store.offloaded:
+            return self.inps[g], self.caches[g], None
+
+        if self._stream is None:
+            inp = self.store.load(self.inps[g], self.device)
+            cache = {k: self.store.load(v, self.device) for k, v in self.caches[g].items()}
+            return inp, cache, None
+
+        with torch.cuda.stream(self._stream):
+            inp = self.store.load(self.inps[g], self.device)
+            cache = {k: self.store.load(v, self.device) for k, v in self.caches[g].items()}
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return inp, cache, event
+
+    def run(self, forward_fn, keep_outputs=True):
+        """
+        Run ``forward_fn(inp, cache)`` on every micro-batch.
+
+        The outputs are kept in ``self.outs`` (offloaded to the store) when
+        ``keep_outputs`` is set, so that ``propagate`` can reuse them.
+        """
+        if self._stream is not None:
+            # outputs of the previous sweep may still be in flight to host memory
+            self._stream.wait_stream(torch.cuda.current_stream(self.device))
+
+        outs = []
+        fetched = self._fetch(0) if len(self.inps) > 0 else None
+        for g in range(len(self.inps)):
+            inp, cache, event = fetched
+            if event is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(event)
+                for v in [inp] + list(cache.values()):
+                    if torch.is_tensor(v) and v.is_cuda:
+                        v.record_stream(current_stream)
+            # double buffering: start copying the next micro-batch before computing this one
+            fetched = self._fetch(g + 1) if g + 1 < len(self.inps) else None
+
+            self._layout = self.layouts[g]
+            out = forward_fn(inp, cache)
+            if keep_outputs:
+                outs.append(self.store.offload(out, non_blocking=True))
+            del inp, cache
+        self._layout = None
+
+        if self.outs is not None:
+            # outputs of a previous sweep that were not propagated
+            self.store.release(self.outs)
+        self.outs = outs if keep_outputs else None
+        return outs
+
+    def propagate(self, forward_fn, reuse_outputs=False):
+        """
+        Use the block outputs as the inputs of the next block.
+
+        With ``reuse_outputs`` the outputs of the last ``run`` (the statistics
+        pass) are taken as they are instead of running the block again. This
+        is only exact when pruning did not change the block forward, see
+        ``pruning_changes_forward``. The store files of the superseded
+        activations are removed.
+        """
+        stale = self.inps
+        if reuse_outputs and self.outs is not None:
+            self.inps = self.outs
+        else:
+            self.inps = self.run(forward_fn)
+        self.outs = None
+        self.store.release(stale)
@@ -6,11 +6,13 @@ from functools import partial
 
 from lavis.common.registry import registry
 from lavis.compression.pruners.utils import (
-    loss_vision_language, loss_language, loss_vision, print_time
+    loss_vision_language, loss_language, loss_vision, print_time, nm_prune_mask, set_mask, zero_pruned_weights
 )
 
 
+from lavis.compression.pruners.calibration import CalibrationBatches, pruning_changes_forward
 from lavis.compression.pruners.layer_single_base_pruner import LayerWiseBasePruner, LayerSparsity
+from lavis.compression.pruners.shared_inputs import SharedInputs
 from lavis.peft.src.peft.tuners.lora import Linear, LoraLayer, Linear8bitLt
 
 
@@ -63,8 +65,6 @@ class WrappedGPT:
         self.nsamples = 0
 
         self.initial_method = initial_method
-        if self.initial_method == "sparsegpt":
-            self.H = torch.zeros((self.columns, self.columns), device=self.dev)
 
         self.scaler_row = torch.zeros((self.columns), device=self.dev)
         self.sum_metric_row = torch.zeros((self.columns), device=self.dev)
@@ -157,6 +157,7 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
             prune_per_model=prune_per_model,
             prune_n=prune_n,
             prune_m=prune_m,
+            **kwargs,
         )
         
         self.pow_of_var_regrowing = pow_of_var_regrowing
@@ -272,13 +273,15 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
                 "attention_mask", "position_ids", 
             ]
             
+        store = self.activation_store
+
         class Catcher(nn.Module):
             def __init__(self, module):
                 super().__init__()
                 self.module = module
                 
             def forward(self, inp, dense=True, **kwargs):
-                inps.append(inp)
+                inps.append(store.offload(inp))
                 inps[-1].requires_grad = False
                 
                 cache = {}
@@ -286,7 +289,7 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
                     cache[k] = kwargs[k]
                 if lora_model:
                     cache["dense"] = dense
-                caches.append(cache)
+                caches.append(store.offload_cache(cache))
                 raise ValueError
 
         layers[0] = Catcher(layers[0])
@@ -319,6 +322,11 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
             inps, outs, caches = self.prepare_calibration_input_encoder(model, dataloader, device, model_prefix, n_samples, module_to_process, lora_model)
 
         n_samples = min(n_samples, len(inps))
+        calibration = CalibrationBatches(
+            inps[:n_samples], caches[:n_samples], batch_size=self.calibration_batch_size,
+            store=self.activation_store, device=device,
+        )
+        del inps, outs, caches
 
         total_time = 0
         layers = get_module_recursive(model, module_to_process)
@@ -338,26 +346,41 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
             wrapped_layers = {}
             for name in subset:
                 wrapped_layers[name] = WrappedGPT(subset[name])
+            # linears reading the same input share its statistics
+            shared = SharedInputs()
+            # the sparsegpt initial mask needs the Hessians, see hessian.py
+            hessians = self.hessian_store(shared) if self.initial_method == "sparsegpt" else None
 
             def add_batch(name):
                 def tmp(_, inp, out):
-                    wrapped_layers[name].add_batch(inp[0].data, out.data)
+                    if not shared.is_owner(name, inp[0].data):
+                        return
+                    for inp_j in calibration.split(inp[0].data):
+                        wrapped_layers[name].add_batch(inp_j, out.data)
+                        if hessians is not None:
+                            hessians.add_batch(name, subset[name], inp_j)
                 return tmp
 
             handles = []
             for name in wrapped_layers:
                 handles.append(subset[name].register_forward_hook(add_batch(name)))
 
-            for j in range(n_samples):
+            def forward_block(inp, cache):
                 with torch.no_grad():
                     with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])[0]
+                        return layer(inp, **cache)[0]
+
+            calibration.run(forward_block, keep_outputs=self.fused_propagate)
+            shared.finish()
+            shared.share(wrapped_layers)
+            if hessians is not None:
+                hessians.finish()
                         
             for h in handles:
                 h.remove()
 
             for name in subset:
-                assert wrapped_layers[name].nsamples == len(inps) * inps[0].shape[0]
+                assert wrapped_layers[name].nsamples == calibration.nsamples
                 
                 start_time = time.time()
 
@@ -383,8 +406,7 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
                         W = W.t()
                     W = W.float()
 
-                    H = wrapped_layers[name].H
-                    # del wrapped_layers[name].H
+                    H = hessians.get(name)
                     dead = torch.diag(H) == 0
                     H[dead, dead] = 1
                     W[:, dead] = 0
@@ -414,28 +436,9 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
                     #             tmp = initial_metric[:,ii:(ii+self.prune_m)].float()
                     #             weight_mask.scatter_(1,ii+torch.topk(tmp, self.prune_n, dim=1, largest=False)[1], True)
                     # else:
-                    initial_prune_indices = torch.zeros((initial_metric.shape[0], 0), dtype=torch.int64, device=initial_metric.device,)
-                    initial_res_indices = torch.zeros((initial_metric.shape[0], 0), dtype=torch.int64, device=initial_metric.device,)
-
-                    for ii in range(initial_metric.shape[1]):
-                        if ii % self.prune_m == 0:
-                            tmp = initial_metric[:, ii : (ii + self.prune_m)].float()
-                            _, tmp_all_indices = torch.sort(tmp, dim=1)
-                            tmp_all_indices += ii
-                            res_prune_n = self.prune_m - self.prune_n
-                            tmp_indices, tmp_res_indices = torch.split(
-                                tmp_all_indices,
-                                split_size_or_sections=[self.prune_n, res_prune_n],
-                                dim=1,
-                            )
-
-                            initial_prune_indices = torch.cat(
-                                (initial_prune_indices, tmp_indices), dim=1
-                            )
-                            initial_res_indices = torch.cat(
-                                (initial_res_indices, tmp_res_indices), dim=1
-                            )
-                            weight_mask.scatter_(1, tmp_indices, True)
+                    weight_mask, initial_prune_indices, initial_res_indices = nm_prune_mask(
+                        initial_metric, self.prune_n, self.prune_m, return_indices=True
+                    )
 
                     metric_for_regrowing = DSnoT_metric.clone()
                     
@@ -750,20 +753,22 @@ class T5LayerDSnoTPruner(LayerWiseBasePruner):
                                 torch.zeros_like(regrowing_metric),
                             )
                             
-                setattr(subset[name], "mask", ~weight_mask.bool())
+                set_mask(subset[name], ~weight_mask.bool(), self.pack_masks, self.prune_n, self.prune_m)
                 if lora_model == False:
-                    subset[name].weight.data[weight_mask] = 0  ## set weights to zero 
+                    zero_pruned_weights(subset[name], weight_mask)  ## set weights to zero 
                 
             end_time = time.time()
             total_time += end_time - start_time
 
             # print(f"pruning time: {total_time:.3f}")
-            for j in range(n_samples):
-                with torch.no_grad():
-                    with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])[0]
-            inps, outs = outs, inps
+            calibration.propagate(
+                forward_block,
+                reuse_outputs=self.fused_propagate and \
+                    not pruning_changes_forward(subset, weights_modified=not lora_model, dense=calibration.dense),
+            )
 
+        del calibration
+        self.activation_store.clear()
         getattr(model, model_prefix).config.use_cache = use_cache 
         torch.cuda.empty_cache()
         
@@ -904,6 +909,7 @@ class VITLayerDSnoTPruner(LayerWiseBasePruner):
             prune_per_model=prune_per_model,
             prune_n=prune_n,
             prune_m=prune_m,
+            **kwargs,
         )
         
         self.loss_func = loss_vision
@@ -1013,19 +1019,21 @@ class VITLayerDSnoTPruner(LayerWiseBasePruner):
             "rel_pos_bias"
         ]
 
+        store = self.activation_store
+
         class Catcher(nn.Module):
             def __init__(self, module):
                 super().__init__()
                 self.module = module
             def forward(self, inp, rel_pos_bias, dense=True):
-                inps.append(inp)
+                inps.append(store.offload(inp))
                 inps[-1].requires_grad = False
                 
                 cache = {}
                 cache["rel_pos_bias"] = rel_pos_bias
                 if lora_model:
                     cache["dense"] = dense 
-                caches.append(cache)
+                caches.append(store.offload_cache(cache))
                 raise ValueError
 
         layers[0] = Catcher(layers[0])
@@ -1052,6 +1060,11 @@ class VITLayerDSnoTPruner(LayerWiseBasePruner):
             inps, outs, caches = self.prepare_calibration_input_encoder(model, dataloader, device, model_prefix, n_samples, module_to_process, lora_model)
 
         n_samples = min(n_samples, len(inps))
+        calibration = CalibrationBatches(
+            inps[:n_samples], caches[:n_samples], batch_size=self.calibration_batch_size,
+            store=self.activation_store, device=device,
+        )
+        del inps, outs, caches
 
         total_time = 0
         layers = get_module_recursive(model, module_to_process)
@@ -1071,26 +1084,41 @@ class VITLayerDSnoTPruner(LayerWiseBasePruner):
             wrapped_layers = {}
             for name in subset:
                 wrapped_layers[name] = WrappedGPT(subset[name])
+            # linears reading the same input share its statistics
+            shared = SharedInputs()
+            # the sparsegpt initial mask needs the Hessians, see hessian.py
+            hessians = self.hessian_store(shared) if self.initial_method == "sparsegpt" else None
 
             def add_batch(name):
                 def tmp(_, inp, out):
-                    wrapped_layers[name].add_batch(inp[0].data, out.data)
+                    if not shared.is_owner(name, inp[0].data):
+                        return
+                    for inp_j in calibration.split(inp[0].data):
+                        wrapped_layers[name].add_batch(inp_j, out.data)
+                        if hessians is not None:
+                            hessians.add_batch(name, subset[name], inp_j)
                 return tmp
 
             handles = []
             for name in wrapped_layers:
                 handles.append(subset[name].register_forward_hook(add_batch(name)))
 
-            for j in range(n_samples):
+            def forward_block(inp, cache):
                 with torch.no_grad():
                     with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])
+                        return layer(inp, **cache)
+
+            calibration.run(forward_block, keep_outputs=self.fused_propagate)
+            shared.finish()
+            shared.share(wrapped_layers)
+            if hessians is not None:
+                hessians.finish()
                         
             for h in handles:
                 h.remove()
 
             for name in subset:
-                assert wrapped_layers[name].nsamples == len(inps) * inps[0].shape[0]
+                assert wrapped_layers[name].nsamples == calibration.nsamples
                 
                 start_time = time.time()
 
@@ -1116,8 +1144,7 @@ class VITLayerDSnoTPruner(LayerWiseBasePruner):
                         W = W.t()
                     W = W.float()
 
-                    H = wrapped_layers[name].H
-                    # del wrapped_layers[name].H
+                    H = hessians.get(name)
                     dead = torch.diag(H) == 0
                     H[dead, dead] = 1
                     W[:, dead] = 0
@@ -1146,28 +1173,9 @@ class VITLayerDSnoTPruner(LayerWiseBasePruner):
                     #             tmp = initial_metric[:,ii:(ii+self.prune_m)].float()
                     #             weight_mask.scatter_(1,ii+torch.topk(tmp, self.prune_n, dim=1, largest=False)[1], True)
                     # else:
-                    initial_prune_indices = torch.zeros((initial_metric.shape[0], 0), dtype=torch.int64, device=initial_metric.device,)
-                    initial_res_indices = torch.zeros((initial_metric.shape[0], 0), dtype=torch.int64, device=initial_metric.device,)
-
-                    for ii in range(initial_metric.shape[1]):
-                        if ii % self.prune_m == 0:
-                            tmp = initial_metric[:, ii : (ii + self.prune_m)].float()
-                            _, tmp_all_indices = torch.sort(tmp, dim=1)
-                            tmp_all_indices += ii
-                            res_prune_n = self.prune_m - self.prune_n
-                            tmp_indices, tmp_res_indices = torch.split(
-                                tmp_all_indices,
-                                split_size_or_sections=[self.prune_n, res_prune_n],
-                                dim=1,
-                            )
-
-                            initial_prune_indices = torch.cat(
-                                (initial_prune_indices, tmp_indices), dim=1
-                            )
-                            initial_res_indices = torch.cat(
-                                (initial_res_indices, tmp_res_indices), dim=1
-                            )
-                            weight_mask.scatter_(1, tmp_indices, True)
+                    weight_mask, initial_prune_indices, initial_res_indices = nm_prune_mask(
+                        initial_metric, self.prune_n, self.prune_m, return_indices=True
+                    )
 
                     metric_for_regrowing = DSnoT_metric.clone()
                     
@@ -1480,20 +1488,22 @@ class VITLayerDSnoTPruner(LayerWiseBasePruner):
                                 regrowing_metric,
                                 torch.zeros_like(regrowing_metric),
                             )
-                setattr(subset[name], "mask", ~weight_mask.bool())
+                set_mask(subset[name], ~weight_mask.bool(), self.pack_masks, self.prune_n, self.prune_m)
                 if lora_model == False:
-                    subset[name].weight.data[weight_mask] = 0  ## set weights to zero 
+                    zero_pruned_weights(subset[name], weight_mask)  ## set weights to zero 
                 
             end_time = time.time()
             total_time += end_time - start_time
 
             # print(f"pruning time: {total_time:.3f}")
-            for j in range(n_samples):
-                with torch.no_grad():
-                    with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])
-            inps, outs = outs, inps
+            calibration.propagate(
+                forward_block,
+                reuse_outputs=self.fused_propagate and \
+                    not pruning_changes_forward(subset, weights_modified=not lora_model, dense=calibration.dense),
+            )
 
+        del calibration
+        self.activation_store.clear()
         torch.cuda.empty_cache()
         
         return model
@@ -1659,6 +1669,7 @@ class BLIPT5LayerDSnoTPruner(LayerWiseBasePruner):
             prune_per_model=prune_per_model,
             prune_n=prune_n, 
             prune_m=prune_m, 
+            **kwargs,
         )
         self.pow_of_var_regrowing = pow_of_var_regrowing
         self.without_same_sign = without_same_sign
@@ -1680,6 +1691,20 @@ class BLIPT5LayerDSnoTPruner(LayerWiseBasePruner):
         self.t5_model_prefix = t5_model_prefix
         self.vit_model_prefix = vit_model_prefix
         
+    def mask_cache_fields(self, sparsity_dict, lora_model):
+        fields = super().mask_cache_fields(sparsity_dict, lora_model)
+        fields.update(
+            initial_method=self.initial_method,
+            without_DSnoT=self.without_DSnoT,
+            pow_of_var_regrowing=self.pow_of_var_regrowing,
+            without_same_sign=self.without_same_sign,
+            update_threshold=self.update_threshold,
+            max_cycle_time=self.max_cycle_time,
+            skip_layer=self.skip_layer,
+            skip_sub_layer=self.skip_sub_layer,
+        )
+        return fields
+
     def get_sparsity(self, t5_sparsity, vit_sparsity, sparsity_ratio_granularity=None):
         original_sparsity = 0.5 * (t5_sparsity + vit_sparsity)
         if self.sparsity_dict is not None:
@@ -1752,6 +1777,10 @@ class BLIPT5LayerDSnoTPruner(LayerWiseBasePruner):
             prune_per_model=self.prune_per_model,
             per_model_group=[self.t5_model_prefix, self.vit_model_prefix],
             per_model_sparsity=[t5_sparsity, vit_sparsity],
+            grad_accum_dtype=self.grad_accum_dtype,
+            shard_grad_accum=self.shard_grad_accum,
+            zo_max_replicas=self.zo_max_replicas,
+            score_cache=self.score_cache,
         )
         
         return sparsity_module.return_sparsity()
@@ -1781,6 +1810,10 @@ class BLIPT5LayerDSnoTPruner(LayerWiseBasePruner):
                 sparsity_ratio_granularity=self.sparsity_ratio_granularity
             )
 
+        if self.load_cached_masks(global_sparsity_dict, lora_model):
+            self.model_reset(self.model, dtype_record, requires_grad_record, device)
+            return self.model, global_sparsity_dict
+
         if self.vit_prune_spec is not None and float(vit_keep_ratio) < 1.:
 
             sparsity_ratio = 1 - vit_keep_ratio
@@ -1857,6 +1890,8 @@ class BLIPT5LayerDSnoTPruner(LayerWiseBasePruner):
                     lora_model=lora_model, 
                 )
                 
+        self.save_masks([self.vit_model_prefix, self.t5_model_prefix], global_sparsity_dict, lora_model)
+
         # let the pruned model has the original
         self.model_reset(self.model, dtype_record, requires_grad_record, device)
         
@@ -4,9 +4,11 @@ import numpy as np
 
 from lavis.common.registry import registry
 from lavis.compression.pruners.utils import (
-    loss_vision_language, loss_language, loss_vision, print_time
+    loss_vision_language, loss_language, loss_vision, print_time, global_threshold_mask, kth_smallest
 )
 from lavis.compression.pruners.layer_single_base_pruner import LayerWiseBasePruner, LayerSparsity
+from lavis.compression.pruners.grad_accumulator import GradientAccumulator
+from lavis.compression.pruners.zeroth_order import ZerothOrderEngine, per_tensor_mezo_scores
 
 
 def get_module_recursive(base, module_to_process):
@@ -91,6 +93,7 @@ class BLIPT5GlobalPruner(LayerWiseBasePruner):
             num_data_first_stage=num_data_first_stage,
             num_noise=num_noise,
             sparsity_dict=sparsity_dict,
+            **kwargs,
         )
         
         self.t5_prune_spec = t5_prune_spec
@@ -107,41 +110,21 @@ class BLIPT5GlobalPruner(LayerWiseBasePruner):
     
     def get_mask(self, importance_scores, p, max_sparsity_per_layer):
         # Set top (1 - max_sparsity)% of parameters to be very large value to avoid 
-        # them being pruned
-        
-        for k, v in importance_scores.items():
-            num_to_set = int(importance_scores[k].numel() * (1 - max_sparsity_per_layer))
-            
-            if num_to_set > 0:
-                threshold, _ = torch.topk(importance_scores[k].flatten(), num_to_set, largest=True)
-                threshold = threshold[-1] # take the last value
-
-                importance_scores[k][torch.where(v >= threshold)] = torch.finfo(v.dtype).max
-        
-        # Flatten all tensors and concatenate them
-        all_scores = torch.cat([t.flatten() for t in importance_scores.values()])
-        
-        # Sort and find the threshold
-        num_to_zero_out = int(p * all_scores.numel())
-        threshold, _ = torch.topk(all_scores, num_to_zero_out, largest=False)
-        threshold = threshold[-1]
-        
-        # Create mask based on threshold
-        masks = {}
-        for k, v in importance_scores.items():
-            masks[k] = (v > threshold).type(v.dtype)
-        
-        return masks
+        # them being pruned, then find the global threshold by streaming over the
+        # scores instead of concatenating them
+        device = "cuda" if torch.cuda.is_available() else None
+        return global_threshold_mask(importance_scores, p, max_sparsity_per_layer, device=device)
     
     def get_layerwise_mask(self, importance_scores, p):
         # Set top (1 - max_sparsity)% of parameters to be very large value to avoid 
         # them being pruned
         masks = {}
         for k, v in importance_scores.items():
-            all_scores = importance_scores[k].flatten()
-            num_to_zero_out = int(p * all_scores.numel())
-            threshold, _ = torch.topk(all_scores, num_to_zero_out, largest=False)
-            threshold = threshold[-1]
+            num_to_zero_out = int(p * v.numel())
+            if num_to_zero_out == 0:
+                masks[k] = torch.ones_like(v)
+                continue
+            threshold = kth_smallest([v], num_to_zero_out)
 
             masks[k] = (v > threshold).type(v.dtype)
 
@@ -264,12 +247,14 @@ class BLIPT5AOBDPruner(BLIPT5GlobalPruner):
                 names.append(k)
                 params.append(v)
             
-        gradients_dict = {k: 0 for k in names}
+        # running sums stay on device, only the final scores are copied to the host
+        gradients = GradientAccumulator(
+            names, params, square=False, dtype=self.grad_accum_dtype, shard=self.shard_grad_accum
+        )
         
         device = next(iter(model.parameters())).device
 
         accum_samples = 0
-        current_batch_index = 0
         
         for d in data_loader:
             # print(accum_samples)
@@ -279,22 +264,17 @@ class BLIPT5AOBDPruner(BLIPT5GlobalPruner):
             loss, batch_len = loss_func(model, d, device != "cpu")
 
             accum_samples += batch_len
-            current_batch_index += 1
 
             grads = torch.autograd.grad(loss, params)
             
             assert len(grads) == len(names) == len(params)
 
-            for k, v in zip(names, grads):
-                gradients_dict[k] += v.cpu().data.float().abs()
-
-        for k in names:
-            # use current_batch_index rather than self.num_samples because sometimes
-            # the batch size might not be 1, and the loss is already normalized by 
-            # batch size, now when only have to normalize it by num_batches now
-            gradients_dict[k] /= current_batch_index
+            gradients.add(grads)
+            del grads
 
-        importance_measure = {k: (v.cpu().data.float().abs()) * gradients_dict[k].abs() for k, v in zip(names, params)}
+        # the sums are normalized by the number of batches rather than self.num_samples
+        # because the batch size might not be 1, and the loss is already normalized by batch size
+        importance_measure = gradients.importance(lambda w, g: w.float().abs() * g.abs())
         
         return importance_measure
     
@@ -303,21 +283,6 @@ class BLIPT5AOBDPruner(BLIPT5GlobalPruner):
 class BLIPT5AMeZoPruner(BLIPT5GlobalPruner):
     pruner_name = "blipt5_mezo_pruner"
     
-    def zo_perturb_parameters(self, params, random_seed=1, scaling_factor=1, zo_eps=1e-3):
-        """
-        Perturb the parameters with random vector z.
-        Input: 
-        - random_seed: random seed for MeZO in-place perturbation (if it's None, we will use self.zo_random_seed)
-        - scaling_factor: theta = theta + scaling_factor * z * eps
-        """
-
-        # Set the random seed to ensure that we sample the same z for perturbation/update
-        torch.manual_seed(random_seed)
-        
-        for param in params:
-            z = torch.normal(mean=0, std=1, size=param.data.size(), device=param.data.device, dtype=param.data.dtype)
-            param.data = param.data + scaling_factor * z * zo_eps
-    
     @print_time
     def compute_importance_scores(self, model, data_loader=None, dict_layers_to_prune={}, loss_func=None):
         
@@ -329,55 +294,20 @@ class BLIPT5AMeZoPruner(BLIPT5GlobalPruner):
                 names.append(k)
                 params.append(v)
         
-        gradients_dict = {k: 0 for k in names}
-        
         device = next(iter(model.parameters())).device
 
-        accum_samples = 0
-        current_batch_index = 0
-        
         zo_eps = 1e-3
         
         n_mezo = self.num_noise
         
-        for i, (name, param) in enumerate(zip(names, params)):
-            print(i, name)
-            accum_samples = 0
-            current_batch_index = 0
-            
-            for d in data_loader:
-                if accum_samples >= self.num_samples:
-                    break
-                
-                per_gradients_dict = {name: 0}
-                
-                for _ in range(n_mezo):
-                    
-                    if accum_samples >= self.num_samples:
-                        break
-                    
-                    zo_random_seed = np.random.randint(1000000000)
-                    
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
-                    with torch.no_grad():
-                        loss1, batch_len = loss_func(model, d, device != "cpu")
-                    
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=-2, zo_eps=zo_eps)
-                    with torch.no_grad():
-                        loss2, batch_len = loss_func(model, d, device != "cpu")
-                
-                    # recover the weight
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
-
-                    accum_samples += batch_len
-                    current_batch_index += 1
-                    
-                    projected_grad = ((loss1 - loss2) / (2 * zo_eps)).item()
-
-                    torch.manual_seed(zo_random_seed)
-                    per_gradients_dict[name] += abs(projected_grad)
-                        
-                gradients_dict[name] += torch.FloatTensor([per_gradients_dict[name]]).abs()
+        # every tensor is perturbed on its own, the perturbations of many tensors
+        # and directions are evaluated together in stacked forwards
+        engine = ZerothOrderEngine(
+            model, names, params, loss_func, eps=zo_eps,
+            max_replicas=self.zo_max_replicas, cuda_enabled=device != "cpu",
+        )
+        scores = per_tensor_mezo_scores(engine, data_loader, self.num_samples, n_mezo)
+        gradients_dict = {k: torch.FloatTensor([score]) for k, score in zip(names, scores)}
                 
         importance_measure = {k: gradients_dict[k].abs() for k, v in zip(names, params)}
             
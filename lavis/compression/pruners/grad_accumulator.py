@@ -0,0 +1,166 @@
+import torch
+import torch.distributed as dist
+
+from lavis.common.dist_utils import get_rank, get_world_size
+
+
+ACCUMULATOR_DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+def _shard_owners(params, world_size):
+    # greedy size balancing, largest tensors first
+    loads = [0] * world_size
+    owners = [0] * len(params)
+    for i in sorted(range(len(params)), key=lambda i: -params[i].numel()):
+        rank = loads.index(min(loads))
+        owners[i] = rank
+        loads[rank] += params[i].numel()
+    return owners
+
+
+def _buckets(params, owners, max_numel):
+    # the parameters of one owner and device, in chunks of up to ``max_numel`` elements
+    groups = {}
+    for i, param in enumerate(params):
+        groups.setdefault((owners[i], str(param.device)), []).append(i)
+    buckets = []
+    for key in sorted(groups):
+        current, numel = [], 0
+        for i in groups[key]:
+            if current and numel + params[i].numel() > max_numel:
+                buckets.append(current)
+                current, numel = [], 0
+            current.append(i)
+            numel += params[i].numel()
+        buckets.append(current)
+    return buckets
+
+
+class GradientAccumulator:
+    """
+    Running sums of squared (Fisher) or absolute gradients for first-order
+    importance scores.
+
+    The sums stay on the device of each parameter in ``dtype``; a tensor that
+    does not fit falls back to host memory. With ``shard`` and an initialized
+    process group, every parameter is owned by a single rank: the other ranks
+    reduce their per-batch contribution to it, so each rank only holds about
+    ``1 / world_size`` of the accumulators. Nothing is copied to the host
+    before ``importance``.
+
+    The contributions of a batch are flattened into buckets of the
+    parameters of one owner, one ``dist.reduce`` per bucket; the next bucket
+    is filled while the previous one is reduced.
+
+    Args:
+        names (list): parameter names.
+        params (list): the parameters, aligned with ``names``.
+        square (bool): accumulate ``grad ** 2`` instead of ``|grad|``.
+        dtype: accumulator dtype, a ``torch.dtype`` or a key of ``ACCUMULATOR_DTYPES``.
+        shard (bool): shard the accumulators across ranks.
+        bucket_mb (int): size of the reduced buckets in MB, a larger
+            parameter is reduced on its own.
+    """
+
+    def __init__(self, names, params, square=True, dtype=torch.float32, shard=False, bucket_mb=64):
+        if isinstance(dtype, str):
+            dtype = ACCUMULATOR_DTYPES[dtype]
+        self.names = list(names)
+        self.params = list(params)
+        self.square = square
+        self.dtype = dtype
+        self.num_batches = 0
+
+        self.shard = shard and get_world_size() > 1
+        self.rank = get_rank()
+        if self.shard:
+            self.owners = _shard_owners(self.params, get_world_size())
+            max_numel = bucket_mb * 1024 ** 2 * 8 // torch.finfo(dtype).bits
+            self.buckets = _buckets(self.params, self.owners, max(max_numel, 1))
+        else:
+            self.owners = [self.rank] * len(self.params)
+
+        self.sums = {}
+        for name, param, owner in zip(self.names, self.params, self.owners):
+            if owner == self.rank:
+                self.sums[name] = self._allocate(param)
+
+    def _allocate(self, param):
+        try:
+            return torch.zeros(param.shape, dtype=self.dtype, device=param.device)
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            print(f"Not enough device memory for the gradient accumulator of shape {tuple(param.shape)}, using host memory")
+            return torch.zeros(param.shape, dtype=self.dtype, device="cpu")
+
+    def _contribution(self, grad):
+        grad = grad.detach().float()
+        return (grad.pow_(2) if self.square else grad.abs_()).to(self.dtype)
+
+    def _accumulate(self, bucket, flat, work):
+        work.wait()
+        owner = self.owners[bucket[0]]
+        if owner == self.rank:
+            parts = flat.split([self.params[i].numel() for i in bucket])
+            for i, part in zip(bucket, parts):
+                acc = self.sums[self.names[i]]
+                acc += part.view(acc.shape).to(acc.device)
+
+    @torch.no_grad()
+    def add(self, grads):
+        """Accumulate the gradients of one batch, aligned with ``names``."""
+        assert len(grads) == len(self.names)
+        if self.shard:
+            pending = None
+            for bucket in self.buckets:
+                flat = torch.cat([self._contribution(grads[i]).view(-1) for i in bucket])
+                work = dist.reduce(flat, dst=self.owners[bucket[0]], async_op=True)
+                if pending is not None:
+                    self._accumulate(*pending)
+                pending = (bucket, flat, work)
+            if pending is not None:
+                self._accumulate(*pending)
+        else:
+            for name, grad in zip(self.names, grads):
+                acc = self.sums[name]
+                acc += self._contribution(grad).to(acc.device)
+        self.num_batches += 1
+
+    def _total_batches(self):
+        if not self.shard:
+            return self.num_batches
+        count = torch.tensor([self.num_batches], dtype=torch.long, device=self.params[0].device)
+        dist.all_reduce(count)
+        return int(count.item())
+
+    @torch.no_grad()
+    def importance(self, score_fn, out_device="cpu"):
+        """
+        Turn the sums into importance scores.
+
+        ``score_fn(param, mean)`` receives the parameter and the float32 mean
+        accumulated value (on the parameter's device) and its result is moved
+        to ``out_device``, one parameter at a time. The accumulators are freed
+        on the way.
+        """
+        num_batches = max(self._total_batches(), 1)
+        scores = {}
+        for name, param, owner in zip(self.names, self.params, self.owners):
+            if self.shard:
+                acc = self.sums.pop(name) if owner == self.rank else \
+                    torch.empty(param.shape, dtype=self.dtype, device=param.device)
+                acc = acc.to(param.device)
+                dist.broadcast(acc, src=owner)
+            else:
+                acc = self.sums.pop(name).to(param.device)
+
+            mean = acc.float() / num_batches
+            del acc
+            scores[name] = score_fn(param.data, mean).to(out_device)
+            del mean
+        return scores
@@ -0,0 +1,122 @@
+"""
+Storage of the layer Hessians ``2 / n * sum(X X^T)`` of SparseGPT-style pruning.
+
+Compared to one dense float32 matrix per linear allocated when the block
+starts, ``HessianStore``
+
+    * allocates the Hessian of a linear on its first batch,
+    * shares one Hessian between linears that read the same input tensor
+      (q/k/v, T5 ``wi_0``/``wi_1``, LLaMA ``gate_proj``/``up_proj``),
+    * keeps the Hessian in ``dtype`` (e.g. bfloat16) and only converts it to
+      float32 when a linear asks for it,
+    * optionally moves the finished Hessians to host memory, so that during
+      pruning only the Hessians being worked on live on the device.
+"""
+
+import math
+import threading
+
+import torch
+
+from lavis.compression.pruners.grad_accumulator import ACCUMULATOR_DTYPES
+from lavis.compression.pruners.shared_inputs import SharedInputs
+
+
+class HessianStore:
+    """
+    Args:
+        dtype: storage dtype, a ``torch.dtype`` or a key of ``ACCUMULATOR_DTYPES``.
+            float16 is refused, squared outlier activations overflow it.
+        offload (bool): move the Hessians to host memory once collected.
+    """
+
+    def __init__(self, dtype=torch.float32, offload=False, shared=None):
+        if isinstance(dtype, str):
+            dtype = ACCUMULATOR_DTYPES[dtype]
+        assert dtype in [torch.float32, torch.bfloat16], f"Unsupported Hessian dtype {dtype}"
+        self.dtype = dtype
+        self.offload = offload
+        # owners of the inputs, possibly shared with the other statistics of the block
+        self.shared = shared if shared is not None else SharedInputs()
+
+        self.members = {}     # owner -> linears sharing its Hessian that have not fetched it
+        self.sums = {}        # owner -> running Hessian 2 / n * sum(X X^T)
+        self.nsamples = {}    # owner -> number of samples
+        self.devices = {}     # owner -> device of the linear
+        self._lock = threading.Lock()
+
+    def is_owner(self, name, inp):
+        """
+        Register the input of linear ``name`` seen by its forward hook.
+
+        Returns whether ``name`` accumulates this input, ``False`` if an
+        earlier linear got the very same tensor and accumulates it for both.
+        """
+        return self.shared.is_owner(name, inp)
+
+    def _owner(self, name):
+        return self.shared.owner.get(name, name)
+
+    @torch.no_grad()
+    def add_batch(self, name, layer, inp):
+        """
+        Fold one batch of inputs of ``layer``, owned by ``name``, into its
+        Hessian. As in the original SparseGPT the Hessian is kept as a scaled
+        running mean computed in float32, so that a reduced precision ``dtype``
+        only rounds values of the magnitude of the final Hessian.
+        """
+        if len(inp.shape) == 2:
+            inp = inp.unsqueeze(0)
+        tmp = inp.shape[0]
+        inp = inp.reshape((-1, inp.shape[-1])).float()
+
+        if name not in self.sums:
+            columns = inp.shape[-1]
+            self.sums[name] = torch.zeros((columns, columns), dtype=self.dtype, device=inp.device)
+            self.nsamples[name] = 0
+            self.devices[name] = layer.weight.device
+
+        acc = self.sums[name]
+        acc *= self.nsamples[name] / (self.nsamples[name] + tmp)
+        self.nsamples[name] += tmp
+        inp = math.sqrt(2 / self.nsamples[name]) * inp
+        acc += inp.t().matmul(inp).to(acc.dtype)
+
+    def num_samples(self, name):
+        return self.nsamples.get(self._owner(name), 0)
+
+    def finish(self):
+        """Collection is over: drop the first batch inputs and offload the Hessians."""
+        self.shared.finish()
+        self.members = {owner: [owner] for owner in self.sums}
+        for name, owner in self.shared.owner.items():
+            if name != owner and owner in self.members:
+                self.members[owner].append(name)
+        if self.offload:
+            for k, v in self.sums.items():
+                self.sums[k] = v.to("cpu", non_blocking=True)
+
+    def get(self, name):
+        """
+        The float32 Hessian of linear ``name``, on its device and owned by the
+        caller (it may be modified in place). The stored Hessian is freed once
+        every linear sharing it has fetched it.
+        """
+        owner = self._owner(name)
+        device = self.devices[owner]
+        H = self.sums[owner].to(device=device, dtype=torch.float32, copy=True)
+
+        with self._lock:
+            members = self.members.get(owner, [name])
+            members.remove(name)
+            if len(members) == 0:
+                del self.sums[owner]
+        return H
+
+    def num_bytes(self):
+        return sum(v.numel() * v.element_size() for v in self.sums.values())
+
+    def clear(self):
+        self.shared = SharedInputs()
+        self.members, self.sums = {}, {}
+        self.nsamples, self.devices = {}, {}
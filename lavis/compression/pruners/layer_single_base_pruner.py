@@ -2,9 +2,17 @@ import torch
 import numpy as np
 
 from lavis.compression.pruners.utils import (
-    loss_vision_language, loss_language, loss_vision, print_time
+    loss_vision_language, loss_language, loss_vision, print_time, global_threshold_mask, kth_smallest, set_mask, invalidate_weight_cache
 )
 from lavis.compression.pruners.base_pruner import BasePruner
+from lavis.compression.pruners.calibration import ActivationStore
+from lavis.compression.pruners.grad_accumulator import GradientAccumulator
+from lavis.compression.pruners.hessian import HessianStore
+from lavis.compression.pruners.score_cache import (
+    ScoreCache, MemoryScoreCache, apply_masks, collect_masks, dict_fingerprint
+)
+from lavis.compression.pruners.sparsity_allocation import allocate_group_sparsity
+from lavis.compression.pruners.zeroth_order import ZerothOrderEngine, batch_size, per_tensor_mezo_scores
 
 
 class LayerWiseBasePruner(BasePruner):
@@ -29,6 +37,19 @@ class LayerWiseBasePruner(BasePruner):
         prune_per_model=False,
         prune_n=0, 
         prune_m=0,
+        calibration_batch_size=32,
+        fused_propagate=False,
+        activation_offload="device",
+        activation_offload_dir=None,
+        pack_masks=False,
+        grad_accum_dtype="float32",
+        shard_grad_accum=False,
+        zo_max_replicas=16,
+        prune_workers=1,
+        sparsegpt_blocksize=128,
+        sparsegpt_sub_blocksize=32,
+        hessian_dtype="float32",
+        hessian_offload=False,
         **kwargs,
     ):
         super().__init__(
@@ -53,6 +74,28 @@ class LayerWiseBasePruner(BasePruner):
         self.prune_spec = prune_spec
         self.model_prefix = model_prefix
         self.prune_n, self.prune_m = prune_n, prune_m
+        self.calibration_batch_size = calibration_batch_size
+        self.fused_propagate = fused_propagate
+        self.activation_store = ActivationStore(activation_offload, activation_offload_dir)
+        self.pack_masks = pack_masks
+        self.grad_accum_dtype = grad_accum_dtype
+        self.shard_grad_accum = shard_grad_accum
+        self.zo_max_replicas = zo_max_replicas
+        self.prune_workers = prune_workers
+        self.sparsegpt_blocksize = sparsegpt_blocksize
+        self.sparsegpt_sub_blocksize = sparsegpt_sub_blocksize
+        self.hessian_dtype = hessian_dtype
+        self.hessian_offload = hessian_offload
+
+        # importance_scores_cache / keep_indices_or_masks_cache are cache folders,
+        # see score_cache.py
+        self.score_cache = ScoreCache(importance_scores_cache, model, data_loader) \
+            if importance_scores_cache else None
+        if keep_indices_or_masks_cache and keep_indices_or_masks_cache == importance_scores_cache:
+            self.mask_cache = self.score_cache
+        else:
+            self.mask_cache = ScoreCache(keep_indices_or_masks_cache, model, data_loader) \
+                if keep_indices_or_masks_cache else None
 
         self.model_stem = getattr(self.model, model_prefix, None) # self.model.t5_model, self.model.visual, etc
         
@@ -93,6 +136,8 @@ class LayerWiseBasePruner(BasePruner):
 
         for n, p in model.named_parameters():
             p.data = p.data.type(dtype_record[n])
+        for m in model.modules():
+            invalidate_weight_cache(m)
             
         model.to(device)
             
@@ -107,6 +152,100 @@ class LayerWiseBasePruner(BasePruner):
     def create_pruned_arch(self, *args, **kwargs):
         return NotImplementedError
 
+    def mask_cache_fields(self, sparsity_dict, lora_model):
+        # everything besides the model and the calibration data the masks depend on
+        return dict(
+            pruner=self.pruner_name,
+            t5_prune_spec=getattr(self, "t5_prune_spec", None),
+            vit_prune_spec=getattr(self, "vit_prune_spec", None),
+            prune_spec=self.prune_spec,
+            sparsity=dict_fingerprint(sparsity_dict),
+            prune_n=self.prune_n,
+            prune_m=self.prune_m,
+            lora_model=lora_model,
+        )
+
+    def load_cached_masks(self, sparsity_dict, lora_model):
+        """Apply the cached masks of an earlier identical run, returns whether there were any."""
+        if self.mask_cache is None:
+            return False
+        masks = self.mask_cache.load(
+            "masks", self.num_samples, **self.mask_cache_fields(sparsity_dict, lora_model)
+        )
+        if masks is None:
+            return False
+        apply_masks(
+            self.model, masks, pack=self.pack_masks, prune_n=self.prune_n, prune_m=self.prune_m,
+            zero_weights=not lora_model,
+        )
+        return True
+
+    def save_masks(self, prefixes, sparsity_dict, lora_model):
+        if self.mask_cache is None:
+            return
+        self.mask_cache.save(
+            collect_masks(self.model, prefixes),
+            "masks", self.num_samples, **self.mask_cache_fields(sparsity_dict, lora_model),
+        )
+
+    def hessian_store(self, shared=None):
+        # Hessians of the linears of one block, see hessian.py
+        return HessianStore(self.hessian_dtype, self.hessian_offload, shared)
+
+    def enable_sweep_score_cache(self):
+        # the levels of a sweep score the model once
+        if self.score_cache is None:
+            self.score_cache = MemoryScoreCache()
+
+    def reset_masks(self):
+        # keep everything again
+        for module in self.model.modules():
+            mask = getattr(module, "mask", None)
+            if torch.is_tensor(mask) and mask.shape == getattr(module, "weight", mask).shape:
+                set_mask(module, torch.ones_like(mask))
+
+    @print_time
+    def prune_sweep(self, sparsities, save_fn, lora_model=False):
+        """
+        Prune the model for every target sparsity in ``sparsities``.
+
+        ``save_fn(sparsity, model, sparsity_dict)`` is called with the model
+        pruned at each level, in order, and the model is left unpruned. This
+        generic version reruns ``prune`` per level on the original weights
+        (kept on the host in between) and only shares the importance scores
+        of the sparsity allocation; pruners whose statistics do not depend on
+        the masks override it.
+        """
+        self.enable_sweep_score_cache()
+        spec_attrs = [a for a in ["prune_spec", "t5_prune_spec", "vit_prune_spec"] if getattr(self, a, None) is not None]
+        specs = {a: getattr(self, a) for a in spec_attrs}
+
+        with torch.no_grad():
+            original_weights = {
+                k: v.detach().cpu().clone() for k, v in self.model.named_parameters()
+                if v.dim() == 2 and "lora_" not in k
+            }
+
+        for sparsity in sparsities:
+            print(f"sweep level {sparsity}")
+            for a, spec in specs.items():
+                num_layers, res_keep_ratio, attn_keep_ratio, ffn_keep_ratio = self.convert_spec_to_list(spec)
+                if res_keep_ratio < 1.:
+                    setattr(self, a, f"{num_layers}-{1 - sparsity}-{attn_keep_ratio}-{ffn_keep_ratio}")
+
+            _, sparsity_dict = self.prune(lora_model=lora_model)
+            save_fn(sparsity, self.model, sparsity_dict if isinstance(sparsity_dict, dict) else None)
+
+            with torch.no_grad():
+                for k, v in self.model.named_parameters():
+                    if k in original_weights:
+                        v.data.copy_(original_weights[k].to(v.device))
+            self.reset_masks()
+
+        for a, spec in specs.items():
+            setattr(self, a, spec)
+        return self.model
+
 
 class LayerSparsity:
     def __init__(
@@ -124,6 +263,10 @@ class LayerSparsity:
             prune_per_model=False,
             per_model_group=["t5_model", "visual"],
             per_model_sparsity=[],
+            grad_accum_dtype="float32",
+            shard_grad_accum=False,
+            zo_max_replicas=16,
+            score_cache=None,
         ):
         self.importance_measure = {}
         self.model = model
@@ -136,6 +279,10 @@ class LayerSparsity:
         self.num_noise = num_noise
         self.noise_eps = noise_eps
         self.prune_per_model = prune_per_model
+        self.grad_accum_dtype = grad_accum_dtype
+        self.shard_grad_accum = shard_grad_accum
+        self.zo_max_replicas = zo_max_replicas
+        self.score_cache = score_cache
         
         self.score_method = score_method
         self.per_model_group = per_model_group
@@ -148,31 +295,10 @@ class LayerSparsity:
         
     def get_mask(self, importance_scores, p, max_sparsity_per_layer):
         # Set top (1 - max_sparsity)% of parameters to be very large value to avoid 
-        # them being pruned
-        
-        for k, v in importance_scores.items():
-            num_to_set = int(importance_scores[k].numel() * (1 - max_sparsity_per_layer))
-            
-            if num_to_set > 0:
-                threshold, _ = torch.topk(importance_scores[k].flatten(), num_to_set, largest=True)
-                threshold = threshold[-1] # take the last value
-
-                importance_scores[k][torch.where(v >= threshold)] = torch.finfo(v.dtype).max
-        
-        # Flatten all tensors and concatenate them
-        all_scores = torch.cat([t.flatten() for t in importance_scores.values()])
-        
-        # Sort and find the threshold
-        num_to_zero_out = int(p * all_scores.numel())
-        threshold, _ = torch.topk(all_scores, num_to_zero_out, largest=False)
-        threshold = threshold[-1]
-        
-        # Create mask based on threshold
-        masks = {}
-        for k, v in importance_scores.items():
-            masks[k] = (v > threshold).type(v.dtype)
-        
-        return masks
+        # them being pruned, then find the global threshold by streaming over the
+        # scores instead of concatenating them
+        device = "cuda" if torch.cuda.is_available() else None
+        return global_threshold_mask(importance_scores, p, max_sparsity_per_layer, device=device)
     
     def get_layerwise_mask(self, importance_scores, p):
         # Set top (1 - max_sparsity)% of parameters to be very large value to avoid 
@@ -180,10 +306,11 @@ class LayerSparsity:
         
         masks = {}
         for k, v in importance_scores.items():
-            all_scores = importance_scores[k].flatten().cuda()
-            num_to_zero_out = int(p * all_scores.numel())
-            threshold, _ = torch.topk(all_scores, num_to_zero_out, largest=False)
-            threshold = threshold[-1].cpu()
+            num_to_zero_out = int(p * v.numel())
+            if num_to_zero_out == 0:
+                masks[k] = torch.ones_like(v)
+                continue
+            threshold = kth_smallest([v], num_to_zero_out, device="cuda")
 
             masks[k] = (v > threshold).type(v.dtype)
 
@@ -234,6 +361,8 @@ class LayerSparsity:
             # the batch size might not be 1, and the loss is already normalized by 
             # batch size, now when only have to normalize it by num_batches now
             p.data = weight_copy[k].to(p.device)
+        for m in self.model.modules():
+            invalidate_weight_cache(m)
         
         return sparsity_dict
     
@@ -244,9 +373,16 @@ class LayerSparsity:
         print(f"layer_to_group_mapping: {layer_to_group_mapping}")
 
         if self.score_compute.startswith("real"):
-            return self.global_iterative_pruning(
+            cached = self.load_cached("sparsity", **self.sparsity_cache_fields(original_sparsity))
+            if cached is not None:
+                return cached["layer_sparsity"]
+            layer_sparsity = self.global_iterative_pruning(
                 original_sparsity, layer_to_group_mapping, iteratation=3, max_sparsity_per_layer=1.0
             )
+            self.save_cached(
+                {"layer_sparsity": layer_sparsity}, "sparsity", **self.sparsity_cache_fields(original_sparsity)
+            )
+            return layer_sparsity
 
         if layer_to_group_mapping is None or len(layer_to_group_mapping) == 0:
             class uniform_sparsity_module:
@@ -254,7 +390,17 @@ class LayerSparsity:
                     return original_sparsity
             return uniform_sparsity_module()
 
+        cached = self.load_cached("sparsity", **self.sparsity_cache_fields(original_sparsity))
+        if cached is not None:
+            if "group_scores" in cached:
+                self.group_scores = cached["group_scores"]
+                self.group_num_parameters = cached["group_num_parameters"]
+            return cached["layer_sparsity"]
+
         # compute the global information
+        if len(self.importance_measure) == 0:
+            self.importance_measure = self.load_cached("scores", **self.score_cache_fields()) or {}
+
         if len(self.importance_measure) == 0:
             if self.score_compute.startswith("mezo"):
                 self.importance_measure = self.compute_importance_scores_mezo_diff(layer_to_group_mapping) # update
@@ -264,6 +410,10 @@ class LayerSparsity:
                 self.importance_measure = self.compute_importance_scores_mezo_layer_one(layer_to_group_mapping) # zeroth-order
             else:
                 self.importance_measure = self.compute_importance_scores(layer_to_group_mapping) # first-order
+            # the allocation only needs the total score of every layer
+            self.save_cached(
+                {k: v.sum() for k, v in self.importance_measure.items()}, "scores", **self.score_cache_fields()
+            )
 
         # create the layer list that for each group
         group_to_layer_mapping = {}
@@ -302,102 +452,18 @@ class LayerSparsity:
             
             group_num_parameters[group_name] = num_params
             
-        def compute_the_sparsity_per_group(total_parameters_to_keep, group_scores, group_num_parameters, max_sparsity_per_layer=0.8):
-            scores = torch.FloatTensor(list(group_scores.values()))
-            num_parameters = torch.LongTensor(list(group_num_parameters.values()))
-            
-            parameters_to_keep_per_group = torch.zeros_like(scores, dtype=int)
-            
-            parameters_to_keep_per_group += torch.ceil(num_parameters * (1 - max_sparsity_per_layer)).int() # to gaurantee the max_sparsity
-            
-            while parameters_to_keep_per_group.sum() < total_parameters_to_keep:
-                total_ratio = torch.sum(scores)
-                
-                rest_total_parameters_to_keep = total_parameters_to_keep - parameters_to_keep_per_group.sum()
-                
-                parameters_to_add = torch.ceil((scores / total_ratio) * rest_total_parameters_to_keep)
-                
-                parameters_to_keep_per_group = parameters_to_keep_per_group + parameters_to_add
-                
-                scores[parameters_to_keep_per_group >= num_parameters] = 0 # make sure they are not going to add more parameters
-                
-                parameters_to_keep_per_group = torch.clamp(parameters_to_keep_per_group, max=num_parameters) # remove the extra parameters
-
-                # the following codes are optional
-                # they are to make sure the sum of parameters_to_keep_per_group is EXACTLY the same as total_parameters_to_keep
-                if parameters_to_add.sum() == 0: # for some reason the algo cannot add more parameters
-                    # the algo stuck
-                    current_sum = parameters_to_keep_per_group.sum()
-                    if current_sum < total_parameters_to_keep:
-                        num_need_to_add = total_parameters_to_keep - current_sum
-                        
-                        while num_need_to_add > 0:
-                            # distributed the parameters to the rest of groups
-                            for index in torch.where(scores > 0)[0]:
-                                parameters_can_add = min(
-                                    num_need_to_add, num_parameters[index] - parameters_to_keep_per_group[index]
-                                )
-                                parameters_to_keep_per_group[index] += parameters_can_add
-                                
-                                num_need_to_add -= parameters_can_add
-                                
-                                if num_need_to_add == 0:
-                                    break
-                                
-                if parameters_to_keep_per_group.sum() > total_parameters_to_keep: # for some reason the algo cannot add more parameters
-                    # the algo stuck
-                    current_sum = parameters_to_keep_per_group.sum()
-
-                    num_need_to_remove = current_sum - total_parameters_to_keep
-                    
-                    while num_need_to_remove > 0:
-                        # remove the parameters from full groups
-                        for index in torch.argsort(parameters_to_keep_per_group, descending=True, stable=True):
-                            parameters_can_remove = min(
-                                num_need_to_remove, 
-                                parameters_to_keep_per_group[index] - (num_parameters[index] * (1 - max_sparsity_per_layer)).int() # extra parameters
-                            )
-                            parameters_to_keep_per_group[index] += parameters_can_remove
-                            
-                            num_need_to_remove -= parameters_can_remove
-                            
-                            if num_need_to_remove == 0:
-                                break
-                            
-                ############################### Optional codes end here
-            
-            # convert the group parameters to keep to sparsity    
-            group_sparsity = {}
-            
-            for k, param_to_keep, group_max_param in zip(group_num_parameters.keys(), parameters_to_keep_per_group, num_parameters):
-                group_sparsity[k] = torch.clamp(1 - param_to_keep / group_max_param, min=0, max=1).item()
-                
-            return group_sparsity
-        
-        if self.prune_per_model:
-            group_sparsity = {}
-            for i in range(len(self.per_model_group)):
-                submodel_prefix = self.per_model_group[i]
-                sparsity = self.per_model_sparsity[i]
-                print(submodel_prefix)
-                submodel_group_scores = {k: v for k, v in group_scores.items() if k.startswith(submodel_prefix)}
-                submodel_group_num_parameters = {k: v for k, v in group_num_parameters.items() if k.startswith(submodel_prefix)}
-                
-                submodel_total_parameters_to_keep = int(sum(list(submodel_group_num_parameters.values())) * (1 - sparsity))
-                submodel_group_sparsity = compute_the_sparsity_per_group(
-                    submodel_total_parameters_to_keep, 
-                    submodel_group_scores, 
-                    submodel_group_num_parameters, 
-                    max_sparsity_per_layer=self.max_sparsity_per_layer,
-                )
-                group_sparsity.update(submodel_group_sparsity)
-        else:
-            group_sparsity = compute_the_sparsity_per_group(
-                total_parameters_to_keep, 
-                group_scores, 
-                group_num_parameters, 
-                max_sparsity_per_layer=self.max_sparsity_per_layer,
-            )
+        # kept for sparsity_for, which reallocates without recomputing the scores
+        self.group_scores = group_scores
+        self.group_num_parameters = group_num_parameters
+
+        group_sparsity = allocate_group_sparsity(
+            group_scores,
+            group_num_parameters,
+            original_sparsity,
+            max_sparsity_per_layer=self.max_sparsity_per_layer,
+            per_model_group=self.per_model_group if self.prune_per_model else None,
+            per_model_sparsity=self.per_model_sparsity,
+        )
         
         compute_total_keep_parameters = 0
         for k in group_num_parameters:
@@ -417,8 +483,59 @@ class LayerSparsity:
             for k, v in layer_to_group_mapping.items()
         }
         print(f"layer_sparsity: {layer_sparsity}")
+        self.save_cached(
+            {
+                "layer_sparsity": layer_sparsity,
+                "group_scores": group_scores,
+                "group_num_parameters": group_num_parameters,
+            },
+            "sparsity", **self.sparsity_cache_fields(original_sparsity),
+        )
         return layer_sparsity
 
+    def score_cache_fields(self):
+        return dict(
+            score_method=self.score_method,
+            groups=dict_fingerprint(self.layer_to_group_mapping),
+            num_noise=self.num_noise,
+            noise_eps=self.noise_eps,
+        )
+
+    def sparsity_cache_fields(self, sparsity):
+        return dict(
+            self.score_cache_fields(),
+            sparsity=sparsity,
+            max_sparsity_per_layer=self.max_sparsity_per_layer,
+            prune_per_model=self.prune_per_model,
+            per_model_sparsity=self.per_model_sparsity if self.prune_per_model else None,
+        )
+
+    def load_cached(self, kind, **fields):
+        if self.score_cache is None:
+            return None
+        return self.score_cache.load(kind, self.num_samples, **fields)
+
+    def save_cached(self, value, kind, **fields):
+        if self.score_cache is not None:
+            self.score_cache.save(value, kind, self.num_samples, **fields)
+
+    def sparsity_for(self, sparsity, per_model_sparsity=None):
+        """
+        Layer sparsities for another target ``sparsity`` (or per-model targets
+        with ``prune_per_model``), reusing the group scores of the last
+        ``return_sparsity`` call.
+        """
+        assert hasattr(self, "group_scores"), "call return_sparsity first"
+        group_sparsity = allocate_group_sparsity(
+            self.group_scores,
+            self.group_num_parameters,
+            sparsity,
+            max_sparsity_per_layer=self.max_sparsity_per_layer,
+            per_model_group=self.per_model_group if self.prune_per_model else None,
+            per_model_sparsity=per_model_sparsity if per_model_sparsity is not None else self.per_model_sparsity,
+        )
+        return {k: group_sparsity[v] for k, v in self.layer_to_group_mapping.items()}
+
     @print_time
     def compute_importance_scores(self, layer_to_group_mapping):
         model = self.model
@@ -432,12 +549,15 @@ class LayerSparsity:
                 names.append(k)
                 params.append(v)
             
-        gradients_dict = {k: 0 for k in names}
+        # running sums stay on device, only the final scores are copied to the host
+        gradients = GradientAccumulator(
+            names, params, square=self.score_compute == "obd",
+            dtype=self.grad_accum_dtype, shard=self.shard_grad_accum,
+        )
         
         device = next(iter(model.parameters())).device
 
         accum_samples = 0
-        current_batch_index = 0
         
         for d in data_loader:
             # print(accum_samples)
@@ -447,121 +567,87 @@ class LayerSparsity:
             loss, batch_len = loss_func(model, d, device != "cpu")
 
             accum_samples += batch_len
-            current_batch_index += 1
 
             grads = torch.autograd.grad(loss, params)
             
             assert len(grads) == len(names) == len(params)
 
-            for k, v in zip(names, grads):
-                
-                if self.score_compute == "obd":
-                    gradients_dict[k] += v.cpu().data.float() ** 2
-                else:
-                    gradients_dict[k] += v.cpu().data.float().abs()
+            gradients.add(grads)
+            del grads
 
-        for k in names:
-            # use current_batch_index rather than self.num_samples because sometimes
-            # the batch size might not be 1, and the loss is already normalized by 
-            # batch size, now when only have to normalize it by num_batches now
-            gradients_dict[k] /= current_batch_index
-        
+        # the accumulated sums are normalized by the number of batches rather than
+        # self.num_samples because the batch size might not be 1, and the loss is
+        # already normalized by batch size
         if "obd" in self.score_compute:
             # using square of magnitude multiplied by diagonal fisher as importance scores
-            importance_measure = {k: (v.cpu().data.float() ** 2) * gradients_dict[k] for k, v in zip(names, params)}        # fisher information. 
+            importance_measure = gradients.importance(lambda w, g: (w.float() ** 2) * g)        # fisher information. 
         elif "aobd" in self.score_compute:
-            importance_measure = {k: (v.cpu().data.float().abs()) * gradients_dict[k].abs() for k, v in zip(names, params)} # first order. 
+            importance_measure = gradients.importance(lambda w, g: w.float().abs() * g.abs()) # first order. 
             print(f"importance_measure: {importance_measure}")
         elif "gradient" in self.score_compute:
-            importance_measure = {k: gradients_dict[k].abs() for k, v in zip(names, params)}
+            importance_measure = gradients.importance(lambda w, g: g.abs())
         
         return importance_measure
     
-    def zo_perturb_parameters(self, params, random_seed=1, scaling_factor=1, zo_eps=1e-3):
-        """
-        Perturb the parameters with random vector z.
-        Input: 
-        - random_seed: random seed for MeZO in-place perturbation (if it's None, we will use self.zo_random_seed)
-        - scaling_factor: theta = theta + scaling_factor * z * eps
-        """
-
-        # Set the random seed to ensure that we sample the same z for perturbation/update
-        torch.manual_seed(random_seed)
-        
-        for param in params:
-            z = torch.normal(mean=0, std=1, size=param.data.size(), device=param.data.device, dtype=param.data.dtype)
-            param.data = param.data + scaling_factor * z * zo_eps
+    def zo_engine(self, names, params, zo_eps):
+        device = next(iter(self.model.parameters())).device
+        return ZerothOrderEngine(
+            self.model, names, params, self.loss_func, eps=zo_eps,
+            max_replicas=self.zo_max_replicas, cuda_enabled=device != "cpu",
+        )
     
     def compute_importance_scores_mezo_diff(self, layer_to_group_mapping):
         model = self.model
         data_loader = self.data_loader
-        loss_func = self.loss_func
         
         model.eval()
 
         names = []
         params = []
-        weight_copy = {}
         total_parameters = 0
         for k, v in model.named_parameters():  
             if k in layer_to_group_mapping:
                 names.append(k)
                 params.append(v)
-                weight_copy[k] = torch.clone(v).cpu()
                 total_parameters += v.numel()
                 
-        gradients_dict = {k: 0 for k in names}
-        
-        device = next(iter(model.parameters())).device
-
-        accum_samples = 0
-        current_batch_index = 0
+        gradients_dict = {}
         
         zo_eps = self.noise_eps
         
         learning_rate = 1 / total_parameters * 1e-3
         
+        engine = self.zo_engine(names, params, zo_eps)
+        
+        # one joint direction per batch, all tensors perturbed together. The
+        # MeZO-SGD update of the weights is never applied, it is replayed per
+        # tensor from the seeds at the end.
+        seeds, projected_grads = [], []
+        accum_samples = 0
+        
         for d in data_loader:
             
             if accum_samples >= self.num_samples:
                 break
             
             print(accum_samples)
-            if accum_samples >= self.num_samples:
-                break
             
             zo_random_seed = np.random.randint(1000000000)
             
-            self.zo_perturb_parameters(params, random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
-            with torch.no_grad():
-                loss1, batch_len = loss_func(model, d, device != "cpu")
-            
-            self.zo_perturb_parameters(params, random_seed=zo_random_seed, scaling_factor=-2, zo_eps=zo_eps)
-            with torch.no_grad():
-                loss2, batch_len = loss_func(model, d, device != "cpu")
-        
-            # recover the weight
-            self.zo_perturb_parameters(params, random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
+            projected_grads.append(engine.joint_directional_derivative(d, zo_random_seed))
+            seeds.append(zo_random_seed)
 
-            accum_samples += batch_len
-            current_batch_index += 1
+            accum_samples += batch_size(d)
             
-            projected_grad = ((loss1 - loss2) / (2 * zo_eps)).item()
+        current_batch_index = len(seeds)
 
-            torch.manual_seed(zo_random_seed)
-            for k, param in zip(names, params):
-                z = torch.normal(mean=0, std=1, size=param.data.size(), device=param.data.device, dtype=param.data.dtype)
-                param.data = param.data - projected_grad * z * learning_rate
-
-        for k, p in zip(names, params):
+        for i, k in enumerate(names):
             # use current_batch_index rather than self.num_samples because sometimes
             # the batch size might not be 1, and the loss is already normalized by 
             # batch size, now when only have to normalize it by num_batches now
-            gradients_dict[k] = (p.data.cpu() - weight_copy[k]).float().abs() / current_batch_index
-            
-            p.data = weight_copy[k].to(p.device)
-            
-            del weight_copy[k]
+            update = engine.replay(i, seeds, [-learning_rate * g for g in projected_grads])
+            gradients_dict[k] = (update.abs() / current_batch_index).cpu()
+            del update
             
         # using square of magnitude multiplied by diagonal fisher as importance scores
 
@@ -576,8 +662,6 @@ class LayerSparsity:
     
     def compute_importance_scores_mezo_layer(self, layer_to_group_mapping):
         model = self.model
-        data_loader = self.data_loader
-        loss_func = self.loss_func
         
         names = []
         params = []
@@ -587,61 +671,16 @@ class LayerSparsity:
                 names.append(k)
                 params.append(v)
         
-        gradients_dict = {k: 0 for k in names}
-        
-        device = next(iter(model.parameters())).device
-
-        accum_samples = 0
-        current_batch_index = 0
-        
         zo_eps = self.noise_eps
         
         n_mezo = 4
         
         self.num_samples = 8
         
-        for i, (name, param) in enumerate(zip(names, params)):
-            print(i, name)
-            accum_samples = 0
-            current_batch_index = 0
-            
-            for d in data_loader:
-                if accum_samples >= self.num_samples:
-                    break
-                
-                per_gradients_dict = {name: 0}
-                
-                for _ in range(n_mezo):
-                    
-                    if accum_samples >= self.num_samples:
-                        break
-                    
-                    zo_random_seed = np.random.randint(1000000000) # TODO fix the seed
-                    
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
-                    with torch.no_grad():
-                        loss1, batch_len = loss_func(model, d, device != "cpu")
-                    
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=-2, zo_eps=zo_eps)
-                    with torch.no_grad():
-                        loss2, batch_len = loss_func(model, d, device != "cpu")
-                
-                    # recover the weight
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
-
-                    accum_samples += batch_len
-                    current_batch_index += 1
-                    
-                    projected_grad = ((loss1 - loss2) / (2 * zo_eps)).item()
-                    
-                    # print(zo_random_seed, loss1, loss2, projected_grad)
-
-                    # gradients_dict = self.zo_gradients(gradients_dict, names, params, projected_grad, random_seed=zo_random_seed)
-                    
-                    torch.manual_seed(zo_random_seed)
-                    per_gradients_dict[name] += projected_grad
-                        
-                gradients_dict[name] += torch.FloatTensor([per_gradients_dict[name]]).abs()
+        # per batch, the projected gradients of the directions are summed before taking the abs
+        engine = self.zo_engine(names, params, zo_eps)
+        scores = per_tensor_mezo_scores(engine, self.data_loader, self.num_samples, n_mezo, sum_before_abs=True)
+        gradients_dict = {k: torch.FloatTensor([score]) for k, score in zip(names, scores)}
                 
         print(gradients_dict)
     
@@ -656,8 +695,6 @@ class LayerSparsity:
     
     def compute_importance_scores_mezo_layer_one(self, layer_to_group_mapping):
         model = self.model
-        data_loader = self.data_loader
-        loss_func = self.loss_func
         
         names = []
         params = []
@@ -667,55 +704,13 @@ class LayerSparsity:
                 names.append(k)
                 params.append(v)
         
-        gradients_dict = {k: 0 for k in names}
-        
-        device = next(iter(model.parameters())).device
-
-        accum_samples = 0
-        current_batch_index = 0
-        
         zo_eps = self.noise_eps
         
         n_mezo = self.num_noise
         
-        for i, (name, param) in enumerate(zip(names, params)):
-            print(i, name)
-            accum_samples = 0
-            current_batch_index = 0
-            
-            for d in data_loader:
-                if accum_samples >= self.num_samples:
-                    break
-                
-                per_gradients_dict = {name: 0}
-                
-                for _ in range(n_mezo):
-                    
-                    if accum_samples >= self.num_samples:
-                        break
-                    
-                    zo_random_seed = np.random.randint(1000000000)
-                    
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
-                    with torch.no_grad():
-                        loss1, batch_len = loss_func(model, d, device != "cpu")
-                    
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=-2, zo_eps=zo_eps)
-                    with torch.no_grad():
-                        loss2, batch_len = loss_func(model, d, device != "cpu")
-                
-                    # recover the weight
-                    self.zo_perturb_parameters([param], random_seed=zo_random_seed, scaling_factor=1, zo_eps=zo_eps)
-
-                    accum_samples += batch_len
-                    current_batch_index += 1
-                    
-                    projected_grad = ((loss1 - loss2) / (2 * zo_eps)).item() # TODO Perturbed - Perturbed, a little strange.  
-                    
-                    torch.manual_seed(zo_random_seed)
-                    per_gradients_dict[name] += abs(projected_grad)
-                        
-                gradients_dict[name] += torch.FloatTensor([per_gradients_dict[name]]).abs()
+        engine = self.zo_engine(names, params, zo_eps)
+        scores = per_tensor_mezo_scores(engine, self.data_loader, self.num_samples, n_mezo)
+        gradients_dict = {k: torch.FloatTensor([score]) for k, score in zip(names, scores)}
                 
         print(gradients_dict)
     
@@ -726,4 +721,4 @@ class LayerSparsity:
         elif self.score_compute == "olmezo-obd":
             importance_measure = {k: v.cpu().data.float() ** 2 * gradients_dict[k] ** 2 for k, v in zip(names, params)}
             
-        return importance_measure
\ No newline at end of file
+        return importance_measure
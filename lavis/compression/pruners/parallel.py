@@ -0,0 +1,73 @@
+"""
+Concurrent pruning of the independent linears of a block.
+
+Once the statistics of a block are collected, pruning q, k, v, o, wi and wo
+are independent problems. ``run_concurrently`` runs them on a thread pool:
+on CPU the workers split the intra-op threads between them, on CUDA every
+worker thread launches its kernels on its own stream so that the small
+column-by-column kernels of different linears overlap. Tasks are started
+largest first, so the block takes about as long as its largest linear once
+enough workers are available.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+_local = threading.local()
+
+
+def _worker_stream(device):
+    # one stream per worker thread and device
+    streams = getattr(_local, "streams", None)
+    if streams is None:
+        streams = _local.streams = {}
+    if device not in streams:
+        streams[device] = torch.cuda.Stream(device=device)
+    return streams[device]
+
+
+def _run(device, fn, num_threads):
+    device = torch.device(device)
+    if device.type != "cuda":
+        torch.set_num_threads(num_threads)
+        return fn()
+
+    stream = _worker_stream(device)
+    # the statistics were produced on the default stream
+    stream.wait_stream(torch.cuda.default_stream(device))
+    with torch.cuda.device(device), torch.cuda.stream(stream):
+        fn()
+    stream.synchronize()
+
+
+def run_concurrently(tasks, max_workers=1):
+    """
+    Run independent pruning tasks, at most ``max_workers`` at a time.
+
+    Args:
+        tasks (list): ``(cost, device, fn)`` triples, ``fn()`` prunes one
+            linear on ``device`` and ``cost`` orders the tasks.
+        max_workers (int): tasks in flight; this bounds how many Hessians
+            (with their factorizations and weight copies) are worked on at
+            once. ``1`` runs the tasks in order on the calling thread.
+    """
+    if max_workers <= 1 or len(tasks) <= 1:
+        for _, _, fn in tasks:
+            fn()
+        return
+
+    tasks = sorted(tasks, key=lambda t: -t[0])
+    num_workers = min(max_workers, len(tasks))
+    num_threads = torch.get_num_threads()
+    worker_threads = max(num_threads // num_workers, 1)
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            futures = [pool.submit(_run, device, fn, worker_threads) for _, device, fn in tasks]
+            for future in futures:
+                future.result()
+    finally:
+        torch.set_num_threads(num_threads)
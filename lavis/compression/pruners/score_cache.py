@@ -0,0 +1,216 @@
+"""
+Content-addressed cache for the pruning stages.
+
+Importance scores (summed per layer, which is all the sparsity allocation
+uses), layer sparsity dicts and masks are stored under
+``<cache_dir>/<kind>/<key>.pth`` where the key hashes everything the entry
+depends on: a fingerprint of the model weights, a fingerprint of the
+calibration samples and the settings of the stage (score method, number of
+samples, grouping, target sparsity, ...). Running the same base model with
+another sparsity or other retraining hyperparameters thus reuses the
+expensive scoring pass, while any change of weights or data misses.
+"""
+
+import hashlib
+import json
+import os
+
+import torch
+
+from lavis.common.dist_utils import is_main_process
+from lavis.compression.pruners.utils import set_mask, zero_pruned_weights
+from lavis.peft.src.peft.tuners.lora import pack_mask, unpack_mask
+
+
+# number of elements of every tensor hashed byte for byte, the rest only
+# enters through its sums
+_SAMPLED_ELEMENTS = 4096
+
+
+def _update_with_tensor(h, t):
+    t = t.detach()
+    h.update(f"{tuple(t.shape)}{t.dtype}".encode())
+    if t.numel() == 0:
+        return
+    flat = t.reshape(-1)
+    if not t.is_floating_point():
+        flat = flat.float()
+    stride = max(flat.numel() // _SAMPLED_ELEMENTS, 1)
+    sample = flat[::stride][:_SAMPLED_ELEMENTS].float().cpu()
+    sums = torch.stack([flat.double().sum(), flat.double().abs().sum()]).cpu()
+    h.update(sample.numpy().tobytes())
+    h.update(sums.numpy().tobytes())
+
+
+@torch.no_grad()
+def model_fingerprint(model, exclude=("lora_",), buffers=False):
+    """
+    Hash of the names, shapes, dtypes and values of the model parameters.
+
+    Every tensor contributes a strided sample of its values and its sum and
+    absolute sum, computed on its device, so the whole model is covered
+    without copying it to the host. LoRA parameters are left out since they
+    are freshly initialized before pruning. With ``buffers`` the buffers
+    (e.g. the pruning masks) are hashed as well.
+    """
+    h = hashlib.sha1()
+    tensors = list(model.named_parameters())
+    if buffers:
+        tensors += list(model.named_buffers())
+    for name, t in tensors:
+        if any(e in name for e in exclude):
+            continue
+        h.update(name.encode())
+        _update_with_tensor(h, t)
+    return h.hexdigest()
+
+
+def _batch_len(batch):
+    for key in ["text_input", "image"]:
+        if key in batch:
+            return len(batch[key])
+    for v in batch.values():
+        if torch.is_tensor(v) or isinstance(v, (list, tuple)):
+            return len(v)
+    return 1
+
+
+def calibration_fingerprint(data_loader, num_samples):
+    """Hash of the first ``num_samples`` samples ``data_loader`` yields."""
+    h = hashlib.sha1()
+    accum_samples = 0
+    for batch in data_loader:
+        if accum_samples >= num_samples:
+            break
+        for k in sorted(batch):
+            h.update(str(k).encode())
+            v = batch[k]
+            if torch.is_tensor(v):
+                h.update(f"{tuple(v.shape)}{v.dtype}".encode())
+                h.update(v.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+            else:
+                h.update(repr(v).encode())
+        accum_samples += _batch_len(batch)
+    h.update(str(accum_samples).encode())
+    return h.hexdigest()
+
+
+def dict_fingerprint(d):
+    """Hash of a (sparsity) dict, ``None`` stays ``None``."""
+    if not isinstance(d, dict):
+        return d
+    return hashlib.sha1(json.dumps(d, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ScoreCache:
+    """
+    Entries of the pruning stages keyed by model, calibration data and settings.
+
+    Args:
+        cache_dir (str): root folder of the cache.
+        model: model whose weights enter every key.
+        data_loader: calibration loader whose samples enter every key.
+    """
+
+    def __init__(self, cache_dir, model, data_loader):
+        self.cache_dir = cache_dir
+        self.model = model
+        self.data_loader = data_loader
+        self._model_hash = None
+        self._calibration_hash = {}
+
+    def model_hash(self):
+        # computed once, before the pruners change any weight
+        if self._model_hash is None:
+            self._model_hash = model_fingerprint(self.model)
+        return self._model_hash
+
+    def calibration_hash(self, num_samples):
+        if num_samples not in self._calibration_hash:
+            self._calibration_hash[num_samples] = calibration_fingerprint(self.data_loader, num_samples)
+        return self._calibration_hash[num_samples]
+
+    def key(self, kind, num_samples, **fields):
+        fields = dict(
+            fields, kind=kind, num_samples=num_samples,
+            model=self.model_hash(), calibration=self.calibration_hash(num_samples),
+        )
+        return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest(), fields
+
+    def path(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key + ".pth")
+
+    def load(self, kind, num_samples, **fields):
+        """Return the cached entry or ``None``."""
+        key, _ = self.key(kind, num_samples, **fields)
+        path = self.path(kind, key)
+        if not os.path.exists(path):
+            print(f"{kind} cache miss: {key}")
+            return None
+        print(f"{kind} cache hit: {path}")
+        return torch.load(path, map_location="cpu")["value"]
+
+    def save(self, value, kind, num_samples, **fields):
+        key, fields = self.key(kind, num_samples, **fields)
+        if not is_main_process():
+            return
+        path = self.path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so that an interrupted run never leaves a partial entry
+        tmp_path = path + f".tmp{os.getpid()}"
+        torch.save({"fields": fields, "value": value}, tmp_path)
+        os.replace(tmp_path, path)
+        print(f"{kind} cached at {path}")
+
+
+class MemoryScoreCache(ScoreCache):
+    """
+    ``ScoreCache`` held in memory for the lifetime of one pruner, so that the
+    levels of a sparsity sweep share their importance scores. The model and
+    the data do not change within a run and are left out of the keys.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def key(self, kind, num_samples, **fields):
+        fields = dict(fields, kind=kind, num_samples=num_samples)
+        return json.dumps(fields, sort_keys=True, default=str), fields
+
+    def load(self, kind, num_samples, **fields):
+        key, _ = self.key(kind, num_samples, **fields)
+        return self.entries.get(key, None)
+
+    def save(self, value, kind, num_samples, **fields):
+        key, _ = self.key(kind, num_samples, **fields)
+        self.entries[key] = value
+
+
+def collect_masks(model, prefixes):
+    """Packed keep-masks of the pruned linears under ``prefixes``."""
+    masks = {}
+    for name, module in model.named_modules():
+        if not name.startswith(tuple(prefixes)):
+            continue
+        if hasattr(module, "_stored_mask"):
+            stored, mask_format = module._stored_mask()
+        else:
+            stored, mask_format = getattr(module, "mask", None), None
+        if not torch.is_tensor(stored):
+            continue
+        if mask_format is None:
+            stored, mask_format = pack_mask(stored.bool())
+        masks[name] = (stored.cpu(), mask_format)
+    return masks
+
+
+@torch.no_grad()
+def apply_masks(model, masks, pack=False, prune_n=0, prune_m=0, zero_weights=False):
+    """Set the masks from ``collect_masks`` on ``model``, see ``utils.set_mask``."""
+    modules = dict(model.named_modules())
+    for name, (packed, mask_format) in masks.items():
+        module = modules[name]
+        mask = unpack_mask(packed.to(module.weight.device), mask_format)
+        set_mask(module, mask, pack, prune_n, prune_m)
+        if zero_weights:
+            zero_pruned_weights(module, ~mask)
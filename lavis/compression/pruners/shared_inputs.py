@@ -0,0 +1,48 @@
+"""
+Detection of the linears of a block that read the same input.
+
+q/k/v (T5 ``wi_0``/``wi_1``, LLaMA ``gate_proj``/``up_proj``) are called on
+the very same tensor, so the statistics their forward hooks collect (input
+norms, sums, variances, Hessians) are identical. ``SharedInputs`` elects one
+owner per distinct input; the other hooks skip their reductions and read the
+owner's statistics once collection is over.
+"""
+
+
+class SharedInputs:
+    def __init__(self):
+        self.owner = {}       # linear name -> name of the linear collecting its input
+        self._inputs = {}     # input signature -> (owner, input) during the first batch
+
+    def owner_of(self, name, inp):
+        """
+        Register the input of linear ``name`` seen by its forward hook and
+        return the linear collecting statistics for it. Every hook must call
+        this once per forward.
+        """
+        if name in self.owner:
+            # a later batch, the sharing is known; the first batch inputs can go
+            self._inputs.clear()
+            return self.owner[name]
+
+        # the inputs are kept referenced during the first batch so that their
+        # memory cannot be reused by another input with the same signature
+        signature = (inp.data_ptr(), tuple(inp.shape), tuple(inp.stride()), inp.dtype)
+        owner, _ = self._inputs.setdefault(signature, (name, inp))
+        self.owner[name] = owner
+        return owner
+
+    def is_owner(self, name, inp):
+        """Whether ``name`` collects the statistics of its input, see ``owner_of``."""
+        return self.owner_of(name, inp) == name
+
+    def finish(self):
+        """Collection is over, drop the first batch inputs."""
+        self._inputs.clear()
+
+    def share(self, stats):
+        """Point the entry of every linear of ``stats`` at the one of its owner."""
+        for name, owner in self.owner.items():
+            if owner != name and name in stats:
+                stats[name] = stats[owner]
+        return stats
@@ -1,5 +1,4 @@
 import torch
-import math
 import torch.nn as nn
 
 from time import time
@@ -9,9 +8,12 @@ import transformers
 
 from lavis.common.registry import registry
 from lavis.compression.pruners.utils import (
-    loss_vision_language, loss_language, loss_vision, print_time
+    loss_vision_language, loss_language, loss_vision, print_time, nm_prune_mask, invalidate_weight_cache
 )
+from lavis.compression.pruners.calibration import CalibrationBatches
 from lavis.compression.pruners.layer_single_base_pruner import LayerWiseBasePruner, LayerSparsity
+from lavis.compression.pruners.hessian import HessianStore
+from lavis.compression.pruners.parallel import run_concurrently
 from lavis.peft.src.peft.tuners.lora import Linear, LoraLayer, Linear8bitLt
 
 
@@ -50,37 +52,90 @@ def find_layers(module, layers=[nn.Linear, Linear, LoraLayer, Linear8bitLt], nam
         ))
     return res
 
+
+def repair_non_finite(H, low=0.001, high=0.999):
+    """
+    Replace NaN entries of ``H`` by 0 and infinite ones by the ``low`` /
+    ``high`` quantiles of the finite entries, in place. A finite ``H`` is
+    only scanned once.
+    """
+    finite = torch.isfinite(H)
+    if bool(finite.all()):
+        return H
+
+    values = H[finite].float()
+    if values.numel() == 0:
+        return H.zero_()
+    lo = torch.kthvalue(values, max(int(low * values.numel()), 1))[0].item()
+    hi = torch.kthvalue(values, max(int(high * values.numel()), 1))[0].item()
+    del values
+    return torch.nan_to_num(H, nan=0.0, posinf=hi, neginf=lo, out=H)
+
+
+def damped_cholesky(H, percdamp=.01, upper=False, max_tries=30):
+    """
+    Cholesky factor of ``H``, modifying ``H`` in place.
+
+    ``H`` is factorized as is first. If that fails, ``percdamp`` times its
+    mean absolute diagonal is added to the diagonal, doubling the added
+    amount on every further failure.
+    """
+    damp = percdamp * torch.mean(torch.diag(H).abs())
+    if not bool(torch.isfinite(damp)) or damp <= 0:
+        damp = torch.ones_like(damp) * percdamp
+    diag = torch.arange(H.shape[0], device=H.device)
+
+    for attempt in range(max_tries):
+        L, info = torch.linalg.cholesky_ex(H, upper=upper)
+        if int(info) == 0 and not bool(torch.isnan(L).any()):
+            return L
+        # not a positive definite matrix
+        H[diag, diag] += damp * 2 ** attempt
+
+    raise RuntimeError(f"Cholesky decomposition failed after {max_tries} damping steps")
+
+
 class SparseGPT:
 
-    def __init__(self, layer):
+    def __init__(self, layer, hessians=None, name=""):
         self.layer = layer
         self.dev = self.layer.weight.device
-        W = layer.weight.data.clone()
+        W = layer.weight.data
         if isinstance(self.layer, nn.Conv2d):
             W = W.flatten(1)
         if isinstance(self.layer, transformers.Conv1D):
             W = W.t()
         self.rows = W.shape[0]
         self.columns = W.shape[1]
-        self.H = torch.zeros((self.columns, self.columns), device=self.dev)
-        self.nsamples = 0
+        # the Hessian lives in the (possibly shared) store, see hessian.py
+        self.hessians = hessians if hessians is not None else HessianStore()
+        self.name = name
+
+    @property
+    def nsamples(self):
+        return self.hessians.num_samples(self.name)
 
     def add_batch(self, inp, out):
-        if len(inp.shape) == 2:
-            inp = inp.unsqueeze(0)
-        tmp = inp.shape[0]
-        if isinstance(self.layer, nn.Linear) or isinstance(self.layer, transformers.Conv1D):
-            if len(inp.shape) == 3:
-                inp = inp.reshape((-1, inp.shape[-1]))
-            inp = inp.t()
-        self.H *= self.nsamples / (self.nsamples + tmp)
-        self.nsamples += tmp
-        inp = math.sqrt(2 / self.nsamples) * inp.float()
-        self.H += inp.matmul(inp.t())
+        # inputs of linears sharing a Hessian are only added by its owner,
+        # see HessianStore.is_owner
+        self.hessians.add_batch(self.name, self.layer, inp)
+
+    def prune_cost(self):
+        # the factorizations are cubic in the columns, the OBS updates scale with rows * columns^2
+        return self.columns ** 2 * (self.rows + self.columns)
 
     def fasterprune(
-        self, sparsity, prune_n=0, prune_m=0, blocksize=128, percdamp=.01
+        self, sparsity, prune_n=0, prune_m=0, blocksize=128, percdamp=.01, sub_blocksize=32
     ):
+        """
+        Prune the layer to ``sparsity`` (or N:M) with the OBS updates of SparseGPT.
+
+        Columns are processed in blocks of ``blocksize``. Inside a block the
+        rank-1 updates of a column only reach the rest of its sub-block of
+        ``sub_blocksize`` columns; every finished sub-block updates the rest
+        of the block with one GEMM and every finished block the remaining
+        columns, which gives the same result with far fewer vector updates.
+        """
         W = self.layer.weight.data.clone()
         if isinstance(self.layer, nn.Conv2d):
             W = W.flatten(1)
@@ -90,80 +145,27 @@ class SparseGPT:
 
         tick = time()
 
-        H = self.H
-        del self.H
+        H = self.hessians.get(self.name)
         dead = torch.diag(H) == 0
         H[dead, dead] = 1
         W[:, dead] = 0
 
         Losses = torch.zeros(self.rows, device=self.dev)
         
-        if (torch.isinf(H) * (H > 0)).float().sum() > 0:
-            # positive inf value
-            pos = torch.isinf(H) * (H > 0)
-            H[pos] = torch.quantile(H, 0.999)
-            
-        if (torch.isinf(H) * (H < 0)).float().sum() > 0:
-            # negative inf value
-            pos = torch.isinf(H) * (H < 0)
-            H[pos] = torch.quantile(H, 0.001)
-            
-        damp = percdamp * torch.mean(torch.diag(H))
-        diag = torch.arange(self.columns, device=self.dev)
-        
-        while True:
-            try:
-                decompose_H = torch.linalg.cholesky(H)
-                
-                if not torch.isnan(decompose_H).any():
-                    H = decompose_H
-                    break
-                
-                if torch.isinf(damp).any():
-                    import pdb; pdb.set_trace()
-                # not a positive semi-definite matrix
-                H[diag, diag] += damp
-            except:
-                # not a positive semi-definite matrix
-                H[diag, diag] += damp
-        # H[diag, diag] += damp
-        # H = torch.linalg.cholesky(H)
+        H = repair_non_finite(H)
+        H = damped_cholesky(H, percdamp)
         H = torch.cholesky_inverse(H)
-        
-        if (torch.isinf(H) * (H > 0)).float().sum() > 0:
-            # positive inf value
-            pos = torch.isinf(H) * (H > 0)
-            H[pos] = torch.quantile(H, 0.999)
-            
-        if (torch.isinf(H) * (H < 0)).float().sum() > 0:
-            # negative inf value
-            pos = torch.isinf(H) * (H < 0)
-            H[pos] = torch.quantile(H, 0.001)
-            
-        damp = percdamp * torch.mean(torch.diag(H).abs())
-        diag = torch.arange(self.columns, device=self.dev)
-        
-        while True:
-            try:
-                decompose_H = torch.linalg.cholesky(H, upper=True)
-                
-                if not torch.isnan(decompose_H).any():
-                    H = decompose_H
-                    break
-                # not a positive semi-definite matrix
-                H[diag, diag] += damp
-            except:
-                # not a positive semi-definite matrix
-                H[diag, diag] += damp
-
-        # H = torch.linalg.cholesky(H, upper=True)
-        Hinv = H
-        
+        H = repair_non_finite(H)
+        Hinv = damped_cholesky(H, percdamp, upper=True)
         
         s = W ** 2 / (torch.diag(Hinv).reshape((1, -1))) ** 2
         
         setattr(self.layer.weight, "importance_score", s.cpu().abs().mean().item())
+        del s
 
+        if prune_n != 0:
+            # an N:M group must not straddle two sub-blocks
+            sub_blocksize = max(sub_blocksize // prune_m, 1) * prune_m
         mask = None
 
         for i1 in range(0, self.columns, blocksize):
@@ -175,44 +177,52 @@ class SparseGPT:
             Err1 = torch.zeros_like(W1)
             Losses1 = torch.zeros_like(W1)
             Hinv1 = Hinv[i1:i2, i1:i2]
+            d1 = torch.diag(Hinv1)
 
             if prune_n == 0: 
                 if mask is not None:
                     mask1 = mask[:, i1:i2]
                 else:
-                    tmp = W1 ** 2 / (torch.diag(Hinv1).reshape((1, -1))) ** 2
+                    tmp = W1 ** 2 / d1.reshape((1, -1)) ** 2
                     thresh = torch.sort(tmp.flatten())[0][int(tmp.numel() * sparsity)]
                     mask1 = tmp <= thresh
             else:
                 mask1 = torch.zeros_like(W1) == 1
 
-            for i in range(count):
-                w = W1[:, i]
-                d = Hinv1[i, i]
+            for j1 in range(0, count, sub_blocksize):
+                j2 = min(j1 + sub_blocksize, count)
+
+                for i in range(j1, j2):
+                    w = W1[:, i]
+                    d = d1[i]
+
+                    if prune_n != 0 and i % prune_m == 0:
+                        tmp = W1[:, i:(i + prune_m)] ** 2 / (d1[i:(i + prune_m)].reshape((1, -1))) ** 2
+                        mask1[:, i:(i + prune_m)] = nm_prune_mask(tmp, prune_n, prune_m)
 
-                if prune_n != 0 and i % prune_m == 0:
-                    tmp = W1[:, i:(i + prune_m)] ** 2 / (torch.diag(Hinv1)[i:(i + prune_m)].reshape((1, -1))) ** 2
-                    mask1.scatter_(1, i + torch.topk(tmp, prune_n, dim=1, largest=False)[1], True)
+                    q = w.masked_fill(mask1[:, i], 0)
 
-                q = w.clone()
-                q[mask1[:, i]] = 0
+                    Q1[:, i] = q
+                    Losses1[:, i] = (w - q) ** 2 / d ** 2
 
-                Q1[:, i] = q
-                Losses1[:, i] = (w - q) ** 2 / d ** 2
+                    err1 = (w - q) / d 
+                    W1[:, i:j2] -= err1.unsqueeze(1).matmul(Hinv1[i, i:j2].unsqueeze(0))
+                    Err1[:, i] = err1
 
-                err1 = (w - q) / d 
-                W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
-                Err1[:, i] = err1
+                # lazy update of the rest of the block
+                W1[:, j2:] -= Err1[:, j1:j2].matmul(Hinv1[j1:j2, j2:])
 
             W[:, i1:i2] = Q1
             Losses += torch.sum(Losses1, 1) / 2
 
             W[:, i2:] -= Err1.matmul(Hinv[i1:i2, i2:])
 
-        torch.cuda.synchronize()
+        if W.is_cuda:
+            torch.cuda.current_stream(W.device).synchronize()
         if isinstance(self.layer, transformers.Conv1D):
             W = W.t()
         self.layer.weight.data = W.reshape(self.layer.weight.shape).to(self.layer.weight.data.dtype)
+        invalidate_weight_cache(self.layer)
 
     def free(self):
         self.H = None
@@ -263,6 +273,7 @@ class T5LayerSparseGPTPruner(LayerWiseBasePruner):
             noise_eps=noise_eps,
             prune_n=prune_n,
             prune_m=prune_m,
+            **kwargs,
         )
         
         self.loss_func = loss_language
@@ -370,18 +381,20 @@ class T5LayerSparseGPTPruner(LayerWiseBasePruner):
                 "attention_mask", "layer_head_mask", 
             ]
             
+        store = self.activation_store
+
         class Catcher(nn.Module):
             def __init__(self, module):
                 super().__init__()
                 self.module = module
             def forward(self, inp, dense=True, **kwargs):
-                inps.append(inp)
+                inps.append(store.offload(inp))
                 inps[-1].requires_grad = False
                 
                 cache = {}
                 for k in keys_to_cache:
                     cache[k] = kwargs[k]
-                caches.append(cache)
+                caches.append(store.offload_cache(cache))
 
                 raise ValueError
 
@@ -412,47 +425,68 @@ class T5LayerSparseGPTPruner(LayerWiseBasePruner):
             inps, outs, caches = self.prepare_calibration_input_encoder(model, dataloader, device, model_prefix, n_samples, module_to_process)
 
         n_samples = min(n_samples, len(inps))
+        calibration = CalibrationBatches(
+            inps[:n_samples], caches[:n_samples], batch_size=self.calibration_batch_size,
+            store=self.activation_store, device=device,
+        )
+        del inps, outs, caches
 
         layers = get_module_recursive(model, module_to_process)
         for i in range(len(layers)):
             layer = layers[i]
             subset = find_layers(layer)
 
+            hessians = self.hessian_store()
             wrapped_layers = {}
             for name in subset:
-                wrapped_layers[name] = SparseGPT(subset[name])
+                wrapped_layers[name] = SparseGPT(subset[name], hessians, name)
 
             def add_batch(name):
                 def tmp(_, inp, out):
-                    wrapped_layers[name].add_batch(inp[0].data, out.data)
+                    if not hessians.is_owner(name, inp[0].data):
+                        return
+                    for inp_j in calibration.split(inp[0].data):
+                        wrapped_layers[name].add_batch(inp_j, out.data)
                 return tmp
 
             handles = []
             for name in wrapped_layers:
                 handles.append(subset[name].register_forward_hook(add_batch(name)))
 
-            for j in range(n_samples):
+            def forward_block(inp, cache):
                 with torch.no_grad():
                     with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])[0]
+                        return layer(inp, **cache)[0]
+
+            calibration.run(forward_block, keep_outputs=False)
+            hessians.finish()
             for h in handles:
                 h.remove()
 
+            def prune_linear(name, sparsity):
+                wrapped_layers[name].fasterprune(
+                    sparsity, prune_n=self.prune_n, prune_m=self.prune_m, percdamp=0.01,
+                    blocksize=self.sparsegpt_blocksize, sub_blocksize=self.sparsegpt_sub_blocksize,
+                )
+                wrapped_layers[name].free()
+
+            # the linears of a block are independent once their Hessians are collected
+            tasks = []
             for name in subset:
-                assert wrapped_layers[name].nsamples == len(inps)
+                assert wrapped_layers[name].nsamples == calibration.nsamples
                 
                 sparsity_key = f"{module_to_process}.{i}.{name}.weight"
                 # print(f"pruning {model_prefix} layer {i} {name} at unstructured {sparsity_ratio[sparsity_key]} sparsity")
-                wrapped_layers[name].fasterprune(sparsity_ratio[sparsity_key], prune_n=self.prune_n, prune_m=self.prune_m, percdamp=0.01, blocksize=128)
+                tasks.append((
+                    wrapped_layers[name].prune_cost(), wrapped_layers[name].dev,
+                    partial(prune_linear, name, sparsity_ratio[sparsity_key]),
+                ))
+            run_concurrently(tasks, max_workers=self.prune_workers)
 
-                wrapped_layers[name].free()
-
-            for j in range(n_samples):
-                with torch.no_grad():
-                    with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])[0]
-            inps, outs = outs, inps
+            calibration.propagate(forward_block)
 
+        del calibration
+        self.activation_store.clear()
         getattr(model, model_prefix).config.use_cache = use_cache 
         torch.cuda.empty_cache()
         
@@ -503,6 +537,10 @@ class T5LayerSparseGPTPruner(LayerWiseBasePruner):
             self.num_noise,
             self.noise_eps,
             layer_to_group_mapping,
+            grad_accum_dtype=self.grad_accum_dtype,
+            shard_grad_accum=self.shard_grad_accum,
+            zo_max_replicas=self.zo_max_replicas,
+            score_cache=self.score_cache,
         )
         
         return sparsity_module.return_sparsity()
@@ -587,6 +625,7 @@ class VITLayerSparseGPTPruner(LayerWiseBasePruner):
             noise_eps=noise_eps,
             prune_n=prune_n,
             prune_m=prune_m,
+            **kwargs,
         )
         
         self.loss_func = loss_vision
@@ -694,17 +733,19 @@ class VITLayerSparseGPTPruner(LayerWiseBasePruner):
             "rel_pos_bias"
         ]
 
+        store = self.activation_store
+
         class Catcher(nn.Module):
             def __init__(self, module):
                 super().__init__()
                 self.module = module
             def forward(self, inp, rel_pos_bias, dense=True):
-                inps.append(inp)
+                inps.append(store.offload(inp))
                 inps[-1].requires_grad = False
                 
                 cache = {}
                 cache["rel_pos_bias"] = rel_pos_bias
-                caches.append(cache)
+                caches.append(store.offload_cache(cache))
                 raise ValueError
 
         layers[0] = Catcher(layers[0])
@@ -729,48 +770,69 @@ class VITLayerSparseGPTPruner(LayerWiseBasePruner):
             inps, outs, caches = self.prepare_calibration_input_encoder(model, dataloader, device, model_prefix, n_samples, module_to_process)
 
         n_samples = min(n_samples, len(inps))
+        calibration = CalibrationBatches(
+            inps[:n_samples], caches[:n_samples], batch_size=self.calibration_batch_size,
+            store=self.activation_store, device=device,
+        )
+        del inps, outs, caches
 
         layers = get_module_recursive(model, module_to_process)
         for i in range(len(layers)):
             layer = layers[i]
             subset = find_layers(layer)
 
+            hessians = self.hessian_store()
             wrapped_layers = {}
             for name in subset:
-                wrapped_layers[name] = SparseGPT(subset[name])
+                wrapped_layers[name] = SparseGPT(subset[name], hessians, name)
 
             def add_batch(name):
                 def tmp(_, inp, out):
-                    wrapped_layers[name].add_batch(inp[0].data, out.data)
+                    if not hessians.is_owner(name, inp[0].data):
+                        return
+                    for inp_j in calibration.split(inp[0].data):
+                        wrapped_layers[name].add_batch(inp_j, out.data)
                 return tmp
 
             handles = []
             for name in wrapped_layers:
                 handles.append(subset[name].register_forward_hook(add_batch(name)))
 
-            for j in range(n_samples):
+            def forward_block(inp, cache):
                 with torch.no_grad():
                     with model.maybe_autocast():
-                        outs[j] = layer(inps[j], **caches[j])
+                        return layer(inp, **cache)
+
+            calibration.run(forward_block, keep_outputs=False)
+            hessians.finish()
 
             for h in handles:
                 h.remove()
 
-            for name in subset:
-                assert wrapped_layers[name].nsamples == len(inps)
+            def prune_linear(name, sparsity):
+                wrapped_layers[name].fasterprune(
+                    sparsity, prune_n=self.prune_n, prune_m=self.prune_m, percdamp=0.01,
+                    blocksize=self.sparsegpt_blocksize, sub_blocksize=self.sparsegpt_sub_blocksize,
+                )
+                wrapped_layers[name].free()
 
+            # the linears of a block are independent once their Hessians are collected
+            tasks = []
+            for name in subset:
+                assert wrapped_layers[name].nsamples == calibration.nsamples
+                
                 sparsity_key = f"{module_to_process}.{i}.{name}.weight"
                 # print(f"pruning {model_prefix} layer {i} {name} at unstructured {sparsity_ratio[sparsity_key]} sparsity")
-                
-                wrapped_layers[name].fasterprune(sparsity_ratio[sparsity_key], prune_n=self.prune_n, prune_m=self.prune_m, percdamp=0.01, blocksize=128)
-                wrapped_layers[name].free()
+                tasks.append((
+                    wrapped_layers[name].prune_cost(), wrapped_layers[name].dev,
+                    partial(prune_linear, name, sparsity_ratio[sparsity_key]),
+                ))
+            run_concurrently(tasks, max_workers=self.prune_workers)
 
-            for j in range(n_samples):
-                with torch.no_grad():
-                    with model.maybe_autocast():
-                        outs[j] = layer(inps[j], **caches[j])
-            inps, outs = outs, inps
+            calibration.propagate(forward_block)
 
+        del calibration
+        self.activation_store.clear()
         torch.cuda.empty_cache()
 
         return model
@@ -830,6 +892,10 @@ class VITLayerSparseGPTPruner(LayerWiseBasePruner):
             self.num_noise,
             self.noise_eps,
             layer_to_group_mapping,
+            grad_accum_dtype=self.grad_accum_dtype,
+            shard_grad_accum=self.shard_grad_accum,
+            zo_max_replicas=self.zo_max_replicas,
+            score_cache=self.score_cache,
         )
         
         return sparsity_module.return_sparsity()
@@ -916,6 +982,7 @@ class BLIPT5LayerSparseGPTPruner(LayerWiseBasePruner):
             noise_eps=noise_eps,
             prune_n=prune_n, 
             prune_m=prune_m, 
+            **kwargs,
         )
         
         self.t5_prune_spec = t5_prune_spec
@@ -995,6 +1062,10 @@ class BLIPT5LayerSparseGPTPruner(LayerWiseBasePruner):
             self.num_noise,
             self.noise_eps,
             layer_to_group_mapping,
+            grad_accum_dtype=self.grad_accum_dtype,
+            shard_grad_accum=self.shard_grad_accum,
+            zo_max_replicas=self.zo_max_replicas,
+            score_cache=self.score_cache,
         )
         
         return sparsity_module.return_sparsity()
@@ -0,0 +1,125 @@
+"""
+Allocation of a parameter budget over groups of layers.
+
+Every group keeps at least ``ceil(n * (1 - max_sparsity_per_layer))`` of its
+``n`` parameters, the rest of the budget is shared proportionally to the group
+scores and a group never keeps more than it has. The kept counts are thus
+
+    keep_i = min(n_i, base_i + lam * score_i)
+
+with ``lam`` such that they add up to the budget, which is the fixed point the
+former proportional refill loop converged to. ``lam`` is found in closed form
+after sorting the groups by the value of ``lam`` at which they saturate.
+"""
+
+import torch
+
+
+def _round_to_total(keep, upper, total):
+    # floor, then hand out the missing units by largest fractional part
+    rounded = torch.floor(keep)
+    deficit = int(round(total - float(rounded.sum())))
+    if deficit > 0:
+        fraction = keep - rounded
+        fraction[rounded >= upper] = -1
+        rounded[torch.topk(fraction, min(deficit, fraction.numel()))[1]] += 1
+    return torch.minimum(rounded, upper).long()
+
+
+def allocate_kept_parameters(scores, num_parameters, total_to_keep, max_sparsity_per_layer=0.8):
+    """
+    Number of parameters kept per group, see the module docstring.
+
+    Args:
+        scores: one non-negative score per group.
+        num_parameters: number of parameters per group.
+        total_to_keep (int): budget over all groups.
+        max_sparsity_per_layer (float): maximal sparsity of a single group.
+
+    Returns:
+        torch.LongTensor: parameters kept per group, summing to ``total_to_keep``
+        unless the per-group minimum alone exceeds it.
+    """
+    scores = torch.as_tensor(scores, dtype=torch.float64).clamp(min=0)
+    num_parameters = torch.as_tensor(num_parameters, dtype=torch.float64)
+
+    base = torch.minimum(torch.ceil(num_parameters * (1 - max_sparsity_per_layer)), num_parameters)
+    capacity = num_parameters - base
+    remaining = float(total_to_keep) - float(base.sum())
+    if remaining <= 0:
+        return base.long()
+    if remaining >= float(capacity.sum()):
+        return num_parameters.long()
+
+    positive = (scores > 0) & (capacity > 0)
+    reachable = float(capacity[positive].sum())
+    if remaining >= reachable:
+        # scored groups are full, the others share the rest by their free room
+        keep = base + torch.where(positive, capacity, torch.zeros_like(capacity))
+        room = torch.where(positive, torch.zeros_like(capacity), capacity)
+        keep = keep + room * ((remaining - reachable) / float(room.sum()))
+        return _round_to_total(keep, num_parameters, total_to_keep)
+
+    # value of lam at which each scored group saturates, in increasing order
+    idx = torch.nonzero(positive).flatten()
+    saturation = capacity[idx] / scores[idx]
+    order = torch.argsort(saturation)
+    idx, saturation = idx[order], saturation[order]
+    cap, sc = capacity[idx], scores[idx]
+
+    # budget used at lam = saturation[j]: groups before j are full, j.. grow linearly
+    saturated_before = torch.cumsum(cap, 0) - cap
+    score_from = torch.flip(torch.cumsum(torch.flip(sc, [0]), 0), [0])
+    used = saturated_before + saturation * score_from
+
+    j = int(torch.searchsorted(used, torch.tensor([remaining], dtype=torch.float64))[0])
+    j = min(j, len(idx) - 1)
+    lam = (remaining - float(saturated_before[j])) / float(score_from[j])
+
+    added = torch.zeros_like(capacity)
+    added[idx] = torch.minimum(cap, lam * sc)
+    return _round_to_total(base + added, num_parameters, total_to_keep)
+
+
+def allocate_group_sparsity(
+    group_scores,
+    group_num_parameters,
+    sparsity,
+    max_sparsity_per_layer=0.8,
+    per_model_group=None,
+    per_model_sparsity=None,
+):
+    """
+    Sparsity of every group for a target ``sparsity``.
+
+    With ``per_model_group`` (group name prefixes, e.g. ``["t5_model",
+    "visual"]``) every sub-model gets its own budget from
+    ``per_model_sparsity``; otherwise a single budget covers all groups.
+
+    Args:
+        group_scores (dict): group name -> score.
+        group_num_parameters (dict): group name -> number of parameters.
+
+    Returns:
+        dict: group name -> sparsity in ``[0, 1]``.
+    """
+    if per_model_group is None:
+        budgets = [(list(group_num_parameters.keys()), sparsity)]
+    else:
+        budgets = [
+            ([k for k in group_num_parameters if k.startswith(prefix)], submodel_sparsity)
+            for prefix, submodel_sparsity in zip(per_model_group, per_model_sparsity)
+        ]
+
+    group_sparsity = {}
+    for names, target in budgets:
+        if len(names) == 0:
+            continue
+        scores = [float(group_scores[k]) for k in names]
+        num_parameters = torch.tensor([group_num_parameters[k] for k in names], dtype=torch.float64)
+        total_to_keep = int(float(num_parameters.sum()) * (1 - target))
+
+        keep = allocate_kept_parameters(scores, num_parameters, total_to_keep, max_sparsity_per_layer)
+        for k, kept, n in zip(names, keep.tolist(), num_parameters.tolist()):
+            group_sparsity[k] = min(max(1 - kept / n, 0.0), 1.0)
+    return group_sparsity
@@ -64,4 +64,186 @@ def loss_vision(model, samples, cuda_enabled):
     
     batch_len = len(targets)
 
-    return loss, batch_len
\ No newline at end of file
+    return loss, batch_len
+
+def nm_prune_mask(metric, prune_n, prune_m, return_indices=False):
+    """
+    Build an N:M sparsity mask in one batched op.
+
+    The score matrix is viewed as ``(rows, cols // prune_m, prune_m)`` groups of
+    consecutive input columns and the ``prune_n`` entries with the smallest
+    score of every group are selected for pruning.
+
+    Args:
+        metric (torch.Tensor): ``(rows, cols)`` importance scores.
+        prune_n (int): number of entries pruned per group.
+        prune_m (int): group size.
+        return_indices (bool): also return the pruned and kept column indices.
+
+    Returns:
+        torch.Tensor: boolean mask, ``True`` for pruned entries.
+        torch.Tensor, torch.Tensor: only with ``return_indices``, the column
+            indices of the pruned and the kept entries, ordered group by group
+            and by increasing score within a group.
+    """
+    rows, cols = metric.shape
+    full_cols = cols - cols % prune_m
+
+    def select(scores, size, offset):
+        n = min(prune_n, size)
+        starts = torch.arange(offset, offset + scores.shape[1] * size, size, device=metric.device).view(1, -1, 1)
+        if return_indices:
+            order = torch.sort(scores, dim=-1)[1] + starts
+            return order[..., :n].reshape(rows, -1), order[..., n:].reshape(rows, -1)
+        return (torch.topk(scores, n, dim=-1, largest=False)[1] + starts).reshape(rows, -1), None
+
+    prune_indices, keep_indices = [], []
+    if full_cols > 0:
+        p, k = select(metric[:, :full_cols].float().reshape(rows, -1, prune_m), prune_m, 0)
+        prune_indices.append(p)
+        keep_indices.append(k)
+    if full_cols < cols:
+        # trailing group narrower than prune_m
+        p, k = select(metric[:, full_cols:].float().unsqueeze(1), cols - full_cols, full_cols)
+        prune_indices.append(p)
+        keep_indices.append(k)
+
+    prune_indices = torch.cat(prune_indices, dim=1)
+    mask = torch.zeros(metric.shape, dtype=torch.bool, device=metric.device)
+    mask.scatter_(1, prune_indices, True)
+
+    if return_indices:
+        return mask, prune_indices, torch.cat(keep_indices, dim=1)
+    return mask
+
+
+def set_mask(module, mask, pack=False, prune_n=0, prune_m=0):
+    """
+    Set the keep-mask of a pruned linear.
+
+    With ``pack`` the mask is stored bit-packed (or as N:M pattern codes) by
+    layers that support it, see ``lora.Linear.set_packed_mask``; other layers
+    get the boolean mask as before.
+    """
+    if pack and hasattr(module, "set_packed_mask"):
+        module.set_packed_mask(mask, prune_n, prune_m)
+    else:
+        setattr(module, "mask", mask)
+
+
+def invalidate_weight_cache(module):
+    """
+    Drop the effective weight a LoRA layer caches in eval mode. Its cache key
+    tracks ``weight._version``, which writes through ``weight.data`` do not
+    bump, so every such write has to call this.
+    """
+    if hasattr(module, "invalidate_weight_cache"):
+        module.invalidate_weight_cache()
+
+
+def zero_pruned_weights(module, pruned):
+    """Set the ``pruned`` entries of the weight of ``module`` to zero."""
+    module.weight.data[pruned] = 0
+    invalidate_weight_cache(module)
+
+
+_RADIX_BITS = 16
+
+
+def _ordered_keys(chunk):
+    # float32 bit patterns mapped to int64 keys in [0, 2^32) with the same order as the floats
+    bits = chunk.float().contiguous().view(torch.int32).long()
+    return torch.where(bits < 0, bits ^ 0x7fffffff, bits) + (1 << 31)
+
+
+def _key_to_float(key):
+    bits = key - (1 << 31)
+    if bits < 0:
+        bits ^= 0x7fffffff
+    return torch.tensor([bits], dtype=torch.int32).view(torch.float32)[0]
+
+
+def _stream_chunks(tensors, chunk_size, device):
+    for t in tensors:
+        flat = t.detach().reshape(-1)
+        for start in range(0, flat.numel(), chunk_size):
+            chunk = flat[start:start + chunk_size]
+            yield chunk.to(device) if device is not None else chunk
+
+
+def kth_smallest(tensors, k, chunk_size=1 << 24, device=None):
+    """
+    Exact ``k``-th smallest value (1-indexed) over all elements of ``tensors``.
+
+    Same result as ``torch.topk(torch.cat([t.flatten() for t in tensors]), k,
+    largest=False)[0][-1]`` but without the concatenation or the topk output:
+    the float32 bit patterns are radix-selected 16 bits at a time, with one
+    streaming histogram pass over ``chunk_size`` elements at a time per digit.
+
+    Args:
+        tensors (list): floating point tensors (a dict's ``values()`` works too).
+        k (int): rank of the returned value, ``1 <= k <= total numel``.
+        chunk_size (int): elements processed at once.
+        device: where the histograms are computed, e.g. ``"cuda"``; by default
+            on the device of each tensor.
+
+    Returns:
+        torch.Tensor: 0-dim tensor of the common dtype of ``tensors``.
+    """
+    tensors = list(tensors)
+    total = sum(t.numel() for t in tensors)
+    assert 1 <= k <= total, f"k={k} out of range for {total} elements"
+
+    num_bins = 1 << _RADIX_BITS
+    digit_mask = num_bins - 1
+    prefix, remaining = 0, k
+    for shift in [_RADIX_BITS, 0]:
+        hist = None
+        for chunk in _stream_chunks(tensors, chunk_size, device):
+            keys = _ordered_keys(chunk)
+            if shift == 0:
+                keys = keys[(keys >> _RADIX_BITS) == prefix]
+            counts = torch.bincount((keys >> shift) & digit_mask, minlength=num_bins)
+            hist = counts if hist is None else hist + counts.to(hist.device)
+
+        cumulative = hist.cumsum(0)
+        digit = int(torch.searchsorted(cumulative, torch.tensor([remaining], device=cumulative.device))[0])
+        if digit > 0:
+            remaining -= int(cumulative[digit - 1])
+        prefix = (prefix << _RADIX_BITS) | digit
+
+    dtype = tensors[0].dtype if all(t.dtype == tensors[0].dtype for t in tensors) else torch.float32
+    return _key_to_float(prefix).to(dtype)
+
+
+def kth_largest(tensors, k, chunk_size=1 << 24, device=None):
+    """Exact ``k``-th largest value (1-indexed), see ``kth_smallest``."""
+    tensors = list(tensors)
+    total = sum(t.numel() for t in tensors)
+    return kth_smallest(tensors, total - k + 1, chunk_size=chunk_size, device=device)
+
+
+def global_threshold_mask(importance_scores, p, max_sparsity_per_layer=1.0, device=None):
+    """
+    Masks of a global magnitude-style pruning of ``importance_scores``.
+
+    The top ``1 - max_sparsity_per_layer`` fraction of every tensor is
+    protected by setting it to the dtype's max (in place), then the
+    ``int(p * total)`` smallest scores over all tensors are pruned. Masks
+    are ``1`` where the score is above the global threshold.
+    """
+    for k, v in importance_scores.items():
+        num_to_set = int(v.numel() * (1 - max_sparsity_per_layer))
+        if num_to_set > 0:
+            threshold = kth_largest([v], num_to_set, device=device)
+            v.masked_fill_(v >= threshold, torch.finfo(v.dtype).max)
+
+    num_to_zero_out = int(p * sum(v.numel() for v in importance_scores.values()))
+    if num_to_zero_out == 0:
+        return {k: torch.ones_like(v) for k, v in importance_scores.items()}
+    threshold = kth_smallest(importance_scores.values(), num_to_zero_out, device=device)
+
+    masks = {}
+    for k, v in importance_scores.items():
+        masks[k] = (v > threshold).type(v.dtype)
+    return masks
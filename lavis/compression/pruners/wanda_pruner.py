@@ -7,10 +7,13 @@ from functools import partial
 
 from lavis.common.registry import registry
 from lavis.compression.pruners.utils import (
-    loss_vision_language, loss_language, loss_vision, print_time
+    loss_vision_language, loss_language, loss_vision, print_time, nm_prune_mask, set_mask, zero_pruned_weights
 )
+from lavis.compression.pruners.calibration import CalibrationBatches, pruning_changes_forward
 from lavis.compression.pruners.layer_single_base_pruner import LayerWiseBasePruner, LayerSparsity
-from lavis.peft.src.peft.tuners.lora import Linear, LoraLayer, Linear8bitLt
+from lavis.compression.pruners.shared_inputs import SharedInputs
+from lavis.compression.pruners.score_cache import apply_masks
+from lavis.peft.src.peft.tuners.lora import Linear, LoraLayer, Linear8bitLt, pack_mask
 
 
 def get_module_recursive(base, module_to_process):
@@ -48,6 +51,32 @@ def find_layers(module, layers=[nn.Linear, Linear, LoraLayer, Linear8bitLt], nam
     return res
 
 
+def wanda_masks(W_metric, ratios, per_row=True):
+    """
+    Masks of the pruned entries of ``W_metric`` for every sparsity in ``ratios``,
+    from a single sort. ``per_row`` prunes every output row to the ratio,
+    otherwise the whole matrix shares one threshold.
+    """
+    if per_row:
+        indices = torch.sort(W_metric, dim=-1, stable=True)[1]
+        masks = []
+        for ratio in ratios:
+            W_mask = (torch.zeros_like(W_metric) == 1)  ## initialize a mask to be all False
+            W_mask.scatter_(1, indices[:,:int(W_metric.shape[1] * ratio)], True)
+            masks.append(W_mask)
+        return masks
+
+    sorted_metric = torch.sort(W_metric.flatten())[0]
+    return [W_metric < sorted_metric[int(W_metric.numel() * ratio)] for ratio in ratios]
+
+
+def record_sweep_masks(sweep_masks, name, W_masks):
+    # keep-masks of every sweep level, packed as by ``collect_masks``
+    for level_masks, W_mask in zip(sweep_masks, W_masks):
+        packed, mask_format = pack_mask(~W_mask)
+        level_masks[name] = (packed.cpu(), mask_format)
+
+
 class WrappedGPT:
     """
     This class wraps a GPT layer for specific operations.
@@ -127,6 +156,7 @@ class T5LayerWandaPruner(LayerWiseBasePruner):
             prune_per_model=prune_per_model,
             prune_n=prune_n,
             prune_m=prune_m,
+            **kwargs,
         )
         
         self.loss_func = loss_language
@@ -235,13 +265,15 @@ class T5LayerWandaPruner(LayerWiseBasePruner):
                 "attention_mask", "position_ids", 
             ]
             
+        store = self.activation_store
+
         class Catcher(nn.Module):
             def __init__(self, module):
                 super().__init__()
                 self.module = module
                 
             def forward(self, inp, dense=True, **kwargs):
-                inps.append(inp)
+                inps.append(store.offload(inp))
                 inps[-1].requires_grad = False
                 
                 cache = {}
@@ -249,7 +281,7 @@ class T5LayerWandaPruner(LayerWiseBasePruner):
                     cache[k] = kwargs[k]
                 if lora_model:
                     cache["dense"] = dense
-                caches.append(cache)
+                caches.append(store.offload_cache(cache))
                 raise ValueError
 
         layers[0] = Catcher(layers[0])
@@ -282,6 +314,11 @@ class T5LayerWandaPruner(LayerWiseBasePruner):
             inps, outs, caches = self.prepare_calibration_input_encoder(model, dataloader, model_prefix, n_samples, module_to_process, lora_model)
 
         n_samples = min(n_samples, len(inps))
+        calibration = CalibrationBatches(
+            inps[:n_samples], caches[:n_samples], batch_size=self.calibration_batch_size,
+            store=self.activation_store, device=next(iter(model.parameters())).device,
+        )
+        del inps, outs, caches
 
         layers = get_module_recursive(model, module_to_process)
         for i in range(len(layers)):
@@ -295,57 +332,70 @@ class T5LayerWandaPruner(LayerWiseBasePruner):
             wrapped_layers = {}
             for name in subset:
                 wrapped_layers[name] = WrappedGPT(subset[name])
+            # linears reading the same input share its statistics
+            shared = SharedInputs()
 
             def add_batch(name):
                 def tmp(_, inp, out):
-                    wrapped_layers[name].add_batch(inp[0].data, out.data)
+                    if not shared.is_owner(name, inp[0].data):
+                        return
+                    for inp_j in calibration.split(inp[0].data):
+                        wrapped_layers[name].add_batch(inp_j, out.data)
                 return tmp
 
             handles = []
             for name in wrapped_layers:
                 handles.append(subset[name].register_forward_hook(add_batch(name)))
 
-            for j in range(n_samples):
+            def forward_block(inp, cache):
                 with torch.no_grad():
                     with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])[0]
+                        return layer(inp, **cache)[0]
+
+            calibration.run(forward_block, keep_outputs=self.fused_propagate)
+            shared.finish()
+            shared.share(wrapped_layers)
 
             for h in handles:
                 h.remove()
 
             for name in subset:
-                assert wrapped_layers[name].nsamples == len(inps) * inps[0].shape[0]
+                assert wrapped_layers[name].nsamples == calibration.nsamples
                 W_metric = torch.abs(subset[name].weight.data) * torch.sqrt(wrapped_layers[name].scaler_row.reshape((1,-1)))
+                sparsity_key = f"{module_to_process}.{i}.{name}.weight"
+
+                if isinstance(sparsity_ratio, list):
+                    # sparsity sweep, the statistics do not depend on the masks
+                    print(f"pruning {model_prefix} layer {i} {name} at unstructured {[r[sparsity_key] for r in sparsity_ratio]} sparsity")
+                    record_sweep_masks(
+                        self.sweep_masks, f"{module_to_process}.{i}.{name}",
+                        wanda_masks(W_metric, [r[sparsity_key] for r in sparsity_ratio], per_row=True),
+                    )
+                    continue
 
                 setattr(subset[name].weight, "importance_score", W_metric.cpu().abs().mean().item())
                 
-                W_mask = (torch.zeros_like(W_metric) == 1)  ## initialize a mask to be all False
                 if self.prune_n != 0:
                     # structured n:m sparsity
                     print(f"pruning {model_prefix} layer {i} {name} at structured {self.prune_n}:{self.prune_m} sparsity")
-                    for ii in range(W_metric.shape[1]):
-                        if ii % self.prune_m == 0:
-                            tmp = W_metric[:,ii:(ii+self.prune_m)].float()
-                            W_mask.scatter_(1,ii+torch.topk(tmp, self.prune_n, dim=1, largest=False)[1], True)
+                    W_mask = nm_prune_mask(W_metric, self.prune_n, self.prune_m)
                 else:
                     # unstructured pruning
-                    sort_res = torch.sort(W_metric, dim=-1, stable=True)
-                    sparsity_key = f"{module_to_process}.{i}.{name}.weight"
                     print(f"pruning {model_prefix} layer {i} {name} at unstructured {sparsity_ratio[sparsity_key]} sparsity")
+                    W_mask = wanda_masks(W_metric, [sparsity_ratio[sparsity_key]], per_row=True)[0]
 
-                    indices = sort_res[1][:,:int(W_metric.shape[1] * sparsity_ratio[sparsity_key])]
-                    W_mask.scatter_(1, indices, True)
-
-                setattr(subset[name], "mask", ~W_mask.bool())
+                set_mask(subset[name], ~W_mask.bool(), self.pack_masks, self.prune_n, self.prune_m)
                 if lora_model == False:
-                    subset[name].weight.data[W_mask] = 0  ## set weights to zero 
+                    zero_pruned_weights(subset[name], W_mask)  ## set weights to zero 
 
-            for j in range(n_samples):
-                with torch.no_grad():
-                    with model.maybe_autocast(dtype=torch.bfloat16):
-                        outs[j] = layer(inps[j], **caches[j])[0]
-            inps, outs = outs, inps
+            calibration.propagate(
+                forward_block,
+                reuse_outputs=self.fused_propagate and \
+                    not pruning_changes_forward(subset, weights_modified=not lora_model, dense=calibration.dense),
+            )
 
+        del calibration
+        self.activation_store.clear()
         getattr(model, model_prefix).config.use_cache = use_cache 
         # del inps, outs, caches 
         torch.cuda.empty_cache()
@@ -489,6 +539,7 @@ class VITLayerWandaPruner(LayerWiseBasePruner):
             prune_per_model=prune_per_model,
             prune_n=prune_n,
             prune_m=prune_m,
+            **kwargs,
         )
         
         self.loss_func = loss_vision
@@ -592,19 +643,21 @@ class VITLayerWandaPruner(LayerWiseBasePruner):
             "rel_pos_bias"
         ]
 
+        store = self.activation_store
+
         class Catcher(nn.Module):
             def __init__(self, module):
                 super().__init__()
                 self.module = module
             def forward(self, inp, rel_pos_bias, dense=True):
-                inps.append(inp)
+                inps.append(store.offload(inp))
                 inps[-1].requires_grad = False
                 
                 cache = {}
                 cache["rel_pos_bias"] = rel_pos_bias
                 if lora_model:
                     cache["dense"] = dense 
-                caches.append(cache)
+                caches.append(store.offload_cache(cache))
                 raise ValueError
 
         layers[0] = Catcher(layers[0])
@@ -630,6 +683,11 @@ class VITLayerWandaPruner(LayerWiseBasePruner):
             inps, outs, caches = self.prepare_calibration_input_encoder(model, dataloader, model_prefix, n_samples, module_to_process, lora_model)
 
         n_samples = min(n_samples, len(inps))
+        calibration = CalibrationBatches(
+            inps[:n_samples], caches[:n_samples], batch_size=self.calibration_batch_size,
+            store=self.activation_store, device=next(iter(model.parameters())).device,
+        )
+        del inps, outs, caches
 
         layers = get_module_recursive(model, module_to_process)
         for i in range(len(layers)):
@@ -643,55 +701,70 @@ class VITLayerWandaPruner(LayerWiseBasePruner):
             wrapped_layers = {}
             for name in subset:
                 wrapped_layers[name] = WrappedGPT(subset[name])
+            # linears reading the same input share its statistics
+            shared = SharedInputs()
 
             def add_batch(name):
                 def tmp(_, inp, out):
-                    wrapped_layers[name].add_batch(inp[0].data, out.data)
+                    if not shared.is_owner(name, inp[0].data):
+                        return
+                    for inp_j in calibration.split(inp[0].data):
+                        wrapped_layers[name].add_batch(inp_j, out.data)
                 return tmp
 
             handles = []
             for name in wrapped_layers:
                 handles.append(subset[name].register_forward_hook(add_batch(name)))
             # print(f"caches: {caches}")
-            for j in range(n_samples):
+            def forward_block(inp, cache):
                 with torch.no_grad():
                     with model.maybe_autocast():
-                        outs[j] = layer(inps[j], **caches[j])
+                        return layer(inp, **cache)
+
+            calibration.run(forward_block, keep_outputs=self.fused_propagate)
+            shared.finish()
+            shared.share(wrapped_layers)
 
             for h in handles:
                 h.remove()
 
             for name in subset:
-                assert wrapped_layers[name].nsamples == len(inps) * inps[0].shape[0]
+                assert wrapped_layers[name].nsamples == calibration.nsamples
                 W_metric = torch.abs(subset[name].weight.data) * torch.sqrt(wrapped_layers[name].scaler_row.reshape((1,-1)))
+                sparsity_key = f"{module_to_process}.{i}.{name}.weight"
+
+                if isinstance(sparsity_ratio, list):
+                    # sparsity sweep, the statistics do not depend on the masks
+                    print(f"pruning {model_prefix} layer {i} {name} at unstructured {[r[sparsity_key] for r in sparsity_ratio]} sparsity")
+                    record_sweep_masks(
+                        self.sweep_masks, f"{module_to_process}.{i}.{name}",
+                        wanda_masks(W_metric, [r[sparsity_key] for r in sparsity_ratio], per_row=False),
+                    )
+                    continue
 
                 setattr(subset[name].weight, "importance_score", W_metric.cpu().abs().mean().item())
                 
-                W_mask = (torch.zeros_like(W_metric) == 1)  ## initialize a mask to be all False
                 if self.prune_n != 0:
                     # structured n:m sparsity
                     print(f"pruning {model_prefix} layer {i} {name} at structured {self.prune_n}:{self.prune_m} sparsity")
-                    for ii in range(W_metric.shape[1]):
-                        if ii % self.prune_m == 0:
-                            tmp = W_metric[:,ii:(ii+self.prune_m)].float()
-                            W_mask.scatter_(1,ii+torch.topk(tmp, self.prune_n, dim=1, largest=False)[1], True)
+                    W_mask = nm_prune_mask(W_metric, self.prune_n, self.prune_m)
                 else:
                     # # unstructured pruning
-                    sparsity_key = f"{module_to_process}.{i}.{name}.weight"
                     print(f"pruning {model_prefix} layer {i} {name} at unstructured {sparsity_ratio[sparsity_key]} sparsity")
-                    thres = torch.sort(W_metric.flatten())[0][int(W_metric.numel() * sparsity_ratio[sparsity_key])]
-                    W_mask = (W_metric < thres)
+                    W_mask = wanda_masks(W_metric, [sparsity_ratio[sparsity_key]], per_row=False)[0]
                     
-                setattr(subset[name], "mask", ~W_mask.bool())
+                set_mask(subset[name], ~W_mask.bool(), self.pack_masks, self.prune_n, self.prune_m)
                 if lora_model == False:
-                    subset[name].weight.data[W_mask] = 0  ## set weights to zero 
+                    zero_pruned_weights(subset[name], W_mask)  ## set weights to zero 
 
-            for j in range(n_samples):
-                with torch.no_grad():
-                    with model.maybe_autocast():
-                        outs[j] = layer(inps[j], **caches[j])
-            inps, outs = outs, inps
+            calibration.propagate(
+                forward_block,
+                reuse_outputs=self.fused_propagate and \
+                    not pruning_changes_forward(subset, weights_modified=not lora_model, dense=calibration.dense),
+            )
             
+        del calibration
+        self.activation_store.clear()
         # del inps, outs, caches 
         torch.cuda.empty_cache()
         gc.collect()
@@ -848,6 +921,7 @@ class BLIPT5LayerWandaPruner(LayerWiseBasePruner):
             prune_per_model=prune_per_model,
             prune_n=prune_n, 
             prune_m=prune_m, 
+            **kwargs,
         )
         
         self.t5_prune_spec = t5_prune_spec
@@ -934,6 +1008,10 @@ class BLIPT5LayerWandaPruner(LayerWiseBasePruner):
             # prune_per_model=self.prune_per_model,
             # per_model_group=[self.t5_model_prefix, self.vit_model_prefix],
             # per_model_sparsity=[t5_sparsity, vit_sparsity],
+            grad_accum_dtype=self.grad_accum_dtype,
+            shard_grad_accum=self.shard_grad_accum,
+            zo_max_replicas=self.zo_max_replicas,
+            score_cache=self.score_cache,
         )
         
         return sparsity_module.return_sparsity()
@@ -965,20 +1043,49 @@ class BLIPT5LayerWandaPruner(LayerWiseBasePruner):
 
         self.vit_dense = True if float(vit_keep_ratio) < 1. else False
         self.llm_dense = True if float(t5_keep_ratio) < 1. else False
+
+        if self.load_cached_masks(global_sparsity_dict, lora_model):
+            self.model_reset(self.model, dtype_record, requires_grad_record, device)
+            return self.model, global_sparsity_dict
         
+        vit_sparsity_dict, t5_sparsity_dict = None, None
         if self.vit_prune_spec is not None and float(vit_keep_ratio) < 1.:
             
             sparsity_ratio = 1 - vit_keep_ratio
             
             if global_sparsity_dict not in [None, "none"]:
-                sparsity_dict = global_sparsity_dict
+                vit_sparsity_dict = global_sparsity_dict
             else:
-                sparsity_dict = self.get_sparsity(
+                vit_sparsity_dict = self.get_sparsity(
                     sparsity_ratio,
                     # sparsity_ratio, 
                     sparsity_ratio_granularity=None
                 )
             
+        if self.t5_prune_spec is not None and float(t5_keep_ratio) < 1.:
+            sparsity_ratio = 1 - t5_keep_ratio
+            # print(f"sparsity_ratio: {sparsity_ratio}")
+            if global_sparsity_dict is not None:
+                t5_sparsity_dict = global_sparsity_dict
+            else:
+                t5_sparsity_dict = self.get_sparsity(
+                    sparsity_ratio,
+                    # sparsity_ratio, 
+                    sparsity_ratio_granularity=None
+                )
+                
+        self._prune_stages(vit_sparsity_dict, t5_sparsity_dict, lora_model)
+
+        self.save_masks([self.vit_model_prefix, self.t5_model_prefix], global_sparsity_dict, lora_model)
+
+        # let the pruned model has the original
+        self.model_reset(self.model, dtype_record, requires_grad_record, device)
+        
+        return self.model, global_sparsity_dict
+
+    def _prune_stages(self, vit_sparsity_dict, t5_sparsity_dict, lora_model=False):
+        # a list of sparsity dicts per stage collects the masks of a sparsity sweep
+        if vit_sparsity_dict is not None:
             # print(f"vit sparsity dict: {sparsity_dict}")
             _vit_prune = partial(VITLayerWandaPruner._prune, self)
             self.prepare_calibration_input_encoder = partial(
@@ -990,22 +1097,11 @@ class BLIPT5LayerWandaPruner(LayerWiseBasePruner):
                 self.model, self.data_loader, 
                 model_prefix=self.vit_model_prefix,
                 module_to_process=f"{self.vit_model_prefix}.blocks",
-                n_samples=self.num_samples, sparsity_ratio=sparsity_dict,
+                n_samples=self.num_samples, sparsity_ratio=vit_sparsity_dict,
                 lora_model=lora_model, 
             )
             
-        if self.t5_prune_spec is not None and float(t5_keep_ratio) < 1.:
-            sparsity_ratio = 1 - t5_keep_ratio
-            # print(f"sparsity_ratio: {sparsity_ratio}")
-            if global_sparsity_dict is not None:
-                sparsity_dict = global_sparsity_dict
-            else:
-                sparsity_dict = self.get_sparsity(
-                    sparsity_ratio,
-                    # sparsity_ratio, 
-                    sparsity_ratio_granularity=None
-                )
-                
+        if t5_sparsity_dict is not None:
             # print(f"global_sparsity_dict: {global_sparsity_dict}")
             # print(f"sparsity_dict: {sparsity_dict}")
             _t5_prune = partial(T5LayerWandaPruner._prune, self)
@@ -1018,7 +1114,7 @@ class BLIPT5LayerWandaPruner(LayerWiseBasePruner):
                     self.model, self.data_loader, 
                     model_prefix=self.t5_model_prefix,
                     module_to_process=f"{self.t5_model_prefix}.encoder.block",
-                    n_samples=self.num_samples, sparsity_ratio=sparsity_dict,
+                    n_samples=self.num_samples, sparsity_ratio=t5_sparsity_dict,
                     lora_model=lora_model, 
                 )
                 
@@ -1026,7 +1122,7 @@ class BLIPT5LayerWandaPruner(LayerWiseBasePruner):
                     self.model, self.data_loader, 
                     model_prefix=self.t5_model_prefix,
                     module_to_process=f"{self.t5_model_prefix}.decoder.block",
-                    n_samples=self.num_samples, sparsity_ratio=sparsity_dict,
+                    n_samples=self.num_samples, sparsity_ratio=t5_sparsity_dict,
                     lora_model=lora_model, 
                 )
             else:
@@ -1034,14 +1130,52 @@ class BLIPT5LayerWandaPruner(LayerWiseBasePruner):
                     self.model, self.data_loader, 
                     model_prefix=self.t5_model_prefix,
                     module_to_process=f"{self.t5_model_prefix}{self.peft_postfix}.model.layers", 
-                    n_samples=self.num_samples, sparsity_ratio=sparsity_dict,
+                    n_samples=self.num_samples, sparsity_ratio=t5_sparsity_dict,
                     lora_model=lora_model, 
                 )
-                
-        # let the pruned model has the original
+
+    @print_time
+    def prune_sweep(self, sparsities, save_fn, lora_model=False):
+        """
+        Sparsity sweep sharing one calibration pass.
+
+        With ``lora_model`` the calibration forward is dense and ignores the
+        masks, so the activation statistics of every layer are the same for
+        all levels: each layer is scored and sorted once and cut at every
+        level. Otherwise (or with N:M or a fixed sparsity dict) this falls back
+        to ``LayerWiseBasePruner.prune_sweep``.
+        """
+        if not lora_model or self.prune_n != 0 or self.sparsity_dict is not None:
+            return super().prune_sweep(sparsities, save_fn, lora_model)
+
+        dtype_record, requires_grad_record, device = self.model_setup_and_record_attributes(self.model)
+        self.enable_sweep_score_cache()
+
+        _, vit_keep_ratio, _, _ = self.convert_spec_to_list(self.vit_prune_spec)
+        _, t5_keep_ratio, _, _ = self.convert_spec_to_list(self.t5_prune_spec) 
+        prune_vit = self.vit_prune_spec is not None and float(vit_keep_ratio) < 1.
+        prune_t5 = self.t5_prune_spec is not None and float(t5_keep_ratio) < 1.
+        self.vit_dense, self.llm_dense = prune_vit, prune_t5
+
+        sparsity_dicts = [
+            self.get_sparsity(sparsity, sparsity_ratio_granularity=self.sparsity_ratio_granularity)
+            for sparsity in sparsities
+        ]
+
+        self.sweep_masks = [{} for _ in sparsities]
+        self._prune_stages(
+            sparsity_dicts if prune_vit else None, sparsity_dicts if prune_t5 else None, lora_model
+        )
+
+        for sparsity, sparsity_dict, masks in zip(sparsities, sparsity_dicts, self.sweep_masks):
+            print(f"sweep level {sparsity}")
+            apply_masks(self.model, masks, pack=self.pack_masks)
+            save_fn(sparsity, self.model, sparsity_dict if isinstance(sparsity_dict, dict) else None)
+        del self.sweep_masks
+        self.reset_masks()
+
         self.model_reset(self.model, dtype_record, requires_grad_record, device)
-        
-        return self.model, global_sparsity_dict
+        return self.model
     
     def check(self, name, v, model_prefix):
         if len(v.shape) == 2 and \
@@ -0,0 +1,400 @@
+"""
+Zeroth-order (MeZO-style) directional derivatives of the calibration loss.
+
+A MeZO estimate of ``g . z`` for a direction ``z`` needs the loss at
+``theta + eps * z`` and ``theta - eps * z``. Instead of writing every
+perturbation into the weights and running one full forward per loss, the
+``ZerothOrderEngine`` perturbs linear weights through forward hooks, which
+add ``eps * x @ z^T`` to the layer output. That allows
+
+    * stacking many perturbations along the batch dimension: the calibration
+      batch is repeated once per perturbation ("replica") and every hook only
+      touches the rows of its replica, so a single forward yields the losses
+      of up to ``max_replicas`` perturbed models;
+    * perturbing many tensors at once, each with its own seed;
+    * seed replay: noise is regenerated from ``(seed, tensor)`` whenever it is
+      needed and never stored.
+
+For the perturbed models that leave the vision side untouched, the outputs
+of the visual encoder and the Q-Former are computed once per batch and
+reused by every replica and forward.
+
+Tensors that cannot be hooked (biases, norms, ``query_tokens``, weights not
+called as an ``nn.Linear`` module) are perturbed in place, one replica per
+forward, as the original scorers did. ``losses`` groups the perturbed models
+so that such tensors only disable stacking (and vision tensors only disable
+feature caching) for the models they belong to.
+"""
+
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# modules whose outputs do not depend on the language model and can be cached per batch
+CACHEABLE_MODULES = ["visual_encoder", "Qformer.bert"]
+
+# perturbing parameters under these prefixes changes the cached features
+VISION_PREFIXES = ["visual_encoder", "ln_vision", "Qformer", "query_tokens"]
+
+LM_PREFIXES = ["t5_model", "llm_model", "opt_model"]
+
+
+def batch_size(samples):
+    if "text_input" in samples:
+        return len(samples["text_input"])
+    for v in samples.values():
+        if torch.is_tensor(v) and v.dim() > 0:
+            return v.shape[0]
+    raise ValueError("Cannot infer the batch size of the calibration samples")
+
+
+def tensor_seed(seed, index):
+    # seed of the index-th tensor for a direction shared by all tensors
+    return (int(seed) * 1000003 + index) % (2 ** 62)
+
+
+def _noise(param, seed):
+    generator = torch.Generator(device=param.device)
+    generator.manual_seed(int(seed))
+    return torch.randn(param.shape, generator=generator, device=param.device, dtype=param.dtype)
+
+
+def _replicate(samples, n, size):
+    if n == 1:
+        return samples
+    replicated = {}
+    for k, v in samples.items():
+        if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == size:
+            replicated[k] = v.repeat(n, *([1] * (v.dim() - 1)))
+        elif isinstance(v, (list, tuple)) and len(v) == size:
+            replicated[k] = list(v) * n
+        else:
+            replicated[k] = v
+    return replicated
+
+
+def _take(x, n, size):
+    # first replica of a stacked argument
+    if n > 1 and torch.is_tensor(x) and x.dim() > 0 and x.shape[0] == n * size:
+        return x[:size]
+    return x
+
+
+def _repeat(out, n):
+    if n == 1:
+        return out
+    if torch.is_tensor(out):
+        return torch.cat([out] * n)
+    if isinstance(out, dict):
+        return type(out)(**{k: _repeat(v, n) for k, v in out.items()})
+    if isinstance(out, (list, tuple)):
+        return type(out)(_repeat(v, n) for v in out)
+    return out
+
+
+def _perturb_output(perturbations, module, inputs, output):
+    x = inputs[0]
+    output = output.clone()
+    for rows, param, seed, scale in perturbations:
+        z = _noise(param, seed).to(x.dtype)
+        output[rows] += (scale * F.linear(x[rows], z)).to(output.dtype)
+    return output
+
+
+def _record_rows(seen, module, inputs, output):
+    seen.setdefault(module, []).append(inputs[0].shape[0])
+
+
+class ZerothOrderEngine:
+    """
+    Batched MeZO loss evaluations for a set of parameter tensors.
+
+    Args:
+        model: the model called by ``loss_func``.
+        names (list): names of the scored parameters.
+        params (list): the parameters, aligned with ``names``.
+        loss_func: ``loss_func(model, samples, cuda_enabled) -> (loss, batch_len)``.
+        eps (float): perturbation size.
+        max_replicas (int): maximal number of perturbed models per forward,
+            the forward batch is ``max_replicas`` times the calibration batch.
+        cuda_enabled (bool): passed to ``loss_func``.
+    """
+
+    def __init__(self, model, names, params, loss_func, eps=1e-3, max_replicas=16, cuda_enabled=True):
+        self.model = model
+        self.names = list(names)
+        self.params = list(params)
+        self.loss_func = loss_func
+        self.eps = eps
+        self.max_replicas = max(1, max_replicas)
+        self.cuda_enabled = cuda_enabled
+
+        # owning linear of every weight, None if the tensor has to be perturbed in place
+        modules = dict(model.named_modules())
+        self.modules = []
+        for name, param in zip(self.names, self.params):
+            module_name, _, attr = name.rpartition(".")
+            module = modules.get(module_name, None)
+            if attr == "weight" and isinstance(module, nn.Linear) and module.weight is param and \
+                    not getattr(module, "fan_in_fan_out", False):
+                self.modules.append(module)
+            else:
+                self.modules.append(None)
+        self.splittable = [False] * len(self.params)
+
+        self.lm = next((getattr(model, p) for p in LM_PREFIXES if hasattr(model, p)), None)
+        self.stackable = None
+
+        self._replicas = 1
+        self._batch_size = None
+
+    @contextmanager
+    def _capture_logits(self):
+        captured = {}
+
+        def hook(module, args, kwargs, output):
+            captured["labels"] = kwargs.get("labels", None)
+            captured["logits"] = getattr(output, "logits", None)
+
+        handle = None
+        if self.lm is not None:
+            try:
+                handle = self.lm.register_forward_hook(hook, with_kwargs=True)
+            except TypeError:
+                # torch < 2.0, per-replica losses are not available
+                handle = None
+        try:
+            yield captured
+        finally:
+            if handle is not None:
+                handle.remove()
+
+    def _replica_losses(self, captured, n):
+        logits, labels = captured.get("logits", None), captured.get("labels", None)
+        if logits is None or labels is None or logits.shape[0] != labels.shape[0] or logits.shape[0] % n != 0:
+            return None
+        if not getattr(getattr(self.lm, "config", None), "is_encoder_decoder", True):
+            # causal language models predict the next token
+            logits, labels = logits[:, :-1], labels[:, 1:]
+        token_loss = F.cross_entropy(
+            logits.float().flatten(0, -2), labels.flatten(), ignore_index=-100, reduction="none"
+        ).view(n, -1)
+        num_tokens = labels.ne(-100).view(n, -1).sum(dim=1).clamp(min=1)
+        return token_loss.sum(dim=1) / num_tokens
+
+    @torch.no_grad()
+    def _probe(self, samples):
+        """
+        Run the first batch twice stacked to find the linears that can be
+        perturbed per replica and to check the per-replica losses against
+        the model loss.
+        """
+        size = batch_size(samples)
+        seen = {}
+        handles = [
+            m.register_forward_hook(partial(_record_rows, seen))
+            for m in set(m for m in self.modules if m is not None)
+        ]
+        try:
+            with self._capture_logits() as captured:
+                loss, _ = self.loss_func(self.model, _replicate(samples, 2, size), self.cuda_enabled)
+        finally:
+            for h in handles:
+                h.remove()
+
+        for i, module in enumerate(self.modules):
+            if module is not None and module not in seen:
+                # never called as a module, its weight is used elsewhere
+                self.modules[i] = None
+            self.splittable[i] = module is not None and module in seen and \
+                all(rows == 2 * size for rows in seen[module])
+
+        losses = self._replica_losses(captured, 2)
+        self.stackable = losses is not None and \
+            abs(float(losses.mean()) - float(loss)) <= 1e-2 * max(abs(float(loss)), 1.0)
+
+        num_in_place = sum(m is None for m in self.modules)
+        print(
+            f"Zeroth-order engine: {len(self.params) - num_in_place} tensors perturbed by hooks, "
+            f"{num_in_place} in place, stacked replicas {'on' if self.stackable else 'off'}"
+        )
+
+    def _cached_forward(self, cache, name, original, *args, **kwargs):
+        n, size = self._replicas, self._batch_size
+        if name not in cache:
+            cache[name] = original(
+                *[_take(a, n, size) for a in args], **{k: _take(v, n, size) for k, v in kwargs.items()}
+            )
+        return _repeat(cache[name], n)
+
+    @contextmanager
+    def _cached_features(self, cache):
+        # ``cache`` collects the features of the current batch, ``None`` disables caching
+        patched = []
+        if cache is not None:
+            modules = dict(self.model.named_modules())
+            for name in CACHEABLE_MODULES:
+                module = modules.get(name, None)
+                if module is None:
+                    continue
+                previous = module.__dict__.get("forward", None)
+                module.forward = partial(self._cached_forward, cache, name, module.forward)
+                patched.append((module, previous))
+        try:
+            yield
+        finally:
+            for module, previous in patched:
+                if previous is None:
+                    del module.forward
+                else:
+                    module.forward = previous
+
+    def _register_perturbations(self, replicas, size):
+        per_module = {}
+        for r, replica in enumerate(replicas):
+            rows = slice(r * size, (r + 1) * size) if size is not None else slice(None)
+            for i, seed, scale in replica:
+                per_module.setdefault(self.modules[i], []).append((rows, self.params[i], seed, scale))
+        return [m.register_forward_hook(partial(_perturb_output, p)) for m, p in per_module.items()]
+
+    def _stacked_losses(self, samples, replicas, size):
+        n = len(replicas)
+        self._replicas = n
+        handles = self._register_perturbations(replicas, size)
+        try:
+            with self._capture_logits() as captured:
+                self.loss_func(self.model, _replicate(samples, n, size), self.cuda_enabled)
+        finally:
+            for h in handles:
+                h.remove()
+        return self._replica_losses(captured, n).tolist()
+
+    def _single_loss(self, samples, replica):
+        self._replicas = 1
+        saved = []
+        for i, seed, scale in replica:
+            if self.modules[i] is None:
+                param = self.params[i]
+                saved.append((param, param.data.clone()))
+                param.data.add_(_noise(param, seed), alpha=scale)
+        hooked = [(i, seed, scale) for i, seed, scale in replica if self.modules[i] is not None]
+        handles = self._register_perturbations([hooked], None)
+        try:
+            loss, _ = self.loss_func(self.model, samples, self.cuda_enabled)
+        finally:
+            for h in handles:
+                h.remove()
+            for param, data in saved:
+                param.data.copy_(data)
+        return float(loss)
+
+    @torch.no_grad()
+    def losses(self, samples, replicas):
+        """
+        Loss of every perturbed model on ``samples``.
+
+        Args:
+            replicas (list): one list of ``(tensor_index, seed, scale)`` per
+                perturbed model, ``scale`` multiplies the unit Gaussian noise.
+
+        Returns:
+            list: one float per replica.
+        """
+        if self.stackable is None:
+            self._probe(samples)
+
+        self._batch_size = batch_size(samples)
+
+        # replicas perturbing the vision side cannot reuse the features, replicas
+        # with a tensor perturbed in place cannot be stacked
+        groups = {}
+        for r, replica in enumerate(replicas):
+            cache = not any(self.names[i].startswith(p) for i, _, _ in replica for p in VISION_PREFIXES)
+            stack = self.stackable and all(self.splittable[i] for i, _, _ in replica)
+            groups.setdefault((cache, stack), []).append(r)
+
+        losses = [None] * len(replicas)
+        features = {}
+        for (cache, stack), group in groups.items():
+            with self._cached_features(features if cache else None):
+                if stack:
+                    for start in range(0, len(group), self.max_replicas):
+                        chunk = group[start:start + self.max_replicas]
+                        chunk_losses = self._stacked_losses(samples, [replicas[r] for r in chunk], self._batch_size)
+                        for r, loss in zip(chunk, chunk_losses):
+                            losses[r] = loss
+                else:
+                    for r in group:
+                        losses[r] = self._single_loss(samples, replicas[r])
+        return losses
+
+    def directional_derivatives(self, samples, indices, num_directions):
+        """
+        MeZO estimates ``(L(theta + eps z) - L(theta - eps z)) / (2 eps)`` where
+        every tensor of ``indices`` is perturbed on its own, with
+        ``num_directions`` random directions each.
+
+        Returns:
+            torch.Tensor: ``(len(indices), num_directions)`` projected gradients.
+        """
+        seeds = np.random.randint(1000000000, size=(len(indices), num_directions))
+        replicas = []
+        for a, i in enumerate(indices):
+            for k in range(num_directions):
+                replicas.append([(i, seeds[a, k], self.eps)])
+                replicas.append([(i, seeds[a, k], -self.eps)])
+        losses = torch.tensor(self.losses(samples, replicas), dtype=torch.float64)
+        losses = losses.view(len(indices), num_directions, 2)
+        return (losses[..., 0] - losses[..., 1]) / (2 * self.eps)
+
+    def joint_directional_derivative(self, samples, seed):
+        """MeZO estimate for one direction perturbing all tensors together; see ``replay``."""
+        plus = [(i, tensor_seed(seed, i), self.eps) for i in range(len(self.params))]
+        minus = [(i, s, -scale) for i, s, scale in plus]
+        loss1, loss2 = self.losses(samples, [plus, minus])
+        return (loss1 - loss2) / (2 * self.eps)
+
+    @torch.no_grad()
+    def replay(self, index, seeds, coefficients):
+        """``sum_b coefficients[b] * z_b`` of one tensor, regenerating every joint direction from its seed."""
+        param = self.params[index]
+        out = torch.zeros(param.shape, dtype=torch.float32, device=param.device)
+        for seed, c in zip(seeds, coefficients):
+            out.add_(_noise(param, tensor_seed(seed, index)).float(), alpha=c)
+        return out
+
+
+def per_tensor_mezo_scores(engine, data_loader, num_samples, num_directions, sum_before_abs=False):
+    """
+    Per-tensor zeroth-order sensitivity, each tensor perturbed on its own.
+
+    Every calibration batch gets up to ``num_directions`` directions per tensor,
+    fewer once ``num_samples`` (counted once per direction) is reached. Per
+    batch the projected gradients are summed and the absolute value is taken
+    (``sum_before_abs``), or their absolute values are summed.
+
+    Returns:
+        list: one float per tensor of the engine.
+    """
+    indices = list(range(len(engine.params)))
+    scores = torch.zeros(len(indices), dtype=torch.float64)
+    accum_samples = 0
+    for d in data_loader:
+        if accum_samples >= num_samples:
+            break
+        size = batch_size(d)
+        k = min(num_directions, -(-(num_samples - accum_samples) // size))
+        accum_samples += k * size
+
+        projected_grads = engine.directional_derivatives(d, indices, k)
+        if sum_before_abs:
+            scores += projected_grads.sum(dim=1).abs()
+        else:
+            scores += projected_grads.abs().sum(dim=1)
+        print(f"zeroth-order scores: {min(accum_samples, num_samples)}/{num_samples} samples")
+    return scores.tolist()
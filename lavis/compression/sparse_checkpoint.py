@@ -0,0 +1,308 @@
+"""
+Compressed storage for pruned checkpoints.
+
+A pruned model saved with ``torch.save(model.state_dict())`` stores every
+zero explicitly. Here each sufficiently sparse weight matrix is stored as
+
+    * ``bitmap``: a 1-bit-per-element occupancy bitmap plus the surviving
+      values in row-major order (unstructured sparsity), or
+    * ``nm``: the ``m - n`` surviving values of every group of ``m``
+      consecutive input columns plus their in-group positions (N:M
+      semi-structured sparsity, ``n`` entries pruned per group as in the
+      pruners' ``prune_n``/``prune_m``).
+
+Boolean ``mask`` buffers of the LoRA layers are bit-packed as well. All
+remaining tensors are stored unchanged, so the file is a plain ``torch.save``
+payload and ``load_checkpoint`` transparently accepts both formats.
+"""
+
+import torch
+
+
+SPARSE_FORMAT_KEY = "__sparse_format__"
+SPARSE_FORMAT_VERSION = 1
+
+_BIT_WEIGHTS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+
+def pack_bitmap(mask):
+    """Pack a boolean tensor into a flat uint8 tensor, 8 elements per byte."""
+    flat = mask.reshape(-1).to(torch.uint8)
+    pad = (-flat.numel()) % 8
+    if pad:
+        flat = torch.cat([flat, flat.new_zeros(pad)])
+    weights = torch.tensor(_BIT_WEIGHTS, dtype=torch.uint8, device=flat.device)
+    return (flat.view(-1, 8) * weights).sum(dim=1, dtype=torch.uint8)
+
+
+def unpack_bitmap(packed, numel, shape=None):
+    """Inverse of ``pack_bitmap``; returns a boolean tensor of ``shape``."""
+    weights = torch.tensor(_BIT_WEIGHTS, dtype=torch.uint8, device=packed.device)
+    bits = (packed.view(-1, 1) & weights).ne(0).view(-1)[:numel]
+    if shape is not None:
+        bits = bits.view(shape)
+    return bits
+
+
+def is_nm_sparse(tensor, prune_n, prune_m):
+    """Whether every group of ``prune_m`` input columns has at least ``prune_n`` zeros."""
+    if prune_n <= 0 or prune_m <= 0 or tensor.dim() != 2 or tensor.shape[1] % prune_m != 0:
+        return False
+    groups = tensor.ne(0).view(tensor.shape[0], -1, prune_m).sum(dim=-1)
+    return bool((groups <= prune_m - prune_n).all())
+
+
+def _encode_bitmap(tensor):
+    nonzero = tensor.ne(0)
+    return {
+        "format": "bitmap",
+        "shape": tuple(tensor.shape),
+        "bitmap": pack_bitmap(nonzero),
+        "values": tensor[nonzero].clone(),
+    }
+
+
+def _encode_nm(tensor, prune_n, prune_m):
+    rows, cols = tensor.shape
+    groups = tensor.view(rows, cols // prune_m, prune_m)
+    # groups with more than n zeros keep some zeros, which is still exact
+    indices = torch.topk(groups.abs().float(), prune_m - prune_n, dim=-1, largest=True)[1]
+    indices = indices.sort(dim=-1)[0]
+    values = torch.gather(groups, -1, indices)
+    return {
+        "format": "nm",
+        "shape": (rows, cols),
+        "n": prune_n,
+        "m": prune_m,
+        "indices": indices.to(torch.uint8),
+        "values": values.clone(),
+    }
+
+
+def _decode(entry):
+    if entry["format"] == "bitmap":
+        shape = entry["shape"]
+        numel = 1
+        for s in shape:
+            numel *= s
+        nonzero = unpack_bitmap(entry["bitmap"], numel, shape)
+        values = entry["values"]
+        tensor = values.new_zeros(shape)
+        tensor[nonzero] = values
+        return tensor
+    elif entry["format"] == "nm":
+        rows, cols = entry["shape"]
+        values = entry["values"]
+        tensor = values.new_zeros(rows, cols // entry["m"], entry["m"])
+        tensor.scatter_(-1, entry["indices"].long(), values)
+        return tensor.view(rows, cols)
+    elif entry["format"] == "bitmask":
+        return unpack_bitmap(entry["bitmap"], entry["numel"], entry["shape"])
+    else:
+        raise NotImplementedError(f"Unknown sparse entry format {entry['format']}")
+
+
+def compress_state_dict(state_dict, prune_n=0, prune_m=0, min_sparsity=0.3):
+    """
+    Convert a dense state dict into the compressed checkpoint payload.
+
+    Args:
+        state_dict: the (pruned) model state dict.
+        prune_n, prune_m: N:M pattern used during pruning; ``0`` disables
+            N:M packing and falls back to the bitmap encoding.
+        min_sparsity: floating point matrices with a smaller fraction of
+            zeros are stored dense since the bitmap would not pay off.
+    """
+    dense, sparse = {}, {}
+    for k, v in state_dict.items():
+        if not torch.is_tensor(v):
+            dense[k] = v
+            continue
+
+        v = v.detach().cpu()
+        if v.dtype == torch.bool and v.dim() >= 1:
+            sparse[k] = {
+                "format": "bitmask",
+                "shape": tuple(v.shape),
+                "numel": v.numel(),
+                "bitmap": pack_bitmap(v),
+            }
+        elif v.is_floating_point() and v.dim() >= 2 and v.numel() > 0:
+            sparsity = 1.0 - float(v.count_nonzero()) / v.numel()
+            if sparsity < min_sparsity:
+                dense[k] = v
+            elif is_nm_sparse(v, prune_n, prune_m):
+                sparse[k] = _encode_nm(v, prune_n, prune_m)
+            else:
+                sparse[k] = _encode_bitmap(v)
+        else:
+            dense[k] = v
+
+    return {
+        SPARSE_FORMAT_KEY: SPARSE_FORMAT_VERSION,
+        "prune_n": prune_n,
+        "prune_m": prune_m,
+        "dense": dense,
+        "sparse": sparse,
+    }
+
+
+def is_sparse_checkpoint(checkpoint):
+    return isinstance(checkpoint, dict) and SPARSE_FORMAT_KEY in checkpoint
+
+
+def decompress_state_dict(checkpoint, keys=None):
+    """
+    Rebuild a dense state dict from a compressed payload.
+
+    If ``keys`` is given only those entries are materialized.
+    """
+    if not is_sparse_checkpoint(checkpoint):
+        if keys is None:
+            return checkpoint
+        return {k: v for k, v in checkpoint.items() if k in keys}
+
+    state_dict = {}
+    for k, v in checkpoint["dense"].items():
+        if keys is None or k in keys:
+            state_dict[k] = v
+    for k, entry in checkpoint["sparse"].items():
+        if keys is None or k in keys:
+            state_dict[k] = _decode(entry)
+    return state_dict
+
+
+def pruned_state_dict(model):
+    """
+    ``model.state_dict()`` with the weights outside the ``mask`` of every
+    masked layer set to zero, as after retraining with ``--sparse``. The
+    masked weights are copies on the host, the model is left untouched.
+    """
+    state_dict = model.state_dict()
+    for name, module in model.named_modules():
+        mask = getattr(module, "mask", None)
+        weight = getattr(module, "weight", None)
+        if not torch.is_tensor(mask) or not torch.is_tensor(weight) or mask.shape != weight.shape:
+            continue
+        prefix = name + "." if name else ""
+        state_dict[prefix + "weight"] = weight.detach().cpu() * mask.cpu()
+    return state_dict
+
+
+def save_sparse_checkpoint(state_dict, path, prune_n=0, prune_m=0, min_sparsity=0.3):
+    checkpoint = compress_state_dict(state_dict, prune_n=prune_n, prune_m=prune_m, min_sparsity=min_sparsity)
+
+    dense_bytes = sum(v.numel() * v.element_size() for v in state_dict.values() if torch.is_tensor(v))
+    torch.save(checkpoint, path)
+
+    stored_bytes = sum(v.numel() * v.element_size() for v in checkpoint["dense"].values() if torch.is_tensor(v))
+    for entry in checkpoint["sparse"].values():
+        stored_bytes += sum(
+            v.numel() * v.element_size() for v in entry.values() if torch.is_tensor(v)
+        )
+    print(
+        f"Saved sparse checkpoint to {path}: {stored_bytes / 1024 ** 3:.3f} GB "
+        f"(dense {dense_bytes / 1024 ** 3:.3f} GB, {len(checkpoint['sparse'])} compressed tensors)"
+    )
+
+
+def load_checkpoint(path, map_location="cpu"):
+    """Load a dense or compressed checkpoint and return a dense state dict."""
+    checkpoint = torch.load(path, map_location=map_location)
+    return decompress_state_dict(checkpoint)
+
+
+class LazyCheckpoint:
+    """
+    Memory-mapped view over a dense or compressed checkpoint.
+
+    The file is opened with ``torch.load(..., mmap=True)`` so tensor storages
+    stay on disk until they are indexed. Compressed entries are decoded one
+    tensor at a time on access. Older torch versions (or checkpoints in the
+    legacy non-zip format) fall back to a regular load.
+    """
+
+    def __init__(self, path, map_location="cpu"):
+        try:
+            checkpoint = torch.load(path, map_location=map_location, mmap=True)
+            self.mmap = True
+        except (TypeError, RuntimeError):
+            checkpoint = torch.load(path, map_location=map_location)
+            self.mmap = False
+
+        if is_sparse_checkpoint(checkpoint):
+            self._dense = checkpoint["dense"]
+            self._sparse = checkpoint["sparse"]
+        else:
+            self._dense = checkpoint
+            self._sparse = {}
+
+        self._index = sorted(list(self._dense.keys()) + list(self._sparse.keys()))
+
+    def keys(self):
+        return list(self._index)
+
+    def __contains__(self, key):
+        return key in self._dense or key in self._sparse
+
+    def __getitem__(self, key):
+        if key in self._sparse:
+            return _decode(self._sparse[key])
+        return self._dense[key]
+
+    def keys_with_prefix(self, prefix):
+        return [k for k in self._index if k.startswith(prefix)]
+
+    def find_prefix(self, candidate_prefixes):
+        for candidate_prefix in candidate_prefixes:
+            if any(k.startswith(candidate_prefix) for k in self._index):
+                return candidate_prefix
+        return None
+
+
+def load_into_module(checkpoint, module, prefix, strict=True, transforms=None):
+    """
+    Copy the tensors of ``checkpoint`` whose key starts with ``prefix`` into
+    ``module`` in place, one tensor at a time.
+
+    Args:
+        checkpoint: a ``LazyCheckpoint`` (or anything with ``keys_with_prefix``
+            and ``__getitem__``).
+        module: the target ``nn.Module``; its parameters and buffers are
+            overwritten with ``copy_`` so no second copy of the model is built.
+        prefix: checkpoint key prefix that is stripped before matching.
+        strict: raise on missing or unexpected keys, as ``load_state_dict``.
+        transforms: optional ``{name: fn}`` applied to a tensor before copying,
+            e.g. to interpolate position embeddings.
+    """
+    transforms = transforms or {}
+    target = module.state_dict(keep_vars=True)
+    mapping = {
+        k[len(prefix):].lstrip("."): k for k in checkpoint.keys_with_prefix(prefix)
+    }
+
+    missing = [k for k in target if k not in mapping]
+    unexpected = [k for k in mapping if k not in target]
+    if strict and (len(missing) > 0 or len(unexpected) > 0):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {module.__class__.__name__}: "
+            f"missing keys {missing}, unexpected keys {unexpected}"
+        )
+
+    with torch.no_grad():
+        for name, src_key in mapping.items():
+            if name not in target:
+                continue
+            value = checkpoint[src_key]
+            if name in transforms:
+                value = transforms[name](value)
+            dst = target[name]
+            if dst.shape != value.shape:
+                raise RuntimeError(
+                    f"size mismatch for {name}: copying a param with shape {tuple(value.shape)}, "
+                    f"the shape in current model is {tuple(dst.shape)}"
+                )
+            dst.data.copy_(value)
+            del value
+
+    return missing, unexpected
@@ -0,0 +1,245 @@
+"""
+Inference-time conversion of pruned linears into sparse-executing modules.
+
+After retraining, ``merge()`` folds the LoRA update into the weight and the
+pruned entries are zeroed, but every layer still runs a dense ``F.linear``.
+``convert_to_sparse_inference`` swaps the pruned linears of ``t5_model``,
+``llm_model`` and ``visual_encoder`` for ``SparseLinear`` modules:
+
+    * N:M masks with a 2:4 pattern use PyTorch's semi-structured sparse
+      storage on CUDA (fp16/bf16), which runs on the sparse tensor cores.
+    * Everything else is stored as CSR with int32 indices and multiplied with
+      ``torch.sparse.mm``.
+
+The pass measures a dense and a sparse matmul for a sample of converted
+layers on CPU and prints the speedup and memory saving.
+"""
+
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from lavis.compression.pruners.wanda_pruner import find_layers, get_module_recursive
+from lavis.compression.sparse_checkpoint import is_nm_sparse
+from lavis.peft.src.peft.tuners.lora import Linear
+
+try:
+    from torch.sparse import to_sparse_semi_structured
+except ImportError:
+    to_sparse_semi_structured = None
+
+
+def _tensor_bytes(t):
+    return t.numel() * t.element_size()
+
+
+def effective_weight(module):
+    """Weight a pruned (LoRA) linear applies at inference, as ``merge()`` would fold it."""
+    weight = module.weight.data
+    mask = getattr(module, "mask", None)
+    delta = None
+    if isinstance(module, Linear) and module.r > 0 and not module.merged and \
+            not module.disable_adapters and bool(module.lora_B.weight.any()):
+        delta = (module.lora_B.weight @ module.lora_A.weight).to(weight.dtype) * module.scaling
+        if module.fan_in_fan_out:
+            delta = delta.T
+
+    if torch.is_tensor(mask):
+        if delta is not None and module.sparse:
+            weight = (weight + delta) * mask
+        else:
+            weight = weight * mask
+            if delta is not None:
+                weight = weight + delta
+    elif delta is not None:
+        weight = weight + delta
+
+    if getattr(module, "fan_in_fan_out", False):
+        weight = weight.T
+    return weight
+
+
+class SparseLinear(nn.Module):
+    """
+    Linear layer executing a sparse weight.
+
+    Args:
+        weight (torch.Tensor): dense ``(out_features, in_features)`` weight with
+            the pruned entries set to zero.
+        bias (torch.Tensor): optional bias.
+        prune_n, prune_m (int): N:M pattern used during pruning.
+    """
+
+    def __init__(self, weight, bias=None, prune_n=0, prune_m=0, had_mask=False):
+        super().__init__()
+        self.out_features, self.in_features = weight.shape
+        self.dtype = weight.dtype
+        self.had_mask = had_mask
+
+        sparse_weight, self.format = None, "csr"
+        if (prune_n, prune_m) == (2, 4) and to_sparse_semi_structured is not None and weight.is_cuda and \
+                weight.dtype in [torch.float16, torch.bfloat16] and is_nm_sparse(weight, prune_n, prune_m):
+            try:
+                sparse_weight, self.format = to_sparse_semi_structured(weight), "semi_structured"
+            except (RuntimeError, ValueError):
+                sparse_weight = None
+
+        if sparse_weight is None:
+            csr = weight.to_sparse_csr()
+            sparse_weight = torch.sparse_csr_tensor(
+                csr.crow_indices().int(), csr.col_indices().int(), csr.values(),
+                size=weight.shape, dtype=weight.dtype, device=weight.device,
+            )
+
+        self.register_buffer("sparse_weight", sparse_weight, persistent=False)
+        self.register_buffer("bias", bias.detach().clone() if bias is not None else None, persistent=False)
+
+    def nbytes(self):
+        if self.format == "csr":
+            w = self.sparse_weight
+            size = _tensor_bytes(w.values()) + _tensor_bytes(w.crow_indices()) + _tensor_bytes(w.col_indices())
+        else:
+            size = sum(
+                _tensor_bytes(getattr(self.sparse_weight, attr)) for attr in ["packed", "meta"]
+                if torch.is_tensor(getattr(self.sparse_weight, attr, None))
+            )
+        if self.bias is not None:
+            size += _tensor_bytes(self.bias)
+        return size
+
+    def dense_weight(self):
+        return self.sparse_weight.to_dense()
+
+    def forward(self, x, dense=False, **kwargs):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1]).to(self.dtype)
+        if self.format == "semi_structured":
+            out = F.linear(x, self.sparse_weight)
+        else:
+            out = torch.sparse.mm(self.sparse_weight, x.t()).t()
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(*shape[:-1], self.out_features)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        # the dense weight with the LoRA update folded in; the LoRA entries are
+        # gone, so this does not load back into a LoRA model (train.py saves
+        # pruned checkpoints before the conversion)
+        destination[prefix + "weight"] = self.dense_weight()
+        if self.bias is not None:
+            destination[prefix + "bias"] = self.bias
+        if self.had_mask:
+            destination[prefix + "mask"] = self.dense_weight() != 0
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, format={self.format}"
+
+
+def _time_forward(fn, x, repeats):
+    fn(x)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(x)
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark_sparse_linear(weight, bias, prune_n=0, prune_m=0, tokens=32, repeats=10):
+    """Time a dense and a sparse float32 matmul of ``weight`` on CPU."""
+    weight = weight.detach().float().cpu()
+    bias = bias.detach().float().cpu() if bias is not None else None
+    sparse = SparseLinear(weight, bias, prune_n, prune_m)
+    x = torch.randn(tokens, weight.shape[1])
+
+    with torch.no_grad():
+        dense_time = _time_forward(lambda inp: F.linear(inp, weight, bias), x, repeats)
+        sparse_time = _time_forward(sparse, x, repeats)
+    return dense_time, sparse_time
+
+
+@torch.no_grad()
+def convert_to_sparse_inference(
+    model,
+    prefixes=("t5_model", "llm_model", "visual_encoder"),
+    prune_n=0,
+    prune_m=0,
+    min_sparsity=0.5,
+    num_benchmark_layers=8,
+    benchmark_tokens=32,
+):
+    """
+    Replace the pruned linears of ``model`` with ``SparseLinear`` modules in place.
+
+    Args:
+        model: the BLIP-2 model, the sub-models are looked up by ``prefixes``.
+        prune_n, prune_m (int): N:M pattern used during pruning.
+        min_sparsity (float): linears with a smaller fraction of zeros stay dense.
+        num_benchmark_layers (int): number of converted layers timed on CPU.
+        benchmark_tokens (int): number of input tokens used for the timing.
+
+    Returns:
+        dict: summary with the converted layers, the memory and the timings.
+    """
+    converted = []
+    dense_bytes, sparse_bytes = 0, 0
+    dense_time, sparse_time = 0.0, 0.0
+
+    for prefix in prefixes:
+        stem = getattr(model, prefix, None)
+        if stem is None:
+            continue
+
+        for name, module in find_layers(stem).items():
+            if not module.weight.is_floating_point():
+                continue
+            weight = effective_weight(module)
+            sparsity = 1.0 - float(weight.count_nonzero()) / weight.numel()
+            if sparsity < min_sparsity:
+                continue
+
+            sparse_module = SparseLinear(
+                weight, module.bias, prune_n, prune_m,
+                had_mask=torch.is_tensor(getattr(module, "mask", None)),
+            )
+
+            if len(converted) < num_benchmark_layers:
+                t_dense, t_sparse = benchmark_sparse_linear(
+                    weight, module.bias, prune_n, prune_m, tokens=benchmark_tokens
+                )
+                dense_time += t_dense
+                sparse_time += t_sparse
+
+            dense_bytes += _tensor_bytes(module.weight) + (_tensor_bytes(module.bias) if module.bias is not None else 0)
+            sparse_bytes += sparse_module.nbytes()
+
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(get_module_recursive(stem, parent_name), child_name, sparse_module)
+            converted.append(f"{prefix}.{name}")
+            del weight
+
+    summary = {
+        "num_converted": len(converted),
+        "converted": converted,
+        "dense_bytes": dense_bytes,
+        "sparse_bytes": sparse_bytes,
+        "dense_time": dense_time,
+        "sparse_time": sparse_time,
+    }
+
+    if len(converted) > 0:
+        print(f"Converted {len(converted)} linears to sparse execution")
+        print(
+            f"weight memory: {dense_bytes / 1024 ** 3:.3f} GB -> {sparse_bytes / 1024 ** 3:.3f} GB "
+            f"({(1 - sparse_bytes / dense_bytes) * 100:.1f}% saved)"
+        )
+        if sparse_time > 0:
+            print(
+                f"CPU matmul over {min(len(converted), num_benchmark_layers)} layers, {benchmark_tokens} tokens: "
+                f"dense {dense_time * 1000:.2f} ms, sparse {sparse_time * 1000:.2f} ms, "
+                f"speedup {dense_time / sparse_time:.2f}x"
+            )
+    else:
+        print(f"No linear reached {min_sparsity} sparsity, nothing converted")
+
+    return summary
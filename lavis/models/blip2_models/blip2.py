@@ -47,6 +47,22 @@ class Blip2Base(BaseModel):
         else:
             return contextlib.nullcontext()
 
+    def encode_image(self, image, vit_dense=False):
+        """
+        ``ln_vision(visual_encoder(image))``, served by ``self.image_feature_cache``
+        when one is attached (see image_feature_cache.py).
+        """
+        cache = getattr(self, "image_feature_cache", None)
+        if cache is not None:
+            return cache.encode(self, image, vit_dense)
+        return self.compute_image_embeds(image, vit_dense)
+
+    def compute_image_embeds(self, image, vit_dense=False):
+        with self.maybe_autocast():
+            if vit_dense:
+                return self.ln_vision(self.visual_encoder(image, vit_dense))
+            return self.ln_vision(self.visual_encoder(image))
+
     @classmethod
     def init_Qformer(cls, num_query_token, vision_width, cross_attention_freq=2):
         if os.path.isdir(local_paths["bert-base-uncased"]):
@@ -117,8 +117,7 @@ class Blip2T5(Blip2Base):
     def forward(self, samples, vit_dense=False, llm_dense=False):
         image = samples["image"]
 
-        with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image, vit_dense))
+        image_embeds = self.encode_image(image, vit_dense)
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
             image.device
         )
@@ -316,8 +315,7 @@ class Blip2T5(Blip2Base):
         """
         image = samples["image"]
 
-        with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
+        image_embeds = self.encode_image(image)
         image_embeds = image_embeds.float()
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
             image.device
@@ -392,8 +390,7 @@ class Blip2T5(Blip2Base):
         **kwargs
     ):
         image = samples["image"]
-        with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
+        image_embeds = self.encode_image(image)
         image_embeds = image_embeds.float()
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
             image.device
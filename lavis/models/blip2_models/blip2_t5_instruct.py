@@ -16,6 +16,7 @@ from transformers import T5TokenizerFast
 
 from lavis.common.registry import registry
 from lavis.models.blip2_models.blip2 import Blip2Base, disabled_train
+from lavis.models.blip2_models.candidate_ranking import rank_candidates
 from lavis.models.blip2_models.modeling_t5 import T5Config, T5ForConditionalGeneration
 from transformers.modeling_outputs import BaseModelOutput
 from lavis.common.utils import is_url, local_paths
@@ -140,8 +141,7 @@ class Blip2T5Instruct(Blip2Base):
         # print('-----------------')
 
         image = samples["image"]
-        with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image, vit_dense))
+        image_embeds = self.encode_image(image, vit_dense)
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
         query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
@@ -376,8 +376,7 @@ class Blip2T5Instruct(Blip2Base):
             inputs_t5 = torch.cat(inputs_t5, dim=1)
             atts_t5 = torch.cat(atts_t5, dim=1)
         else:
-            with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
+            image_embeds = self.encode_image(image)
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -485,38 +484,7 @@ class Blip2T5Instruct(Blip2Base):
         candidates,
         n_segments=1,
     ):
-        # If candidates is a list of lists, each sample has its candidates, then we need to iterate one by one
-        if type(candidates[0]) == list:
-            results = []
-
-            for i in range(samples["image"].size(0)):
-                this_sample = {
-                    "image": samples["image"][i].unsqueeze(0),
-                    "prompt": samples["prompt"],
-                }
-
-                if "text_input" in samples.keys():
-                    this_sample["text_input"] = [samples["text_input"][i]]
-
-                if 'context' in samples.keys():
-                    this_sample['context'] = [samples["context"][i]]
-
-                if 'history' in samples.keys():
-                    this_sample['history'] = [samples["history"][i]]
-
-                if 'caption' in samples.keys():
-                    this_sample['caption'] = [samples["caption"][i]]
-
-                this_result = self._predict_class(this_sample, candidates[i], n_segments)
-                results.append(this_result)
-
-            try:
-                results = torch.cat(results, dim=0)
-            except:
-                results = [res.tolist()[0] for res in results]
-
-            return results
-
+        # per-sample candidate lists are ranked in one batch as well, see candidate_ranking.py
         return self._predict_class(samples, candidates, n_segments)
 
     def _predict_class(
@@ -531,11 +499,11 @@ class Blip2T5Instruct(Blip2Base):
                 - image (torch.Tensor): A tensor of shape (batch_size, 3, H, W)
                 - prompt: the instruction
             candidates:
-                (list): A list of candidate class names;
+                (list): A list of candidate class names, or one such list per sample;
             n_segments:
-                (int): Split the candidates into n_segments and predict one by one. This is useful when the number of candidates is too large.
+                (int): Split the decoding steps into n_segments chunks. This is useful when the number of candidates is too large.
         Returns:
-            output_class: predicted class index
+            output_class: ranks of the candidates per sample, lists when the samples have different numbers of candidates
         """
 
         image = samples["image"]
@@ -609,8 +577,7 @@ class Blip2T5Instruct(Blip2Base):
             inputs_t5 = torch.cat(inputs_t5, dim=1)
             atts_t5 = torch.cat(atts_t5, dim=1)
         else:
-            with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
+            image_embeds = self.encode_image(image)
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -636,13 +603,16 @@ class Blip2T5Instruct(Blip2Base):
         input_tokens = self.t5_tokenizer(
             prompt, padding="longest", return_tensors="pt"
         ).to(image.device)
-        output_tokens = self.t5_tokenizer(
-            candidates, padding="longest", return_tensors="pt"
-        ).to(image.device)
 
         encoder_atts = torch.cat([atts_t5, input_tokens.attention_mask], dim=1)
 
-        n_cands = len(candidates)
+        if type(candidates[0]) == list:
+            candidate_ids = [self.t5_tokenizer(c).input_ids for c in candidates]
+        else:
+            candidate_ids = [self.t5_tokenizer(candidates).input_ids] * bs
+        max_rows = None
+        if n_segments > 1:
+            max_rows = max(sum(len(c) for c in candidate_ids) // n_segments, 1)
 
         with self.maybe_autocast(dtype=torch.bfloat16):
             inputs_embeds = self.t5_model.encoder.embed_tokens(input_tokens.input_ids)
@@ -653,64 +623,15 @@ class Blip2T5Instruct(Blip2Base):
                 attention_mask=encoder_atts,
             )
 
-            all_losses = []
-            for n in range(n_segments):
-                seg_len = n_cands // n_segments
-                if n == (n_segments - 1):
-                    seg_len = n_cands - seg_len * (n_segments - 1)
-
-                # this_encoder_outputs = copy.deepcopy(encoder_outputs)
-                this_encoder_outputs = BaseModelOutput(
-                    last_hidden_state=encoder_outputs[0].clone(),
-                )
-
-                this_encoder_outputs['last_hidden_state'] = this_encoder_outputs[0].repeat_interleave(seg_len, dim=0)
-                this_encoder_atts = encoder_atts.repeat_interleave(seg_len, dim=0)
-
-                start_i = n * (n_cands // n_segments)
-                end_i = start_i + seg_len
-                this_output_tokens_ids = output_tokens.input_ids[start_i:end_i].repeat(bs, 1)
-                this_output_tokens_atts = output_tokens.attention_mask[start_i:end_i].repeat(bs, 1)
-
-                this_targets = this_output_tokens_ids.masked_fill(this_output_tokens_ids == self.t5_tokenizer.pad_token_id, -100)
+            # the encoder runs once per sample, the candidates share its cross-attention state
+            all_losses = rank_candidates(
+                self.t5_model, encoder_outputs[0], encoder_atts, candidate_ids, max_rows=max_rows,
+            )
 
-                outputs = self.t5_model(
-                    encoder_outputs=this_encoder_outputs,
-                    attention_mask=this_encoder_atts,
-                    decoder_attention_mask=this_output_tokens_atts,
-                    return_dict=True,
-                    labels=this_targets,
-                    reduction="none",
-                )
-                loss = outputs.loss
-
-                loss = loss.reshape(bs, seg_len)
-                # output_class_ranks = torch.argsort(loss, dim=-1)
-                all_losses.append(loss)
-
-            all_losses = torch.cat(all_losses, dim=-1)
-            output_class_ranks = torch.argsort(all_losses, dim=-1)
-
-            # encoder_outputs['last_hidden_state'] = encoder_outputs[0].repeat_interleave(n_cands, dim=0)
-            # encoder_atts = encoder_atts.repeat_interleave(n_cands, dim=0)
-            # output_tokens.input_ids = output_tokens.input_ids.repeat(bs, 1)
-            # output_tokens.attention_mask = output_tokens.attention_mask.repeat(bs, 1)
-
-            # # compute the LM loss for each candidate (sum logprob across all tokens) and select the highest
-            # targets = output_tokens.input_ids.masked_fill(output_tokens.input_ids == self.t5_tokenizer.pad_token_id, -100)
-
-            # outputs = self.t5_model(
-            #     encoder_outputs=encoder_outputs,
-            #     attention_mask=encoder_atts,
-            #     decoder_attention_mask=output_tokens.attention_mask,
-            #     return_dict=True,
-            #     labels=targets,
-            #     reduction="none",
-            # )
-            # loss = outputs.loss
-
-            # loss = loss.reshape(bs, n_cands)
-            # output_class_ranks = torch.argsort(loss, dim=-1) # (bs, num_candidates)
+        ranks = [torch.argsort(loss, dim=-1) for loss in all_losses]
+        if len(set(len(r) for r in ranks)) > 1:
+            return [r.tolist() for r in ranks]
+        output_class_ranks = torch.stack(ranks)
 
         return output_class_ranks
 
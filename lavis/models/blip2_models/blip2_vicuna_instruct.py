@@ -158,8 +158,7 @@ class Blip2VicunaInstruct(Blip2Base):
     def forward(self, samples, vit_dense=False, llm_dense=False):
 
         image = samples["image"]
-        with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image, vit_dense))
+        image_embeds = self.encode_image(image, vit_dense)
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
         bs = image.size(0)
@@ -338,8 +337,7 @@ class Blip2VicunaInstruct(Blip2Base):
             inputs_llm = torch.cat(inputs_llm, dim=1)
             atts_llm = torch.cat(atts_llm, dim=1)
         else:
-            with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
+            image_embeds = self.encode_image(image)
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -561,8 +559,7 @@ class Blip2VicunaInstruct(Blip2Base):
             inputs_llm = torch.cat(inputs_llm, dim=1)
             atts_llm = torch.cat(atts_llm, dim=1)
         else:
-            with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
+            image_embeds = self.encode_image(image)
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -0,0 +1,158 @@
+"""
+Candidate ranking for the encoder-decoder (T5) BLIP-2 models.
+
+Ranking ``n`` candidates by their sequence loss used to repeat the encoder
+state ``n`` times and decode every candidate from scratch, so that every
+decoder layer projected the same encoder state to cross-attention keys and
+values ``n`` times. Here
+
+    * the cross-attention keys and values are projected once per sample (by
+      the first decoder step) and only gathered for the decoded rows,
+    * the candidates of all samples are merged into one prefix trie per
+      sample and decoded breadth first with the self-attention cache, so a
+      prefix shared by several candidates ("a red ...", "a blue ...") is
+      decoded once and every step batches the trie nodes of all samples.
+
+The loss of a candidate is the sum of the negative log-likelihoods of its
+tokens (end of sequence included), as the ``reduction="none"`` loss of
+``T5ForConditionalGeneration``.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+class _Trie:
+    def __init__(self, num_samples, start_token_id):
+        # node i: sample, parent node, token fed to reach it, depth
+        self.sample = list(range(num_samples))
+        self.parent = [-1] * num_samples
+        self.token = [start_token_id] * num_samples
+        self.depth = [0] * num_samples
+        self.children = [{} for _ in range(num_samples)]
+
+    def insert(self, sample, tokens):
+        """Add a candidate of ``sample``, returns the nodes along its path."""
+        node, path = sample, []
+        for t in tokens:
+            child = self.children[node].get(t)
+            if child is None:
+                child = len(self.token)
+                self.sample.append(sample)
+                self.parent.append(node)
+                self.token.append(t)
+                self.depth.append(self.depth[node] + 1)
+                self.children.append({})
+                self.children[node][t] = child
+            node = child
+            path.append(node)
+        return path
+
+
+def _index(values, device):
+    return torch.tensor(values, device=device, dtype=torch.long)
+
+
+def _decoder_step(t5_model, input_ids, encoder_hidden, encoder_atts, past_key_values):
+    outputs = t5_model.decoder(
+        input_ids=input_ids,
+        encoder_hidden_states=encoder_hidden,
+        encoder_attention_mask=encoder_atts,
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=True,
+    )
+    sequence_output = outputs.last_hidden_state[:, -1]
+    if t5_model.config.tie_word_embeddings:
+        sequence_output = sequence_output * (t5_model.model_dim ** -0.5)
+    log_probs = F.log_softmax(t5_model.lm_head(sequence_output).float(), dim=-1)
+    return log_probs, outputs.past_key_values
+
+
+@torch.no_grad()
+def rank_candidates(t5_model, encoder_hidden, encoder_atts, candidate_ids, max_rows=None):
+    """
+    Sequence losses of the candidates of every sample.
+
+    Args:
+        t5_model: ``T5ForConditionalGeneration``.
+        encoder_hidden: ``(batch_size, length, dim)`` encoder output.
+        encoder_atts: ``(batch_size, length)`` encoder attention mask.
+        candidate_ids (list): per sample, the token ids of its candidates,
+            each ending with the end of sequence token.
+        max_rows (int): trie nodes decoded per forward, bounds the memory.
+
+    Returns:
+        list: per sample, a float tensor with the loss of each candidate.
+    """
+    bs = encoder_hidden.size(0)
+    device = encoder_hidden.device
+    trie = _Trie(bs, t5_model.config.decoder_start_token_id)
+    paths = [[trie.insert(i, ids) for ids in candidates] for i, candidates in enumerate(candidate_ids)]
+
+    num_nodes = len(trie.token)
+    node_log_prob = torch.zeros(num_nodes, device=device)
+
+    def score_children(nodes, log_probs):
+        # log-probability of the edges from the decoded nodes to their children
+        rows, children, tokens = [], [], []
+        for row, node in enumerate(nodes):
+            for t, c in trie.children[node].items():
+                rows.append(row)
+                children.append(c)
+                tokens.append(t)
+        node_log_prob[_index(children, device)] = log_probs[_index(rows, device), _index(tokens, device)]
+
+    # roots: one step per sample, which also projects the cross-attention keys and values
+    log_probs, past = _decoder_step(
+        t5_model, _index(trie.token[:bs], device).unsqueeze(-1),
+        encoder_hidden, encoder_atts, None,
+    )
+    cross_past = [layer[2:] for layer in past]
+    self_past = [layer[:2] for layer in past]
+    row_of = {node: node for node in range(bs)}
+    score_children(list(range(bs)), log_probs)
+
+    # inner nodes breadth first; the leaves are end of sequence tokens and are not fed
+    frontier = [n for n in range(bs, num_nodes) if trie.depth[n] == 1 and trie.children[n]]
+    while frontier:
+        next_frontier, next_self_past, next_row_of = [], None, {}
+        step = max_rows or len(frontier)
+        for start in range(0, len(frontier), step):
+            nodes = frontier[start:start + step]
+            parent_rows = _index([row_of[trie.parent[n]] for n in nodes], device)
+            samples = _index([trie.sample[n] for n in nodes], device)
+            past = [
+                (k.index_select(0, parent_rows), v.index_select(0, parent_rows),
+                 ck.index_select(0, samples), cv.index_select(0, samples))
+                for (k, v), (ck, cv) in zip(self_past, cross_past)
+            ]
+            # the keys and values come from the cache, the encoder state only gives the shapes
+            log_probs, new_past = _decoder_step(
+                t5_model, _index([trie.token[n] for n in nodes], device).unsqueeze(-1),
+                encoder_hidden[:1].expand(len(nodes), -1, -1), encoder_atts.index_select(0, samples), past,
+            )
+            score_children(nodes, log_probs)
+
+            new_self = [layer[:2] for layer in new_past]
+            if next_self_past is None:
+                next_self_past = [[[k], [v]] for k, v in new_self]
+            else:
+                for acc, (k, v) in zip(next_self_past, new_self):
+                    acc[0].append(k)
+                    acc[1].append(v)
+            for n in nodes:
+                next_row_of[n] = len(next_row_of)
+                next_frontier.extend(c for c in trie.children[n].values() if trie.children[c])
+
+        self_past = [(torch.cat(k), torch.cat(v)) for k, v in next_self_past]
+        row_of, frontier = next_row_of, next_frontier
+
+    # sum the edges along the path of every candidate
+    nodes, owners = [], []
+    for c, path in enumerate(p for sample_paths in paths for p in sample_paths):
+        nodes.extend(path)
+        owners.extend([c] * len(path))
+    losses = torch.zeros(sum(len(sample_paths) for sample_paths in paths), device=device)
+    losses.index_add_(0, _index(owners, device), -node_log_prob[_index(nodes, device)])
+    return list(losses.split([len(sample_paths) for sample_paths in paths]))
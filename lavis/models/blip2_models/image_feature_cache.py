@@ -0,0 +1,295 @@
+"""
+Caches of the vision trunk outputs ``ln_vision(visual_encoder(image))`` of BLIP-2 models.
+
+When the vision encoder is frozen (retraining without V) or unpruned (only
+the language model is pruned) its output only depends on the image, so it
+does not have to be recomputed:
+
+    * ``ImageFeatureCache`` keeps the features in host memory during
+      retraining (and on disk with ``cache_dir``),
+    * ``ImageFeatureStore`` writes the features of evaluation splits to
+      memory-mapped files, so that evaluating other language model
+      sparsities skips the vision encoder.
+
+Entries are keyed by a hash of the processed image tensor, so only
+deterministic image processors produce hits; a randomly augmented view is a
+new image. The folders are named after a fingerprint of the vision encoder
+weights and masks (LoRA weights only while they change the features).
+
+Attach an instance as ``model.image_feature_cache``, see ``Blip2Base.encode_image``.
+"""
+
+import glob
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lavis.common.dist_utils import get_rank
+from lavis.compression.pruners.score_cache import model_fingerprint
+
+
+def _inactive_lora(module):
+    # LoRA weights that do not change the features: lora_B is zero (``reset_peft``
+    # re-randomizes lora_A on every ``merge``) or the update is merged already
+    names = []
+    for name, m in module.named_modules():
+        lora_B = getattr(m, "lora_B", None)
+        if isinstance(lora_B, nn.Linear) and (getattr(m, "merged", False) or not bool(lora_B.weight.any())):
+            prefix = name + "." if name else ""
+            names += [prefix + "lora_A.", prefix + "lora_B."]
+    return tuple(names)
+
+
+def vision_fingerprint(model):
+    # hashed on first use, once pruning has set the masks
+    h = hashlib.sha1()
+    for module in [model.visual_encoder, model.ln_vision]:
+        h.update(model_fingerprint(module, exclude=_inactive_lora(module), buffers=True).encode())
+    return h.hexdigest()
+
+
+def image_hashes(image):
+    host = image.detach().contiguous().cpu()
+    hashes = []
+    for img in host:
+        h = hashlib.sha1(f"{tuple(img.shape)}{img.dtype}".encode())
+        h.update(img.view(torch.uint8).numpy().tobytes())
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+class ImageFeatureCache:
+    """
+    Args:
+        cache_dir (str): folder the features are persisted in, ``None`` keeps
+            them in host memory only.
+        max_bytes (int): host memory budget of the features, the least
+            recently used ones are evicted beyond it.
+
+    An epoch after the first without a single hit means the images are never
+    seen twice (random augmentation): the cache then drops its entries and
+    passes the images through from then on.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=16 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.model_hash = None
+        self.entries = OrderedDict()  # (image hash, vit_dense) -> features on the host, least recent first
+        self.own = set()              # keys of the entries computed by this rank
+        self.num_bytes = 0
+        self.dirty = False
+        self.enabled = True
+        self.epochs = 0
+        self.lookups, self.hits = 0, 0
+
+    def _setup(self, model):
+        self.model_hash = vision_fingerprint(model)
+        if self.cache_dir is None:
+            return
+        folder = os.path.join(self.cache_dir, self.model_hash)
+        for path in sorted(glob.glob(os.path.join(folder, "rank*.pth"))):
+            shard = torch.load(path, map_location="cpu")
+            own = os.path.basename(path) == f"rank{get_rank()}.pth"
+            for k, f in shard.items():
+                self._insert(k, f, own)
+        print(f"image feature cache {folder}: {len(self.entries)} features")
+
+    def _insert(self, key, features, own):
+        self.entries[key] = features
+        self.num_bytes += features.numel() * features.element_size()
+        if own:
+            self.own.add(key)
+        while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+            k, f = self.entries.popitem(last=False)
+            self.num_bytes -= f.numel() * f.element_size()
+            self.own.discard(k)
+
+    @torch.no_grad()
+    def encode(self, model, image, vit_dense=False):
+        """The features of a batch of images, computing the missing ones only."""
+        if not self.enabled:
+            return model.compute_image_embeds(image, vit_dense)
+        if self.model_hash is None:
+            self._setup(model)
+
+        keys = [(h, bool(vit_dense)) for h in image_hashes(image)]
+        missing = [i for i, k in enumerate(keys) if k not in self.entries]
+        computed = {}
+        if missing:
+            features = model.compute_image_embeds(image[missing], vit_dense)
+            for i, f in zip(missing, features.cpu()):
+                computed[keys[i]] = f.clone()
+        for k in keys:
+            if k in self.entries:
+                self.entries.move_to_end(k)
+        for k, f in computed.items():
+            self._insert(k, f, own=True)
+        self.dirty = self.dirty or len(computed) > 0
+
+        self.lookups += len(keys)
+        self.hits += len(keys) - len(missing)
+        batch = [computed[k] if k in computed else self.entries[k] for k in keys]
+        return torch.stack(batch).to(image.device, non_blocking=True)
+
+    def save(self):
+        """End of an epoch: write the features computed by this rank, every rank has its own shard."""
+        print(f"image feature cache: {self.hits}/{self.lookups} hits, {len(self.entries)} features")
+        self.epochs += 1
+        if self.enabled and self.epochs > 1 and self.lookups > 0 and self.hits == 0:
+            print("image feature cache: no image was seen twice, caching is disabled")
+            self.enabled = False
+            self.entries, self.own, self.num_bytes, self.dirty = OrderedDict(), set(), 0, False
+        self.lookups, self.hits = 0, 0
+        if self.cache_dir is None or not self.dirty:
+            return
+        path = os.path.join(self.cache_dir, self.model_hash, f"rank{get_rank()}.pth")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + f".tmp{os.getpid()}"
+        torch.save({k: self.entries[k] for k in self.own}, tmp_path)
+        os.replace(tmp_path, path)
+        self.dirty = False
+
+
+def deterministic_processor(processor):
+    """
+    Whether an image processor maps an image to the same tensor every time,
+    ``None`` if it cannot be told. Only then can ``ImageFeatureCache`` hit.
+    """
+    transform = getattr(processor, "transform", None)
+    if transform is None:
+        return None
+    steps = getattr(transform, "transforms", [transform])
+    # torchvision's Random* transforms and LAVIS' RandomAugment
+    return not any(type(t).__name__.startswith("Random") for t in steps)
+
+
+class ImageFeatureStore:
+    """
+    Memory-mapped features of the (non-dense) vision trunk for evaluation.
+
+    Every rank appends the features it computes to ``rank{r}.bin`` and lists
+    their image hashes, dtype and shape in ``rank{r}.json`` under
+    ``<store_dir>/<vision fingerprint>``; ``flush`` commits the appended rows.
+    The next run reads all shards through ``np.memmap``.
+
+    Args:
+        store_dir (str): root folder of the store.
+        writable (bool): append the features missing from the store.
+    """
+
+    def __init__(self, store_dir, writable=True):
+        self.store_dir = store_dir
+        self.writable = writable
+        self.folder = None
+        self.index = {}       # image hash -> (shard, row)
+        self.shards = []      # (memmap of the rows as bytes, dtype, shape)
+        self.meta = None      # keys, dtype and shape of the shard of this rank
+        self._file = None
+        self._appended = set()
+        self.lookups, self.hits = 0, 0
+
+    def _setup(self, model):
+        self.folder = os.path.join(self.store_dir, vision_fingerprint(model))
+        for meta_path in sorted(glob.glob(os.path.join(self.folder, "rank*.json"))):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if os.path.basename(meta_path) == f"rank{get_rank()}.json":
+                self.meta = meta
+            if len(meta["keys"]) == 0:
+                continue
+            rows = np.memmap(
+                meta_path[:-len(".json")] + ".bin", dtype=np.uint8, mode="r",
+                shape=(len(meta["keys"]), meta["row_bytes"]),
+            )
+            shard = len(self.shards)
+            self.shards.append((rows, getattr(torch, meta["dtype"]), tuple(meta["shape"])))
+            for row, key in enumerate(meta["keys"]):
+                self.index.setdefault(key, (shard, row))
+        if self.meta is None:
+            self.meta = {"keys": [], "dtype": None, "shape": None, "row_bytes": None}
+        print(f"image feature store {self.folder}: {len(self.index)} features")
+
+    def _row(self, shard, row):
+        rows, dtype, shape = self.shards[shard]
+        return torch.from_numpy(np.array(rows[row])).view(dtype).reshape(shape)
+
+    def _append(self, keys, features):
+        if self._file is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._file = open(os.path.join(self.folder, f"rank{get_rank()}.bin"), "ab")
+            # rows of an interrupted run were never committed
+            self._file.truncate(len(self.meta["keys"]) * (self.meta["row_bytes"] or 0))
+        # questions of VQA sets share their images
+        rows = []
+        for i, k in enumerate(keys):
+            if k not in self._appended:
+                self._appended.add(k)
+                rows.append(i)
+        if len(rows) == 0:
+            return
+        keys = [keys[i] for i in rows]
+        features = features[rows].cpu().contiguous()
+        if self.meta["dtype"] is None:
+            self.meta["dtype"] = str(features.dtype).replace("torch.", "")
+            self.meta["shape"] = list(features.shape[1:])
+            self.meta["row_bytes"] = features[0].numel() * features.element_size()
+        self._file.write(features.view(torch.uint8).numpy().tobytes())
+        self.meta["keys"].extend(keys)
+
+    @torch.no_grad()
+    def encode(self, model, image, vit_dense=False):
+        """The stored features of a batch, the missing ones are computed (and appended)."""
+        if self.folder is None:
+            self._setup(model)
+        if vit_dense:
+            return model.compute_image_embeds(image, vit_dense)
+
+        keys = image_hashes(image)
+        found = [self.index.get(k) for k in keys]
+        missing = [i for i, f in enumerate(found) if f is None]
+        self.lookups += len(keys)
+        self.hits += len(keys) - len(missing)
+        if len(missing) == len(keys):
+            features = model.compute_image_embeds(image)
+            if self.writable:
+                self._append(keys, features)
+            return features
+
+        stored = torch.stack([self._row(*f) for f in found if f is not None]).to(image.device)
+        features = stored.new_empty((len(keys),) + tuple(stored.shape[1:]))
+        features[[i for i, f in enumerate(found) if f is not None]] = stored
+        if missing:
+            computed = model.compute_image_embeds(image[missing])
+            features[missing] = computed.to(features.dtype)
+            if self.writable:
+                self._append([keys[i] for i in missing], computed)
+        return features
+
+    def flush(self):
+        """Commit the appended rows of this rank."""
+        print(f"image feature store: {self.hits}/{self.lookups} hits")
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        meta_path = os.path.join(self.folder, f"rank{get_rank()}.json")
+        tmp_path = meta_path + f".tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, meta_path)
+
+    @torch.no_grad()
+    def extract(self, model, data_loader, cuda_enabled=True):
+        """Offline pass writing the features of the images of ``data_loader``, ``--extract_image_features`` of train.py."""
+        from lavis.datasets.data_utils import prepare_sample
+
+        for samples in data_loader:
+            samples = prepare_sample(samples, cuda_enabled=cuda_enabled)
+            self.encode(model, samples["image"])
+        self.flush()
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import importlib
+import itertools
 import math
 import re
 import warnings
@@ -23,6 +24,7 @@ from typing import List, Optional, Union
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.cuda.amp import custom_bwd, custom_fwd
 from transformers.pytorch_utils import Conv1D
 
 from ..utils import PeftConfig, PeftType, transpose
@@ -286,6 +288,162 @@ class LoraLayer:
         self.disable_adapters = False
         
 
+_MASK_BIT_WEIGHTS = [1, 2, 4, 8, 16, 32, 64, 128]
+_NM_PATTERNS = {}
+
+
+def _pack_rows(bits):
+    # (rows, cols) bool -> (rows, ceil(cols / 8)) uint8, each row packed on its own
+    rows, cols = bits.shape
+    bits = bits.to(torch.uint8)
+    if cols % 8:
+        bits = F.pad(bits, (0, 8 - cols % 8))
+    weights = torch.tensor(_MASK_BIT_WEIGHTS, dtype=torch.uint8, device=bits.device)
+    return (bits.view(rows, -1, 8) * weights).sum(dim=-1, dtype=torch.uint8)
+
+
+def _unpack_rows(packed, cols):
+    weights = torch.tensor(_MASK_BIT_WEIGHTS, dtype=torch.uint8, device=packed.device)
+    return (packed.unsqueeze(-1) & weights).ne(0).view(packed.shape[0], -1)[:, :cols]
+
+
+def _nm_patterns(prune_n, prune_m, device):
+    # all keep-patterns of a group of prune_m entries with prune_n of them pruned
+    if (prune_n, prune_m) not in _NM_PATTERNS:
+        kept = list(itertools.combinations(range(prune_m), prune_m - prune_n))
+        patterns = torch.zeros(len(kept), prune_m, dtype=torch.bool)
+        for i, k in enumerate(kept):
+            patterns[i, list(k)] = True
+        _NM_PATTERNS[(prune_n, prune_m)] = patterns
+    return _NM_PATTERNS[(prune_n, prune_m)].to(device)
+
+
+def _code_bits(num_patterns):
+    return max(1, math.ceil(math.log2(num_patterns)))
+
+
+def pack_mask(mask, prune_n=0, prune_m=0):
+    """
+    Bit-pack a 2D boolean keep-mask row by row.
+
+    If every group of ``prune_m`` consecutive columns keeps exactly
+    ``prune_m - prune_n`` entries, each group is stored as the index of its
+    pattern among all possible ones (3 bits per 4 weights for 2:4), otherwise
+    every weight takes one bit.
+
+    Returns:
+        torch.Tensor: the packed uint8 mask, one row per mask row.
+        tuple: ``(kind, rows, cols, prune_n, prune_m)`` needed by ``unpack_mask``.
+    """
+    rows, cols = mask.shape
+    mask = mask.bool()
+    if 0 < prune_n < prune_m <= 16 and cols % prune_m == 0:
+        patterns = _nm_patterns(prune_n, prune_m, mask.device)
+        powers = 2 ** torch.arange(prune_m, dtype=torch.int32, device=mask.device)
+        lookup = torch.full((2 ** prune_m,), -1, dtype=torch.long, device=mask.device)
+        lookup[(patterns.int() * powers).sum(dim=-1).long()] = torch.arange(patterns.shape[0], device=mask.device)
+        codes = lookup[(mask.view(rows, -1, prune_m).int() * powers).sum(dim=-1).long()]
+        if bool((codes >= 0).all()):
+            shifts = torch.arange(_code_bits(patterns.shape[0]), device=mask.device)
+            bits = (codes.unsqueeze(-1) >> shifts) & 1
+            return _pack_rows(bits.view(rows, -1).bool()), ("nm", rows, cols, prune_n, prune_m)
+    return _pack_rows(mask), ("bitmap", rows, cols, prune_n, prune_m)
+
+
+def unpack_mask(packed, mask_format, start=None, end=None):
+    """Inverse of ``pack_mask``, restricted to the rows ``start:end`` if given."""
+    kind, rows, cols, prune_n, prune_m = mask_format
+    if start is not None:
+        packed = packed[start:end]
+    if kind == "bitmap":
+        return _unpack_rows(packed, cols)
+
+    patterns = _nm_patterns(prune_n, prune_m, packed.device)
+    code_bits = _code_bits(patterns.shape[0])
+    groups = cols // prune_m
+    bits = _unpack_rows(packed, groups * code_bits).reshape(packed.shape[0], groups, code_bits)
+    codes = (bits.long() << torch.arange(code_bits, device=packed.device)).sum(dim=-1)
+    return patterns[codes].view(packed.shape[0], cols)
+
+
+def _mask_rows(mask, mask_format, start, end):
+    if mask_format is None:
+        return mask[start:end]
+    return unpack_mask(mask, mask_format, start, end)
+
+
+def _effective_weight_rows(weight, mask_rows, lora_A, lora_B, scaling, sparse, start, end):
+    delta = (lora_B[start:end] @ lora_A).to(weight.dtype) * scaling
+    if sparse:
+        return (weight[start:end] + delta) * mask_rows
+    return weight[start:end] * mask_rows + delta
+
+
+class SparseLoraLinearFunction(torch.autograd.Function):
+    """
+    ``F.linear(x, W_eff, bias)`` for a frozen weight with a masked LoRA update,
+    ``W_eff = (W + scaling * B @ A) * mask`` when ``sparse`` and
+    ``W * mask + scaling * B @ A`` otherwise.
+
+    The effective weight and its gradient are only formed ``chunk_size``
+    output rows at a time, and the backward recomputes them from ``W``,
+    ``mask``, ``A`` and ``B``. Autograd therefore keeps no full-size delta,
+    masked weight or weight gradient per layer. A packed ``mask`` (see
+    ``pack_mask``) is passed with its ``mask_format`` and unpacked one chunk
+    at a time as well.
+    """
+
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, x, weight, mask, lora_A, lora_B, bias, scaling, sparse, chunk_size, mask_format=None):
+        ctx.scaling, ctx.sparse, ctx.chunk_size, ctx.mask_format = scaling, sparse, chunk_size, mask_format
+        ctx.save_for_backward(x, weight, mask, lora_A, lora_B, bias)
+
+        outs = []
+        for start in range(0, weight.shape[0], chunk_size):
+            end = min(start + chunk_size, weight.shape[0])
+            mask_rows = _mask_rows(mask, mask_format, start, end)
+            w = _effective_weight_rows(weight, mask_rows, lora_A, lora_B, scaling, sparse, start, end)
+            outs.append(F.linear(x, w, bias[start:end] if bias is not None else None))
+        return torch.cat(outs, dim=-1)
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_output):
+        x, weight, mask, lora_A, lora_B, bias = ctx.saved_tensors
+        scaling, sparse, chunk_size, mask_format = ctx.scaling, ctx.sparse, ctx.chunk_size, ctx.mask_format
+
+        grad_output = grad_output.reshape(-1, grad_output.shape[-1])
+        x_2d = x.reshape(-1, x.shape[-1]).to(grad_output.dtype)
+
+        grad_x = torch.zeros_like(x_2d) if ctx.needs_input_grad[0] else None
+        grad_A = torch.zeros(lora_A.shape, dtype=torch.float32, device=lora_A.device)
+        grad_B = torch.empty(lora_B.shape, dtype=torch.float32, device=lora_B.device)
+
+        for start in range(0, weight.shape[0], chunk_size):
+            end = min(start + chunk_size, weight.shape[0])
+            g = grad_output[:, start:end]
+            mask_rows = _mask_rows(mask, mask_format, start, end)
+            if grad_x is not None:
+                w = _effective_weight_rows(weight, mask_rows, lora_A, lora_B, scaling, sparse, start, end)
+                grad_x += g @ w.to(g.dtype)
+
+            grad_w = g.t() @ x_2d
+            if sparse:
+                grad_w = grad_w * mask_rows
+            grad_w = grad_w.float() * scaling
+            grad_B[start:end] = grad_w @ lora_A.float().t()
+            grad_A += lora_B[start:end].float().t() @ grad_w
+
+        grad_bias = None
+        if bias is not None and ctx.needs_input_grad[5]:
+            grad_bias = grad_output.sum(dim=0).to(bias.dtype)
+        if grad_x is not None:
+            grad_x = grad_x.view(x.shape).to(x.dtype)
+
+        return grad_x, None, None, grad_A.to(lora_A.dtype), grad_B.to(lora_B.dtype), grad_bias, None, None, None, None
+
+
 class Linear(nn.Linear, LoraLayer):
     # Lora implemented in a dense layer
     def __init__(
@@ -316,6 +474,10 @@ class Linear(nn.Linear, LoraLayer):
         # self.mask = 1.
         self.register_buffer("mask", torch.ones_like(self.weight.data).bool())
         self.sparse = False
+        # rows per chunk of the memory-lean training forward, 0 disables it
+        self.chunk_size = 0
+        self._weight_cache = None
+        self._weight_cache_key = None
 
     def reset_parameters(self):
         nn.Linear.reset_parameters(self)
@@ -329,9 +491,108 @@ class Linear(nn.Linear, LoraLayer):
             # initialize A the same way as the default for nn.Linear and B to zero
             nn.init.kaiming_uniform_(self.lora_A.weight, a=math.sqrt(5))
             nn.init.zeros_(self.lora_B.weight)
+        self.invalidate_weight_cache()
+
+    def invalidate_weight_cache(self):
+        self._weight_cache = None
+        self._weight_cache_key = None
+
+    def __getattr__(self, name):
+        if name == "mask":
+            buffers = self.__dict__.get("_buffers", {})
+            if "mask_packed" in buffers:
+                return unpack_mask(buffers["mask_packed"], self.__dict__["mask_format"])
+        return super().__getattr__(name)
+
+    def __setattr__(self, name, value):
+        if name == "mask" and torch.is_tensor(value) and "mask_packed" in self.__dict__.get("_buffers", {}):
+            self.set_packed_mask(value, *self.mask_format[3:])
+        else:
+            super().__setattr__(name, value)
+
+    def set_packed_mask(self, mask, prune_n=0, prune_m=0):
+        """
+        Store the keep-mask bit-packed (see ``pack_mask``) in the ``mask_packed``
+        buffer instead of the boolean ``mask`` buffer.
+
+        ``self.mask`` keeps returning the boolean mask, unpacked on access, and
+        assigning to it packs the new mask again. The chunked training forward
+        unpacks one chunk of rows at a time.
+        """
+        packed, mask_format = pack_mask(mask.to(self.weight.device), prune_n, prune_m)
+        self._buffers.pop("mask", None)
+        self.mask_format = mask_format
+        if "mask_packed" in self._buffers:
+            self._buffers["mask_packed"] = packed
+        else:
+            self.register_buffer("mask_packed", packed)
+        self.invalidate_weight_cache()
+
+    def unpack_mask(self):
+        """Go back to the boolean ``mask`` buffer."""
+        if "mask_packed" not in self._buffers:
+            return
+        mask = self.mask
+        del self._buffers["mask_packed"]
+        self.register_buffer("mask", mask)
+        self.invalidate_weight_cache()
+
+    def _stored_mask(self):
+        # the mask buffer as stored and the format needed to unpack it
+        if "mask_packed" in self._buffers:
+            return self._buffers["mask_packed"], self.mask_format
+        return self.mask, None
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        if "mask_packed" in self._buffers:
+            # keep the checkpoint layout of the boolean mask
+            destination.pop(prefix + "mask_packed", None)
+            destination[prefix + "mask"] = self.mask
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        mask_format = self.mask_format if "mask_packed" in self._buffers else None
+        if mask_format is not None:
+            self.unpack_mask()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        if mask_format is not None:
+            self.set_packed_mask(self._buffers["mask"], *mask_format[3:])
+
+    def _cache_key(self):
+        # in-place updates bump ``_version``, re-assignments change the storage;
+        # writes through ``weight.data`` bump neither reliably and must call
+        # ``invalidate_weight_cache`` (see ``pruners.utils.zero_pruned_weights``)
+        tensors = (self.weight, self.lora_A.weight, self.lora_B.weight, self._stored_mask()[0])
+        return tuple((t.data_ptr(), t._version) for t in tensors) + (self.sparse, self.scaling, self.fan_in_fan_out)
+
+    def _compute_effective_weight(self):
+        previous_dtype = self.weight.dtype
+        delta = transpose((self.lora_B.weight @ self.lora_A.weight).to(previous_dtype), self.fan_in_fan_out) * self.scaling
+        if self.sparse:
+            weight = (self.weight + delta) * self.mask
+        else:
+            weight = self.weight * self.mask + delta
+        return transpose(weight, self.fan_in_fan_out)
+
+    def effective_weight(self):
+        """
+        Masked weight with the LoRA update folded in, as used by ``forward``.
+
+        In eval mode without autograd it is built once and reused until the
+        weight, the LoRA parameters or the mask change, or ``train`` is called.
+        """
+        if self.training or torch.is_grad_enabled():
+            return self._compute_effective_weight()
+
+        key = self._cache_key()
+        if self._weight_cache is None or self._weight_cache_key != key:
+            self._weight_cache = self._compute_effective_weight()
+            self._weight_cache_key = key
+        return self._weight_cache
 
     def train(self, mode: bool = True):
 
+        self.invalidate_weight_cache()
         nn.Linear.train(self, mode)
         self.lora_A.train(mode)
         self.lora_B.train(mode)
@@ -361,18 +622,15 @@ class Linear(nn.Linear, LoraLayer):
         if dense or self.disable_adapters: 
             result = F.linear(x, transpose(self.weight, self.fan_in_fan_out), bias=self.bias)
         elif self.r > 0 and not self.merged:
-            if self.sparse:
-                result = F.linear(x, 
-                                transpose((self.weight + 
-                                            transpose((self.lora_B.weight @ self.lora_A.weight).to(previous_dtype), 
-                                            self.fan_in_fan_out) * self.scaling) * self.mask, self.fan_in_fan_out), 
-                                bias=self.bias)
+            if self.chunk_size > 0 and self.training and torch.is_grad_enabled() and \
+                    not self.weight.requires_grad and not self.fan_in_fan_out:
+                mask, mask_format = self._stored_mask()
+                result = SparseLoraLinearFunction.apply(
+                    x, self.weight, mask, self.lora_A.weight, self.lora_B.weight, self.bias,
+                    self.scaling, self.sparse, self.chunk_size, mask_format,
+                )
             else:
-                result = F.linear(x, 
-                                transpose(self.weight * self.mask + 
-                                            transpose((self.lora_B.weight @ self.lora_A.weight).to(previous_dtype), 
-                                            self.fan_in_fan_out) * self.scaling, self.fan_in_fan_out), 
-                                bias=self.bias)
+                result = F.linear(x, self.effective_weight(), bias=self.bias)
         else:
             result = F.linear(x, transpose(self.weight, self.fan_in_fan_out), bias=self.bias)
 
@@ -382,11 +640,12 @@ class Linear(nn.Linear, LoraLayer):
         return result
             
     def merge(self):
+        mask = self.mask
         if self.sparse:
             self.weight.data += (transpose(self.lora_B.weight @ self.lora_A.weight,
-                                           self.fan_in_fan_out) * self.scaling) * self.mask
+                                           self.fan_in_fan_out) * self.scaling) * mask
         else:
-            self.weight.data[~self.mask] = 0  
+            self.weight.data[~mask] = 0  
             self.weight.data += (transpose(self.lora_B.weight @ self.lora_A.weight,
                                            self.fan_in_fan_out) * self.scaling)
 
@@ -433,6 +692,8 @@ class MergedLinear(nn.Linear, LoraLayer):
         self.reset_parameters()
         if fan_in_fan_out:
             self.weight.data = self.weight.data.T
+        self._weight_cache = None
+        self._weight_cache_key = None
 
     def reset_parameters(self):
         nn.Linear.reset_parameters(self)
@@ -447,7 +708,40 @@ class MergedLinear(nn.Linear, LoraLayer):
         result[:, self.lora_ind] = x.reshape(-1, self.out_features // len(self.enable_lora) * sum(self.enable_lora))
         return result.view((*x.shape[:-1], self.out_features))
 
+    def invalidate_weight_cache(self):
+        self._weight_cache = None
+        self._weight_cache_key = None
+
+    def _cache_key(self):
+        tensors = (self.weight, self.lora_A.weight, self.lora_B.weight)
+        return tuple((t.data_ptr(), t._version) for t in tensors) + (self.scaling, self.fan_in_fan_out)
+
+    def _compute_effective_weight(self):
+        delta_w = (
+            F.conv1d(
+                self.lora_A.weight.unsqueeze(0),
+                self.lora_B.weight,
+                groups=sum(self.enable_lora),
+            )
+            .squeeze(0)
+            .transpose(-2, -1)
+        )
+        delta_w = delta_w.to(self.weight.dtype)
+        return self.weight + transpose(self.zero_pad(delta_w * self.scaling), not self.fan_in_fan_out)
+
+    def effective_weight(self):
+        """Weight with the LoRA update folded in, cached in eval mode without autograd."""
+        if self.training or torch.is_grad_enabled():
+            return self._compute_effective_weight()
+
+        key = self._cache_key()
+        if self._weight_cache is None or self._weight_cache_key != key:
+            self._weight_cache = self._compute_effective_weight()
+            self._weight_cache_key = key
+        return self._weight_cache
+
     def train(self, mode: bool = True):
+        self.invalidate_weight_cache()
         nn.Linear.train(self, mode)
         self.lora_A.train(mode)
         self.lora_B.train(mode)
@@ -490,6 +784,8 @@ class MergedLinear(nn.Linear, LoraLayer):
             result = F.linear(x, transpose(self.weight, self.fan_in_fan_out), bias=self.bias)
         elif self.merged:
             result = F.linear(x, transpose(self.weight, self.fan_in_fan_out), bias=self.bias)
+        elif self.r > 0 and any(self.enable_lora) and not self.training and not torch.is_grad_enabled():
+            result = F.linear(x, transpose(self.effective_weight(), self.fan_in_fan_out), bias=self.bias)
         else:
             result = F.linear(x, transpose(self.weight, self.fan_in_fan_out), bias=self.bias)
             if self.r > 0:
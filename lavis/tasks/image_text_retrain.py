@@ -13,6 +13,8 @@ from lavis.tasks.base_task import BaseTask
 from lavis.common.logger import MetricLogger
 from lavis.datasets.data_utils import prepare_sample
 from lavis.common.logger import MetricLogger, SmoothedValue
+from lavis.models.blip2_models.image_feature_cache import ImageFeatureCache
+from lavis.tasks.teacher_cache import TeacherLogitCache, topk_kl_div
 from torch.nn import KLDivLoss
 import torch.nn.functional as F
 
@@ -24,6 +26,15 @@ class ImageTextRetrainTask(BaseTask):
         super().__init__()
         self.kl_weight = 0.01
         self.T = 2. 
+        # dense-teacher outputs cached on disk, see teacher_cache.py
+        self.teacher_cache_dir = None
+        self.teacher_topk = 64
+        self.teacher_cache = None
+        # outputs of the vision trunk reused while it is frozen
+        self.cache_frozen_vision = False
+        self.vision_cache_dir = None
+        self.vision_cache_max_gb = 16
+        self.image_feature_cache = None
         
     def evaluation(self, model, data_loader, cuda_enabled=True):
         metric_logger = MetricLogger(delimiter="  ")
@@ -138,6 +149,22 @@ class ImageTextRetrainTask(BaseTask):
             header = header + "; inner epoch [{}]".format(inner_epoch)
 
         kl_fnt = KLDivLoss(reduction="batchmean", log_target=True)
+        if self.teacher_cache_dir and self.teacher_cache is None:
+            self.teacher_cache = TeacherLogitCache(self.teacher_cache_dir, model, self.T, self.teacher_topk)
+
+        # the dense and sparse passes of a frozen vision encoder are computed
+        # once per image, only the trainable part of the graph runs every step
+        unwrapped = getattr(model, "module", model)
+        vision_frozen = hasattr(unwrapped, "visual_encoder") and not any(
+            p.requires_grad for m in [unwrapped.visual_encoder, unwrapped.ln_vision] for p in m.parameters()
+        )
+        if self.cache_frozen_vision and vision_frozen:
+            if self.image_feature_cache is None:
+                self.image_feature_cache = ImageFeatureCache(
+                    self.vision_cache_dir, int(self.vision_cache_max_gb * 1024 ** 3)
+                )
+            unwrapped.image_feature_cache = self.image_feature_cache
+
         for i in metric_logger.log_every(range(iters_per_epoch), log_freq, header):
             # if using iter-based runner, we stop after iters_per_epoch iterations.
             if i >= iters_per_epoch:
@@ -156,18 +183,28 @@ class ImageTextRetrainTask(BaseTask):
 
             lr_scheduler.step(cur_epoch=inner_epoch, cur_step=i)
 
-            model.eval()
-            with torch.no_grad():
-                with torch.cuda.amp.autocast(enabled=use_amp):
-                    _, logits_DD = self.train_step(model=model, samples=samples, vit_dense=True, llm_dense=True)
-                    # _, logits_DS = self.train_step(model=model, samples=samples, vit_dense=True, llm_dense=False)
-                    # _, logits_SD = self.train_step(model=model, samples=samples, vit_dense=False, llm_dense=True)
+            teacher = None
+            if self.teacher_cache is not None:
+                teacher = self.teacher_cache.lookup(samples, samples["image"].device)
+
+            if teacher is None:
+                model.eval()
+                with torch.no_grad():
+                    with torch.cuda.amp.autocast(enabled=use_amp):
+                        _, logits_DD = self.train_step(model=model, samples=samples, vit_dense=True, llm_dense=True)
+                        # _, logits_DS = self.train_step(model=model, samples=samples, vit_dense=True, llm_dense=False)
+                        # _, logits_SD = self.train_step(model=model, samples=samples, vit_dense=False, llm_dense=True)
+                if self.teacher_cache is not None:
+                    teacher = self.teacher_cache.add(samples, logits_DD)
                     
             model.train()
             with torch.cuda.amp.autocast(enabled=use_amp):
                 loss, logits_SS = self.train_step(model=model, samples=samples, vit_dense=False, llm_dense=False)
 
-            kl_loss = kl_fnt(F.log_softmax(logits_SS / self.T, -1), F.log_softmax(logits_DD / self.T, -1)) 
+            if teacher is not None:
+                kl_loss = topk_kl_div(logits_SS, teacher, self.T)
+            else:
+                kl_loss = kl_fnt(F.log_softmax(logits_SS / self.T, -1), F.log_softmax(logits_DD / self.T, -1)) 
 
             # kl_loss = kl_fnt(F.log_softmax(logits_SS / self.T, -1), F.log_softmax(logits_DS / self.T, -1)) + \
             #             + kl_fnt(F.log_softmax(logits_SS / self.T, -1), F.log_softmax(logits_SD / self.T, -1))
@@ -193,6 +230,13 @@ class ImageTextRetrainTask(BaseTask):
             metric_logger.update(loss=loss.item())
             metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
+        if self.teacher_cache is not None:
+            self.teacher_cache.save()
+        if getattr(unwrapped, "image_feature_cache", None) is not None:
+            self.image_feature_cache.save()
+            # merging the LoRA weights after training changes the encoder
+            unwrapped.image_feature_cache = None
+
         # after train_epoch()
         # gather the stats from all processes
         metric_logger.synchronize_between_processes()
@@ -0,0 +1,146 @@
+"""
+Disk cache of the dense-teacher outputs of RESSA retraining.
+
+The KL term of ``ImageTextRetrainTask`` compares the sparse model against the
+dense model (``vit_dense=True, llm_dense=True``), whose weights never change
+during LoRA retraining. Instead of a second forward on every step, the
+temperature-softened teacher distribution of every training sample is kept
+as its ``topk`` largest log-probabilities (fp16 values and int indices) and
+streamed back on the next epochs and runs. Entries are keyed by the sample
+(its id and texts), the temperature ``T`` and a fingerprint of the dense
+weights.
+"""
+
+import glob
+import hashlib
+import os
+
+import torch
+import torch.nn.functional as F
+
+from lavis.common.dist_utils import get_rank
+from lavis.compression.pruners.score_cache import model_fingerprint
+
+
+_ID_KEYS = ["instance_id", "question_id", "image_id"]
+
+
+def _sample_keys(samples):
+    batch_size = len(samples["text_input"])
+    keys = []
+    for i in range(batch_size):
+        h = hashlib.sha1()
+        for k in _ID_KEYS:
+            if k in samples:
+                v = samples[k][i]
+                h.update(f"{k}={v.item() if torch.is_tensor(v) else v}".encode())
+        h.update(samples["text_input"][i].encode())
+        h.update(samples.get("text_output", [""] * batch_size)[i].encode())
+        keys.append(h.hexdigest())
+    return keys
+
+
+def topk_kl_div(student_logits, teacher, T):
+    """
+    ``KL(teacher || student)`` of the softened distributions, summed over the
+    positions and averaged over the batch like ``KLDivLoss("batchmean")``.
+
+    The teacher is known on its top-k tokens only, the other tokens are
+    merged into one bucket on both sides, so the loss is exact when ``topk``
+    covers the vocabulary.
+
+    Args:
+        student_logits: ``(batch, length, vocab)`` logits.
+        teacher: ``(indices, log_probs, valid)`` from ``TeacherLogitCache``.
+        T (float): temperature.
+    """
+    indices, log_p, valid = teacher
+    log_q = F.log_softmax(student_logits.float() / T, -1)
+
+    # the teacher was stored with the padding of another batch
+    length = log_q.shape[1]
+    if indices.shape[1] < length:
+        pad = length - indices.shape[1]
+        indices = F.pad(indices, (0, 0, 0, pad))
+        log_p = F.pad(log_p, (0, 0, 0, pad))
+        valid = F.pad(valid, (0, pad))
+    indices, log_p, valid = indices[:, :length], log_p[:, :length].float(), valid[:, :length]
+
+    log_q_k = log_q.gather(-1, indices.long())
+    p_k = log_p.exp()
+    p_rest = (1 - p_k.sum(-1)).clamp(min=0)
+    log_q_rest = torch.log1p(-log_q_k.exp().sum(-1).clamp(max=1 - 1e-6))
+
+    kl = (p_k * (log_p - log_q_k)).sum(-1)
+    kl = kl + p_rest * (torch.log(p_rest.clamp(min=1e-12)) - log_q_rest)
+    return (kl * valid).sum() / student_logits.shape[0]
+
+
+class TeacherLogitCache:
+    """
+    Args:
+        cache_dir (str): root folder of the cache.
+        model: the model being retrained, its non-LoRA weights give the dense teacher.
+        T (float): distillation temperature.
+        topk (int): tokens kept per position.
+    """
+
+    def __init__(self, cache_dir, model, T, topk=64):
+        self.T = T
+        self.topk = topk
+        model = getattr(model, "module", model)
+        self.dir = os.path.join(cache_dir, f"{model_fingerprint(model)}_T{T}_top{topk}")
+
+        self.entries = {}     # sample key -> (indices, log-probs), one row per position
+        for path in sorted(glob.glob(os.path.join(self.dir, "rank*.pth"))):
+            self.entries.update(torch.load(path, map_location="cpu"))
+        self.own_path = os.path.join(self.dir, f"rank{get_rank()}.pth")
+        self.own = torch.load(self.own_path, map_location="cpu") if os.path.exists(self.own_path) else {}
+        self.dirty = False
+        print(f"teacher cache {self.dir}: {len(self.entries)} samples")
+
+    def lookup(self, samples, device):
+        """The cached teacher of a batch, ``None`` unless all its samples are cached."""
+        keys = _sample_keys(samples)
+        if not all(k in self.entries for k in keys):
+            return None
+        return self._stack([self.entries[k] for k in keys], device)
+
+    @torch.no_grad()
+    def add(self, samples, logits):
+        """Store the teacher ``logits`` of a batch and return them as from ``lookup``."""
+        log_p = F.log_softmax(logits.float() / self.T, -1)
+        log_p, indices = log_p.topk(min(self.topk, log_p.shape[-1]), -1)
+        index_dtype = torch.int16 if logits.shape[-1] <= torch.iinfo(torch.int16).max else torch.int32
+        indices, log_p = indices.to(index_dtype).cpu(), log_p.half().cpu()
+
+        entries = []
+        for i, k in enumerate(_sample_keys(samples)):
+            entry = (indices[i].clone(), log_p[i].clone())
+            self.entries[k] = self.own[k] = entry
+            entries.append(entry)
+        self.dirty = True
+        return self._stack(entries, logits.device)
+
+    def _stack(self, entries, device):
+        length = max(e[0].shape[0] for e in entries)
+        topk = entries[0][0].shape[1]
+        indices = torch.zeros((len(entries), length, topk), dtype=torch.long)
+        log_p = torch.zeros((len(entries), length, topk), dtype=torch.float16)
+        valid = torch.zeros((len(entries), length))
+        for i, (idx, val) in enumerate(entries):
+            indices[i, :idx.shape[0]] = idx.long()
+            log_p[i, :idx.shape[0]] = val
+            valid[i, :idx.shape[0]] = 1
+        return indices.to(device), log_p.to(device), valid.to(device)
+
+    def save(self):
+        """Write the entries of this rank, every rank has its own shard."""
+        if not self.dirty:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self.own_path + f".tmp{os.getpid()}"
+        torch.save(self.own, tmp_path)
+        os.replace(tmp_path, self.own_path)
+        self.dirty = False
+        print(f"teacher cache: {len(self.own)} samples saved at {self.own_path}")
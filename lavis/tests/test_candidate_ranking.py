@@ -0,0 +1,82 @@
+import unittest
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+from lavis.models.blip2_models.candidate_ranking import rank_candidates
+from lavis.models.blip2_models.modeling_t5 import T5Config, T5ForConditionalGeneration
+
+PAD, EOS = 0, 1
+
+# per sample: candidates sharing prefixes, a lone token, lists of different lengths
+CANDIDATES = [
+    [[5, 6, 7, EOS], [5, 6, 8, EOS], [5, 9, EOS], [4, EOS], [5, 6, 7, 3, EOS]],
+    [[7, EOS], [8, EOS]],
+    [[3, 4, 5, 6, 7, 8, EOS], [3, 4, 5, EOS], [9, 9, EOS]],
+]
+
+
+def make_model(tie_word_embeddings):
+    torch.manual_seed(0)
+    config = T5Config(
+        vocab_size=16, d_model=16, d_kv=4, d_ff=32, num_layers=2, num_heads=4,
+        pad_token_id=PAD, eos_token_id=EOS, decoder_start_token_id=PAD,
+        tie_word_embeddings=tie_word_embeddings,
+    )
+    return T5ForConditionalGeneration(config).double().eval()
+
+
+def batched_losses(t5_model, encoder_hidden, encoder_atts, candidate_ids):
+    # the former ranking: repeat the encoder state per candidate and decode every candidate in full
+    losses = []
+    for i, candidates in enumerate(candidate_ids):
+        n = len(candidates)
+        length = max(len(c) for c in candidates)
+        ids = torch.tensor([c + [PAD] * (length - len(c)) for c in candidates])
+        targets = ids.masked_fill(ids == PAD, -100)
+        outputs = t5_model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden[i:i + 1].repeat_interleave(n, dim=0)),
+            attention_mask=encoder_atts[i:i + 1].repeat_interleave(n, dim=0),
+            decoder_attention_mask=(ids != PAD).long(),
+            labels=targets,
+            return_dict=True,
+            reduction="none",
+        )
+        losses.append(outputs.loss)
+    return losses
+
+
+class RankCandidatesTester(unittest.TestCase):
+    """``rank_candidates`` against the per-candidate ``reduction="none"`` loss."""
+
+    def check(self, tie_word_embeddings, max_rows):
+        t5_model = make_model(tie_word_embeddings)
+        bs = len(CANDIDATES)
+        input_ids = torch.randint(2, 16, (bs, 6))
+        encoder_atts = torch.ones(bs, 6, dtype=torch.long)
+        encoder_atts[1, 4:] = 0
+        with torch.no_grad():
+            encoder_hidden = t5_model.encoder(input_ids=input_ids, attention_mask=encoder_atts)[0]
+            expected = batched_losses(t5_model, encoder_hidden, encoder_atts, CANDIDATES)
+        losses = rank_candidates(t5_model, encoder_hidden, encoder_atts, CANDIDATES, max_rows=max_rows)
+
+        self.assertEqual([len(l) for l in losses], [len(c) for c in CANDIDATES])
+        for loss, ref in zip(losses, expected):
+            self.assertTrue(torch.allclose(loss.double(), ref, atol=1e-5), (loss, ref))
+            self.assertEqual(torch.argsort(loss).tolist(), torch.argsort(ref).tolist())
+
+    def test_whole_frontier(self):
+        self.check(tie_word_embeddings=True, max_rows=None)
+
+    def test_max_rows_below_frontier(self):
+        # the first inner frontier has 6 nodes over the three samples
+        for max_rows in [1, 2, 3]:
+            with self.subTest(max_rows=max_rows):
+                self.check(tie_word_embeddings=True, max_rows=max_rows)
+
+    def test_untied_embeddings(self):
+        self.check(tie_word_embeddings=False, max_rows=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from lavis.compression.pruners.grad_accumulator import GradientAccumulator, _buckets, _shard_owners
+
+SHAPES = [(16, 8), (8,), (32, 4), (3, 5), (64,), (4, 4)]
+WORLD_SIZE = 2
+
+
+def batch_grads(rank, batch):
+    generator = torch.Generator().manual_seed(100 * batch + rank)
+    return [torch.randn(shape, generator=generator) for shape in SHAPES]
+
+
+def sharded_worker(rank, init_file, out_dir, bucket_mb):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+    params = [torch.zeros(shape) for shape in SHAPES]
+    names = [f"p{i}" for i in range(len(params))]
+    gradients = GradientAccumulator(names, params, square=True, shard=True, bucket_mb=bucket_mb)
+    for batch in range(3):
+        gradients.add(batch_grads(rank, batch))
+    scores = gradients.importance(lambda param, mean: mean)
+    torch.save({"scores": scores, "buckets": gradients.buckets}, os.path.join(out_dir, f"rank{rank}.pth"))
+    dist.destroy_process_group()
+
+
+class BucketsTester(unittest.TestCase):
+    def test_one_owner_per_bucket(self):
+        params = [torch.zeros(shape) for shape in SHAPES]
+        owners = _shard_owners(params, 3)
+        for max_numel in [1, 40, 100, 10 ** 6]:
+            buckets = _buckets(params, owners, max_numel)
+            self.assertEqual(sorted(i for b in buckets for i in b), list(range(len(params))))
+            for b in buckets:
+                self.assertEqual(len(set(owners[i] for i in b)), 1)
+                # only a parameter larger than the cap makes a larger bucket
+                self.assertTrue(len(b) == 1 or sum(params[i].numel() for i in b) <= max_numel)
+        # without a cap, a single bucket per owner
+        self.assertEqual(len(_buckets(params, owners, 10 ** 6)), len(set(owners)))
+
+
+class ShardedAccumulatorTester(unittest.TestCase):
+    """The bucketed reduces against the unsharded sums of the grads of all ranks."""
+
+    def check(self, bucket_mb):
+        with tempfile.TemporaryDirectory() as out_dir:
+            mp.spawn(
+                sharded_worker, args=(os.path.join(out_dir, "init"), out_dir, bucket_mb),
+                nprocs=WORLD_SIZE, join=True,
+            )
+            results = [torch.load(os.path.join(out_dir, f"rank{r}.pth")) for r in range(WORLD_SIZE)]
+
+        params = [torch.zeros(shape) for shape in SHAPES]
+        names = [f"p{i}" for i in range(len(params))]
+        reference = GradientAccumulator(names, params, square=True)
+        for batch in range(3):
+            for rank in range(WORLD_SIZE):
+                reference.add(batch_grads(rank, batch))
+        expected = reference.importance(lambda param, mean: mean)
+
+        for result in results:
+            self.assertEqual(sorted(result["scores"]), sorted(expected))
+            for name in expected:
+                self.assertTrue(torch.allclose(result["scores"][name], expected[name], atol=1e-5), name)
+        return results[0]["buckets"]
+
+    def test_bucket_per_owner(self):
+        buckets = self.check(bucket_mb=64)
+        self.assertEqual(len(buckets), WORLD_SIZE)
+
+    def test_small_buckets(self):
+        # 0 MB: every parameter is reduced on its own
+        buckets = self.check(bucket_mb=0)
+        self.assertEqual(len(buckets), len(SHAPES))
+
+
+if __name__ == "__main__":
+    unittest.main()
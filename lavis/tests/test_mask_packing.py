@@ -0,0 +1,107 @@
+import unittest
+
+import torch
+
+from lavis.peft.src.peft.tuners.lora import Linear, pack_mask, unpack_mask
+
+
+def nm_keep_mask(rows, cols, prune_n, prune_m, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    scores = torch.rand(rows, cols // prune_m, prune_m, generator=generator)
+    keep = torch.topk(scores, prune_m - prune_n, dim=-1)[1]
+    return torch.zeros_like(scores, dtype=torch.bool).scatter_(-1, keep, True).view(rows, cols)
+
+
+def random_mask(rows, cols, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand(rows, cols, generator=generator) > 0.5
+
+
+class PackMaskTester(unittest.TestCase):
+    def check_round_trip(self, mask, prune_n, prune_m, kind):
+        packed, mask_format = pack_mask(mask, prune_n, prune_m)
+        self.assertEqual(mask_format[0], kind)
+        self.assertEqual(packed.dtype, torch.uint8)
+        self.assertEqual(packed.shape[0], mask.shape[0])
+        self.assertTrue(torch.equal(unpack_mask(packed, mask_format), mask))
+        # rows of the chunked training forward
+        for start, end in [(0, 1), (2, 5), (3, mask.shape[0])]:
+            self.assertTrue(torch.equal(unpack_mask(packed, mask_format, start, end), mask[start:end]))
+        return packed
+
+    def test_nm(self):
+        for prune_n, prune_m, code_bits in [(2, 4, 3), (1, 4, 2), (3, 4, 2), (4, 8, 7)]:
+            mask = nm_keep_mask(6, 32, prune_n, prune_m)
+            packed = self.check_round_trip(mask, prune_n, prune_m, "nm")
+            self.assertEqual(packed.shape[1], -(-(32 // prune_m * code_bits) // 8))
+
+    def test_bitmap(self):
+        # cols % 8 != 0, no N:M pattern requested
+        self.check_round_trip(random_mask(6, 13), 0, 0, "bitmap")
+        # N:M requested but the mask does not follow it
+        mask = nm_keep_mask(6, 12, 2, 4)
+        mask[1, :4] = False
+        self.check_round_trip(mask, 2, 4, "bitmap")
+        # cols not a multiple of prune_m
+        self.check_round_trip(random_mask(6, 13), 2, 4, "bitmap")
+
+
+class PackedLinearTester(unittest.TestCase):
+    def make_layer(self, mask=None, packed=False):
+        layer = Linear(12, 6, r=2)
+        if mask is not None:
+            if packed:
+                layer.set_packed_mask(mask, 2, 4)
+            else:
+                layer.mask = mask
+        return layer
+
+    def test_set_packed_mask(self):
+        mask = nm_keep_mask(6, 12, 2, 4)
+        layer = self.make_layer(mask, packed=True)
+        self.assertNotIn("mask", layer._buffers)
+        self.assertEqual(layer.mask_format[0], "nm")
+        self.assertTrue(torch.equal(layer.mask, mask))
+
+        # assigning repacks the new mask
+        new_mask = nm_keep_mask(6, 12, 2, 4, seed=1)
+        layer.mask = new_mask
+        self.assertNotIn("mask", layer._buffers)
+        self.assertEqual(layer.mask_format[0], "nm")
+        self.assertTrue(torch.equal(layer.mask, new_mask))
+
+        # a mask without the N:M pattern is repacked as a bitmap
+        bitmap_mask = random_mask(6, 12)
+        layer.mask = bitmap_mask
+        self.assertEqual(layer.mask_format[0], "bitmap")
+        self.assertTrue(torch.equal(layer.mask, bitmap_mask))
+
+        layer.unpack_mask()
+        self.assertIn("mask", layer._buffers)
+        self.assertNotIn("mask_packed", layer._buffers)
+        self.assertTrue(torch.equal(layer.mask, bitmap_mask))
+
+    def test_state_dict(self):
+        mask = nm_keep_mask(6, 12, 2, 4)
+        source = self.make_layer(mask, packed=True)
+        state_dict = source.state_dict()
+        # the checkpoint layout of the boolean mask
+        self.assertNotIn("mask_packed", state_dict)
+        self.assertEqual(state_dict["mask"].dtype, torch.bool)
+        self.assertTrue(torch.equal(state_dict["mask"], mask))
+
+        unpacked = self.make_layer()
+        unpacked.load_state_dict(state_dict)
+        self.assertIn("mask", unpacked._buffers)
+        self.assertTrue(torch.equal(unpacked.mask, mask))
+
+        packed = self.make_layer(nm_keep_mask(6, 12, 2, 4, seed=1), packed=True)
+        packed.load_state_dict(state_dict)
+        self.assertNotIn("mask", packed._buffers)
+        self.assertEqual(packed.mask_format[0], "nm")
+        self.assertTrue(torch.equal(packed.mask, mask))
+        self.assertTrue(torch.equal(packed.weight, source.weight))
+
+        # and from an unpacked module into a packed one
+        packed.load_state_dict(self.make_layer(random_mask(6, 12)).state_dict())
+        self.assertEqual(packed.mask_format[0], "bitmap")
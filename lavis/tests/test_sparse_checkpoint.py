@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from lavis.compression.sparse_checkpoint import (
+    LazyCheckpoint,
+    compress_state_dict,
+    decompress_state_dict,
+    is_nm_sparse,
+    load_checkpoint,
+    save_sparse_checkpoint,
+)
+
+
+def nm_pruned(rows, cols, prune_n, prune_m, seed=0):
+    # the pruners zero the prune_n smallest entries of every group of prune_m columns
+    generator = torch.Generator().manual_seed(seed)
+    weight = torch.randn(rows, cols, generator=generator)
+    groups = weight.view(rows, -1, prune_m)
+    pruned = torch.topk(groups.abs(), prune_n, dim=-1, largest=False)[1]
+    groups.scatter_(-1, pruned, 0)
+    return weight
+
+
+class SparseCheckpointTester(unittest.TestCase):
+    def assert_round_trip(self, state_dict, prune_n=0, prune_m=0):
+        checkpoint = compress_state_dict(state_dict, prune_n=prune_n, prune_m=prune_m)
+        restored = decompress_state_dict(checkpoint)
+        self.assertEqual(set(restored.keys()), set(state_dict.keys()))
+        for k, v in state_dict.items():
+            self.assertEqual(restored[k].dtype, v.dtype, k)
+            self.assertTrue(torch.equal(restored[k], v), k)
+        return checkpoint
+
+    def test_bitmap(self):
+        generator = torch.Generator().manual_seed(0)
+        weight = torch.randn(16, 20, generator=generator)
+        weight[torch.rand(16, 20, generator=generator) < 0.6] = 0
+        state_dict = {
+            "weight": weight,
+            "half_weight": weight.half(),
+            "mask": weight != 0,
+            "bias": torch.randn(16, generator=generator),
+            "dense_weight": torch.randn(8, 8, generator=generator),
+        }
+        checkpoint = self.assert_round_trip(state_dict)
+        self.assertEqual(checkpoint["sparse"]["weight"]["format"], "bitmap")
+        self.assertEqual(checkpoint["sparse"]["mask"]["format"], "bitmask")
+        self.assertIn("bias", checkpoint["dense"])
+        self.assertIn("dense_weight", checkpoint["dense"])
+
+    def test_nm(self):
+        for prune_n, prune_m in [(2, 4), (1, 4), (3, 4), (4, 8)]:
+            weight = nm_pruned(12, 32, prune_n, prune_m)
+            self.assertTrue(is_nm_sparse(weight, prune_n, prune_m))
+            # min_sparsity keeps 1:4 weights dense, compress them anyway
+            checkpoint = compress_state_dict({"weight": weight}, prune_n=prune_n, prune_m=prune_m, min_sparsity=0)
+            entry = checkpoint["sparse"]["weight"]
+            self.assertEqual(entry["format"], "nm", (prune_n, prune_m))
+            self.assertEqual(entry["values"].shape, (12, 32 // prune_m, prune_m - prune_n))
+            self.assertTrue(torch.equal(decompress_state_dict(checkpoint)["weight"], weight))
+
+    def test_nm_extra_zeros(self):
+        # groups with more than prune_n zeros still use the N:M encoding
+        weight = nm_pruned(8, 16, 2, 4)
+        weight[:, :4] = 0
+        checkpoint = self.assert_round_trip({"weight": weight}, prune_n=2, prune_m=4)
+        self.assertEqual(checkpoint["sparse"]["weight"]["format"], "nm")
+
+    def test_not_nm_falls_back_to_bitmap(self):
+        weight = nm_pruned(8, 16, 1, 4)
+        self.assertFalse(is_nm_sparse(weight, 2, 4))
+        weight = nm_pruned(8, 16, 2, 4)
+        weight[0, 0] = weight[0, 1] = weight[0, 2] = 1.0
+        self.assertFalse(is_nm_sparse(weight, 2, 4))
+        checkpoint = self.assert_round_trip({"weight": weight}, prune_n=2, prune_m=4)
+        self.assertEqual(checkpoint["sparse"]["weight"]["format"], "bitmap")
+
+    def test_save_and_load(self):
+        state_dict = {"weight": nm_pruned(8, 16, 2, 4), "mask": nm_pruned(8, 16, 2, 4) != 0}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "pruned.pth")
+            save_sparse_checkpoint(state_dict, path, prune_n=2, prune_m=4)
+            restored = load_checkpoint(path)
+            lazy = LazyCheckpoint(path)
+            for k, v in state_dict.items():
+                self.assertTrue(torch.equal(restored[k], v))
+                self.assertTrue(torch.equal(lazy[k], v))
+
+
+class PrunedStateDictTester(unittest.TestCase):
+    def test_masked_lora_model(self):
+        # the pruners set the masks of LoRA linears without zeroing their weights
+        from lavis.compression.pruners.utils import nm_prune_mask, set_mask
+        from lavis.compression.sparse_checkpoint import pruned_state_dict
+        from lavis.peft.src.peft.tuners.lora import Linear
+
+        torch.manual_seed(0)
+        model = torch.nn.ModuleDict({
+            "unstructured": Linear(32, 16, r=4),
+            "nm": Linear(32, 16, r=4),
+            "packed": Linear(32, 16, r=4),
+        })
+        metric = model["unstructured"].weight.abs()
+        set_mask(model["unstructured"], metric > metric.median())
+        set_mask(model["nm"], ~nm_prune_mask(model["nm"].weight.abs(), 2, 4))
+        set_mask(model["packed"], ~nm_prune_mask(model["packed"].weight.abs(), 2, 4), pack=True, prune_n=2, prune_m=4)
+
+        dense = compress_state_dict(model.state_dict(), prune_n=2, prune_m=4)
+        self.assertIn("nm.weight", dense["dense"])
+
+        checkpoint = compress_state_dict(pruned_state_dict(model), prune_n=2, prune_m=4)
+        self.assertEqual(checkpoint["sparse"]["unstructured.weight"]["format"], "bitmap")
+        self.assertEqual(checkpoint["sparse"]["nm.weight"]["format"], "nm")
+        self.assertEqual(checkpoint["sparse"]["packed.weight"]["format"], "nm")
+        self.assertIn("nm.lora_A.weight", checkpoint["dense"])
+
+        restored = decompress_state_dict(checkpoint)
+        for name, module in model.items():
+            self.assertTrue(torch.equal(restored[f"{name}.weight"], module.weight * module.mask))
+            self.assertTrue(torch.equal(restored[f"{name}.mask"], module.mask))
@@ -0,0 +1,61 @@
+import copy
+import unittest
+
+import torch
+
+from lavis.peft.src.peft.tuners.lora import Linear
+
+
+def nm_keep_mask(weight, prune_n, prune_m):
+    groups = weight.abs().view(weight.shape[0], -1, prune_m)
+    keep = torch.topk(groups, prune_m - prune_n, dim=-1)[1]
+    return torch.zeros_like(groups, dtype=torch.bool).scatter_(-1, keep, True).view(weight.shape)
+
+
+def make_layer(sparse, packed, in_features=12, out_features=10):
+    torch.manual_seed(0)
+    layer = Linear(in_features, out_features, r=4, lora_alpha=8).double()
+    torch.nn.init.normal_(layer.lora_B.weight)
+    layer.sparse = sparse
+    if packed:
+        layer.set_packed_mask(nm_keep_mask(layer.weight, 2, 4), 2, 4)
+    else:
+        layer.mask = torch.rand(out_features, in_features) > 0.5
+    layer.train()
+    return layer
+
+
+def forward_backward(layer, x, grad_output):
+    x = x.clone().requires_grad_(True)
+    out = layer(x)
+    out.backward(grad_output)
+    return out, [x.grad, layer.lora_A.weight.grad, layer.lora_B.weight.grad, layer.bias.grad]
+
+
+class SparseLoraLinearFunctionTester(unittest.TestCase):
+    """The chunked training forward against ``F.linear(x, effective_weight())``."""
+
+    def check(self, sparse, packed, chunk_size, shape):
+        reference = make_layer(sparse, packed)
+        chunked = copy.deepcopy(reference)
+        chunked.chunk_size = chunk_size
+
+        x = torch.randn(*shape, 12, dtype=torch.float64)
+        grad_output = torch.randn(*shape, 10, dtype=torch.float64)
+        out_ref, grads_ref = forward_backward(reference, x, grad_output)
+        out, grads = forward_backward(chunked, x, grad_output)
+
+        self.assertIn("SparseLoraLinearFunction", type(out.grad_fn).__name__)
+        self.assertTrue(torch.allclose(out, out_ref, atol=1e-10))
+        for name, g, g_ref in zip(["x", "lora_A", "lora_B", "bias"], grads, grads_ref):
+            self.assertIsNotNone(g, name)
+            self.assertTrue(torch.allclose(g, g_ref, atol=1e-10), (name, sparse, packed, chunk_size, shape))
+
+    def test_equivalence(self):
+        for sparse in [True, False]:
+            for packed in [False, True]:
+                # 3 does not divide the 10 output features, 16 covers them in one chunk
+                for chunk_size in [3, 16]:
+                    for shape in [(7,), (2, 5)]:
+                        self.check(sparse, packed, chunk_size, shape)
+
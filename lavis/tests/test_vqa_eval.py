@@ -0,0 +1,120 @@
+import copy
+import random
+import unittest
+
+from lavis.common.vqa_tools.vqa_eval import VQAEval
+
+
+class ReferenceVQAEval(VQAEval):
+    """The per-answer leave-one-out loop ``VQAEval.evaluate`` replaced."""
+
+    def evaluate(self, quesIds=None):
+        if quesIds == None:
+            quesIds = [quesId for quesId in self.params["question_id"]]
+        gts = {quesId: self.vqa.qa[quesId] for quesId in quesIds}
+        res = {quesId: self.vqaRes.qa[quesId] for quesId in quesIds}
+
+        accQA = []
+        accQuesType = {}
+        accAnsType = {}
+        for quesId in quesIds:
+            resAns = res[quesId]["answer"]
+            resAns = resAns.replace("\n", " ")
+            resAns = resAns.replace("\t", " ")
+            resAns = resAns.strip()
+            resAns = self.processPunctuation(resAns)
+            resAns = self.processDigitArticle(resAns)
+            gtAcc = []
+            gtAnswers = [ans["answer"] for ans in gts[quesId]["answers"]]
+            if len(set(gtAnswers)) > 1:
+                for ansDic in gts[quesId]["answers"]:
+                    ansDic["answer"] = self.processPunctuation(ansDic["answer"])
+            for gtAnsDatum in gts[quesId]["answers"]:
+                otherGTAns = [
+                    item for item in gts[quesId]["answers"] if item != gtAnsDatum
+                ]
+                matchingAns = [item for item in otherGTAns if item["answer"] == resAns]
+                acc = min(1, float(len(matchingAns)) / 3)
+                gtAcc.append(acc)
+            quesType = gts[quesId]["question_type"]
+            ansType = gts[quesId]["answer_type"]
+            avgGTAcc = float(sum(gtAcc)) / len(gtAcc)
+            accQA.append(avgGTAcc)
+            accQuesType.setdefault(quesType, []).append(avgGTAcc)
+            accAnsType.setdefault(ansType, []).append(avgGTAcc)
+            self.setEvalQA(quesId, avgGTAcc)
+            self.setEvalQuesType(quesId, quesType, avgGTAcc)
+            self.setEvalAnsType(quesId, ansType, avgGTAcc)
+
+        self.setAccuracy(accQA, accQuesType, accAnsType)
+
+
+class FakeVQA:
+    def __init__(self, qa):
+        self.qa = qa
+
+    def getQuesIds(self):
+        return list(self.qa.keys())
+
+
+ANSWERS = [
+    "two", "2", "a dog", "dog", "Dog.", "the dog", "yes", "no", "Yes",
+    "red, blue", "red blue", "it's", "its", "3.5", "none", "dogs", "",
+]
+
+
+def synthetic_questions(num_questions, seed=0):
+    rng = random.Random(seed)
+    gt, res = {}, {}
+    for quesId in range(num_questions):
+        pool = rng.sample(ANSWERS, rng.randint(1, 5))
+        answers = []
+        for answer_id in range(rng.choice([1, 2, 3, 5, 10, 10, 10])):
+            ansDic = {"answer": rng.choice(pool)}
+            if rng.random() < 0.7:
+                # without an id, equal answers are equal dicts and leave-one-out drops all of them
+                ansDic["answer_id"] = answer_id + 1
+            answers.append(ansDic)
+        gt[quesId] = {
+            "answers": answers,
+            "question_type": rng.choice(["what is", "how many", "is the"]),
+            "answer_type": rng.choice(["other", "number", "yes/no"]),
+        }
+        prediction = rng.choice(pool + ANSWERS[:3])
+        res[quesId] = {"answer": rng.choice([prediction, " " + prediction, prediction + "\n"])}
+    return gt, res
+
+
+def run(eval_class, gt, res):
+    evaluator = eval_class(FakeVQA(copy.deepcopy(gt)), FakeVQA(res))
+    evaluator.evaluate()
+    return evaluator
+
+
+class VQAEvalTester(unittest.TestCase):
+    def test_matches_reference(self):
+        for seed in range(5):
+            gt, res = synthetic_questions(300, seed)
+            evaluator, reference = run(VQAEval, gt, res), run(ReferenceVQAEval, gt, res)
+            self.assertEqual(evaluator.accuracy, reference.accuracy)
+            self.assertEqual(evaluator.evalQA, reference.evalQA)
+            self.assertEqual(evaluator.evalQuesType, reference.evalQuesType)
+            self.assertEqual(evaluator.evalAnsType, reference.evalAnsType)
+
+    def test_disagreeing_annotators(self):
+        answers = ["two", "2", "two", "Two.", "three", "two", "2", "four", "two", "2"]
+        gt = {0: {
+            "answers": [{"answer": a, "answer_id": i + 1} for i, a in enumerate(answers)],
+            "question_type": "how many",
+            "answer_type": "number",
+        }}
+        for prediction in ["2", "two", "three", "five"]:
+            evaluator = run(VQAEval, gt, {0: {"answer": prediction}})
+            reference = run(ReferenceVQAEval, gt, {0: {"answer": prediction}})
+            self.assertEqual(evaluator.evalQA, reference.evalQA)
+
+    def test_question_without_answers(self):
+        gt, res = synthetic_questions(10)
+        gt[3]["answers"] = []
+        with self.assertRaises(ZeroDivisionError):
+            run(VQAEval, gt, res)
@@ -20,6 +20,8 @@ from lavis.common.optims import (
 from lavis.common.registry import registry
 from lavis.common.utils import now
 from lavis.compression import load_pruner
+from lavis.compression.pruners.utils import zero_pruned_weights
+from lavis.compression.sparse_checkpoint import LazyCheckpoint, load_into_module, pruned_state_dict, save_sparse_checkpoint
 from lavis.runners import *
 
 def print_gpu_memory_device(device=None):
@@ -168,6 +170,11 @@ def parse_args():
         "--save_pruned_model", action="store_true"
     )
 
+    parser.add_argument(
+        "--sparse_inference", action="store_true",
+        help="replace pruned linears with sparse-executing modules before evaluation",
+    )
+
     parser.add_argument(
         "--sparsity_ratio_granularity",
         type=str,
@@ -233,6 +240,13 @@ def parse_args():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--lora_chunk_size",
+        type=int,
+        default=1024,
+        help="output rows per chunk of the memory-lean SparseLoRA training forward, 0 to build the full weight",
+    )
+
     parser.add_argument(
         "--prune_n",
         type=int,
@@ -245,6 +259,113 @@ def parse_args():
         default=0,
     )
 
+    parser.add_argument(
+        "--calibration_batch_size",
+        type=int,
+        default=32,
+        help="number of calibration samples per block forward in layer-wise pruners, <= 0 for one captured batch at a time",
+    )
+
+    parser.add_argument(
+        "--fused_propagate",
+        action="store_true",
+        help="reuse the statistics pass outputs as next block inputs when pruning leaves the block forward unchanged",
+    )
+
+    parser.add_argument(
+        "--activation_offload",
+        type=str,
+        default="device",
+        choices=["device", "cpu", "disk"],
+        help="where layer-wise pruners keep the calibration activations between block forwards",
+    )
+
+    parser.add_argument(
+        "--activation_offload_dir",
+        type=str,
+        default=None,
+        help="directory for the memory-mapped calibration activations when --activation_offload disk",
+    )
+
+    parser.add_argument(
+        "--pack_masks",
+        action="store_true",
+        help="store the SparseLoRA masks bit-packed (1 bit per weight, or N:M pattern codes) instead of as bool tensors",
+    )
+
+    parser.add_argument(
+        "--grad_accum_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "float16"],
+        help="dtype of the on-device gradient sums used by first-order importance scores",
+    )
+
+    parser.add_argument(
+        "--shard_grad_accum",
+        action="store_true",
+        help="shard the gradient sums of the importance scores across ranks",
+    )
+
+    parser.add_argument(
+        "--zo_max_replicas",
+        type=int,
+        default=16,
+        help="perturbed models stacked along the batch in one forward of the zeroth-order (MeZO) scorers",
+    )
+
+    parser.add_argument(
+        "--prune_workers",
+        type=int,
+        default=1,
+        help="linears of a block pruned concurrently by SparseGPT (threads on CPU, streams on GPU); "
+             "also the number of Hessians being factorized at once",
+    )
+
+    parser.add_argument(
+        "--sparsegpt_blocksize",
+        type=int,
+        default=128,
+        help="columns per lazily updated block of the SparseGPT OBS updates",
+    )
+
+    parser.add_argument(
+        "--sparsegpt_sub_blocksize",
+        type=int,
+        default=32,
+        help="columns per sub-block inside a SparseGPT block, the rest of the block is updated with one GEMM",
+    )
+
+    parser.add_argument(
+        "--hessian_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16"],
+        help="dtype the SparseGPT Hessians are stored in during collection, they are converted to float32 for pruning",
+    )
+
+    parser.add_argument(
+        "--hessian_offload",
+        action="store_true",
+        help="keep the collected SparseGPT Hessians in host memory until their linear is pruned",
+    )
+
+    parser.add_argument(
+        "--sweep_sparsities",
+        type=str,
+        default=None,
+        help="comma separated sparsities, e.g. 0.3,0.4,0.5; prune once for all of them and save one sparse "
+             "checkpoint per level instead of pruning, retraining and evaluating a single model",
+    )
+
+    parser.add_argument(
+        "--score_cache_dir",
+        type=str,
+        default=None,
+        help="folder of the content-addressed cache of importance scores, layer sparsities and masks, "
+             "keyed by model weights, calibration data and pruning settings",
+    )
+
     parser.add_argument(
         "--weight_decay",
         type=float,
@@ -281,8 +402,54 @@ def parse_args():
         type=float,
         default=1.,
     )
+    parser.add_argument(
+        "--teacher_cache_dir",
+        type=str,
+        default=None,
+        help="cache the dense-teacher distributions of retraining on disk instead of recomputing them every step",
+    )
+    parser.add_argument(
+        "--teacher_topk",
+        type=int,
+        default=64,
+        help="teacher tokens kept per position in the teacher cache",
+    )
+    parser.add_argument(
+        "--cache_frozen_vision",
+        action="store_true",
+        help="compute the vision trunk once per image during retraining when V is not in tune_opt; "
+             "needs a deterministic train image processor (e.g. blip_image_eval), random augmentation never hits",
+    )
+    parser.add_argument(
+        "--vision_cache_dir",
+        type=str,
+        default=None,
+        help="persist the cached vision features of --cache_frozen_vision on disk",
+    )
+    parser.add_argument(
+        "--vision_cache_max_gb",
+        type=float,
+        default=16,
+        help="host memory budget of the cached vision features of --cache_frozen_vision",
+    )
+    parser.add_argument(
+        "--image_feature_store",
+        type=str,
+        default=None,
+        help="memory-mapped store of the vision features of the evaluation splits; the first evaluation "
+             "writes them, evaluations with the same vision encoder (e.g. other LLM sparsities) read them",
+    )
+    parser.add_argument(
+        "--extract_image_features",
+        action="store_true",
+        help="with --evaluate, only write the vision features of the test splits to --image_feature_store "
+             "and skip the evaluation",
+    )
     args = parser.parse_args()
 
+    if args.extract_image_features and (args.image_feature_store is None or not args.evaluate):
+        parser.error("--extract_image_features needs --evaluate and --image_feature_store")
+
     return args
 
 
@@ -369,35 +536,30 @@ def main():
     if args.t5_pruned_checkpoint is not None and getattr(model, args.t5_model_prefix, None) is not None:
         # TODO align with other language models. 
         print(f"Load {args.t5_model_prefix} pruned weight")
-        prune_state_dict = torch.load(args.t5_pruned_checkpoint, map_location="cpu")
-        prune_state_dict = {k: v for k, v in prune_state_dict.items() if k.startswith("t5_model")}
-        prune_state_dict = {k.replace(args.t5_model_prefix, ""): v for k, v in prune_state_dict.items()}
-        model.t5_model.load_state_dict(prune_state_dict)
+        prune_checkpoint = LazyCheckpoint(args.t5_pruned_checkpoint, map_location="cpu")
+        load_into_module(prune_checkpoint, model.t5_model, args.t5_model_prefix)
+        del prune_checkpoint
 
     if args.vit_pruned_checkpoint is not None:
         print("Load vit pruned weight")
-        prune_state_dict = torch.load(args.vit_pruned_checkpoint, map_location="cpu")
-        model_prefix = None
-        for candidate_prefix in ["visual.", "visual_encoder."]:
-            if any(k.startswith(candidate_prefix) for k in prune_state_dict.keys()):
-                model_prefix = candidate_prefix
-                break
+        prune_checkpoint = LazyCheckpoint(args.vit_pruned_checkpoint, map_location="cpu")
+        model_prefix = prune_checkpoint.find_prefix(["visual.", "visual_encoder."])
 
         assert model_prefix is not None
 
-        prune_state_dict = {k: v for k, v in prune_state_dict.items() if k.startswith(model_prefix)}
         print(f"VIT checkpoint prefix: {model_prefix}")
-        prune_state_dict = {k.replace(model_prefix, ""): v for k, v in prune_state_dict.items()}
-        original_state_dict = model.visual_encoder.state_dict()
+        from lavis.models.eva_vit import interpolate_pos_embed
 
-        for k, v in prune_state_dict.items():
-            if k in original_state_dict:
-                original_state_dict[k] = v
+        def _interpolate_pos_embed(pos_embed):
+            pos_embed_dict = {"pos_embed": pos_embed}
+            interpolate_pos_embed(model.visual_encoder, pos_embed_dict)
+            return pos_embed_dict["pos_embed"]
 
-        prune_state_dict = original_state_dict
-        from lavis.models.eva_vit import interpolate_pos_embed
-        interpolate_pos_embed(model.visual_encoder, prune_state_dict)
-        model.visual_encoder.load_state_dict(prune_state_dict)
+        load_into_module(
+            prune_checkpoint, model.visual_encoder, model_prefix, strict=False,
+            transforms={"pos_embed": _interpolate_pos_embed},
+        )
+        del prune_checkpoint
 
     distilled_total_size = sum(
         (param != 0).float().sum() for name, param in model.named_parameters() if "lora_" not in name
@@ -490,8 +652,8 @@ def main():
         "vit_prune_spec": args.vit_prune_spec if args.vit_pruned_checkpoint is None else None,
         "t5_pruning_method": "none",
         "vit_pruning_method": "none",
-        "importance_scores_cache": None,
-        "keep_indices_cache": None,
+        "importance_scores_cache": args.score_cache_dir,
+        "keep_indices_or_masks_cache": args.score_cache_dir,
         "is_strct_pruning": False,
         "is_global": args.is_global,
         "num_samples": args.num_data,
@@ -505,6 +667,19 @@ def main():
         "iteration": args.iteration,
         "prune_n": args.prune_n,
         "prune_m": args.prune_m,
+        "calibration_batch_size": args.calibration_batch_size,
+        "fused_propagate": args.fused_propagate,
+        "activation_offload": args.activation_offload,
+        "activation_offload_dir": args.activation_offload_dir,
+        "pack_masks": args.pack_masks,
+        "grad_accum_dtype": args.grad_accum_dtype,
+        "shard_grad_accum": args.shard_grad_accum,
+        "zo_max_replicas": args.zo_max_replicas,
+        "prune_workers": args.prune_workers,
+        "sparsegpt_blocksize": args.sparsegpt_blocksize,
+        "sparsegpt_sub_blocksize": args.sparsegpt_sub_blocksize,
+        "hessian_dtype": args.hessian_dtype,
+        "hessian_offload": args.hessian_offload,
         "without_DSnoT": args.without_DSnoT,
         "initial_method": args.initial_method,
         "t5_model_prefix": args.t5_model_prefix,
@@ -566,6 +741,29 @@ def main():
                 cfg=config,
             )
 
+        if args.sweep_sparsities is not None:
+            saved_folder = os.path.join("pruned_checkpoint/V+L", args.pruning_method)
+            os.makedirs(saved_folder, exist_ok=True)
+
+            def save_level(sparsity, model, sparsity_dict):
+                save_sparse_checkpoint(
+                    pruned_state_dict(model),
+                    os.path.join(saved_folder, f"{job_id}_sparsity{sparsity}.pth"),
+                    prune_n=args.prune_n,
+                    prune_m=args.prune_m,
+                )
+                if sparsity_dict is not None:
+                    os.makedirs("sparsity_dict", exist_ok=True)
+
+                    import yaml
+                    with open(os.path.join("sparsity_dict", f"{job_id}_sparsity{sparsity}.yaml"), "w") as f:
+                        yaml.dump(sparsity_dict, f)
+
+            sparsities = [float(s) for s in args.sweep_sparsities.split(",")]
+            pruner.prune_sweep(sparsities, save_level, lora_model=True)
+            print(f"**** Sweep Done: {len(sparsities)} sparse checkpoints in {saved_folder}")
+            return
+
         model, sparsity_dict = pruner.prune(lora_model=True)
         _wrapped_model = prune_runner.model if prune_runner.use_distributed else _wrapped_model
 
@@ -588,10 +786,26 @@ def main():
         getattr(model, args.t5_model_prefix).config.use_cache = False
         setattr(task, "kl_weight", args.kl_weight)
         setattr(task, "T", args.T)
+        setattr(task, "teacher_cache_dir", args.teacher_cache_dir)
+        setattr(task, "teacher_topk", args.teacher_topk)
+        setattr(task, "cache_frozen_vision", args.cache_frozen_vision)
+        setattr(task, "vision_cache_dir", args.vision_cache_dir)
+        setattr(task, "vision_cache_max_gb", args.vision_cache_max_gb)
 
         if train_datasets is None:
             train_datasets = task.build_datasets(cfg, args.max_train_samples)
 
+        if args.cache_frozen_vision:
+            from lavis.models.blip2_models.image_feature_cache import deterministic_processor
+            # a randomly augmented image is a new cache key on every epoch
+            random_datasets = [
+                name for name, splits in train_datasets.items()
+                if "train" in splits and deterministic_processor(getattr(splits["train"], "vis_processor", None)) is False
+            ]
+            if len(random_datasets) > 0:
+                print(f"--cache_frozen_vision is ignored, the image processors of {random_datasets} are random")
+                setattr(task, "cache_frozen_vision", False)
+
         for name, param in model.named_parameters():  # TODO exclude the grad from other modules.
             if param.requires_grad:
                 if not any(remained in name for remained in remain_grads) or "LayerNorm" in name:
@@ -607,6 +821,7 @@ def main():
         for name, module in model.named_modules():
             if isinstance(module, (Linear, LoraLayer, Linear8bitLt)):
                 setattr(module, "sparse", sparse)
+                setattr(module, "chunk_size", args.lora_chunk_size)
                     
         if train_runner is None:
             train_runner = RunnerBase(
@@ -634,7 +849,7 @@ def main():
         if args.sparse:
             for name, module in model.named_modules():
                 if isinstance(module, (Linear, LoraLayer, Linear8bitLt)):
-                    module.weight.data[~module.mask] = 0  
+                    zero_pruned_weights(module, ~module.mask)
         
         distilled_total_size = sum(
             (param != 0).float().sum() for name, param in model.named_parameters() if "lora" not in name
@@ -646,6 +861,24 @@ def main():
         print(f"peak_memory: {peak_memory}")
         getattr(model, args.t5_model_prefix).config.use_cache = use_cache
 
+    if args.save_pruned_model:
+        # before the sparse inference conversion, which drops the LoRA entries
+        saved_folder = os.path.join("pruned_checkpoint/V+L", args.pruning_method)
+        os.makedirs(saved_folder, exist_ok=True)
+
+        # pruning only sets the masks, the pruned weights are zeroed here unless
+        # retraining merged a dense LoRA update into them
+        save_sparse_checkpoint(
+            model.state_dict() if args.train and not args.sparse else pruned_state_dict(model),
+            os.path.join(saved_folder, job_id + ".pth"),
+            prune_n=args.prune_n,
+            prune_m=args.prune_m,
+        )
+
+    if args.sparse_inference:
+        from lavis.compression.sparse_inference import convert_to_sparse_inference
+        convert_to_sparse_inference(model, prune_n=args.prune_n, prune_m=args.prune_m)
+
     if args.evaluate:
         eval_args = copy.deepcopy(args)
         eval_args.cfg_path = eval_args.eval_cfg_path
@@ -669,20 +902,25 @@ def main():
         eval_runner._wrapped_model = _wrapped_model
         eval_runner.orig_total_size = orig_total_size
         eval_runner.distilled_total_size = distilled_total_size
-        eval_runner.evaluate(skip_reload=True)
+        if args.extract_image_features:
+            from lavis.models.blip2_models.image_feature_cache import ImageFeatureStore
+            store = ImageFeatureStore(args.image_feature_store)
+            model.eval()
+            for split_name in eval_runner.test_splits:
+                store.extract(model, eval_runner.dataloaders[split_name], cuda_enabled=eval_runner.cuda_enabled)
+        else:
+            if args.image_feature_store is not None:
+                from lavis.models.blip2_models.image_feature_cache import ImageFeatureStore
+                model.image_feature_cache = ImageFeatureStore(args.image_feature_store)
+            eval_runner.evaluate(skip_reload=True)
+            if args.image_feature_store is not None:
+                model.image_feature_cache.flush()
+                model.image_feature_cache = None
         torch.cuda.empty_cache()
         peak_memory = (torch.cuda.max_memory_allocated() / 1024 ** 2) / 1000
         print(f"peak_memory: {peak_memory}")
 
     if args.save_pruned_model:
-        saved_folder = os.path.join("pruned_checkpoint/V+L", args.pruning_method)
-        os.makedirs(saved_folder, exist_ok=True)
-
-        torch.save(
-            model.state_dict(),
-            os.path.join(saved_folder, job_id + ".pth")
-        )
-
         # TODO save sparsity dict
         if sparsity_dict is not None and isinstance(sparsity_dict, dict):
             saved_folder = "sparsity_dict"